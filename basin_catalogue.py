@@ -0,0 +1,142 @@
+import os
+import pandas as pd
+import geopandas as gpd
+from shapely.ops import unary_union
+from utils import shp_id, geodesic_area_perimeter, valid_geometry
+from manifest import paths
+
+'''
+流域几何目录: 一次性读入所有流域 shapefile 的几何、编号 (shp_id)、外包矩形和面积, 供各属性计算脚本共享,
+避免每个脚本、每个函数重复打开同一个 shapefile。目录可保存为 GeoParquet 以便下次直接读取。
+
+Requirement:
+Catchment shapefiles
+├── folder_shp
+|   ├── basin_0000.shp
+|   ├── basin_0000.dbf
+|   ├── basin_0000.sbx
+|   ├── basin_0000.cpg
+|   ├── ...
+'''
+
+
+class BasinCatalogue():
+    """
+    所有流域的几何与基本信息, 以流域编号 (shp_id) 为索引的 GeoDataFrame:
+    path, geometry (EPSG:4326), minx, miny, maxx, maxy, area_km2, shp_stamp (见 shapefile_stamp),
+    以及 shapefile 第一条记录的属性字段 (如 GDBD_ID)
+    """
+
+    def __init__(self, basins: gpd.GeoDataFrame):
+        self.basins = basins
+        self._records = None
+
+    @classmethod
+    def from_folder(cls, shp_dir: str):
+        """
+        shp_dir: 流域 shapefile 文件夹, 每个 .shp 文件为一个流域; 没有记录的 shapefile 被跳过 (打印警告),
+                 流域编号 (shp_id) 重复时报错
+        """
+        records = []
+        for shape_file in paths(shp_dir, suffix='.shp'):
+            gdf = gpd.read_file(shape_file)
+            if len(gdf) == 0:
+                print(f'skip empty shapefile: {shape_file}')
+                continue
+            if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+                gdf = gdf.to_crs(epsg=4326)
+            record = gdf.drop(columns='geometry').iloc[0].to_dict()
+            geometry = unary_union(list(gdf.geometry)) if len(gdf) > 1 else gdf.geometry.iloc[0]
+            record.update({'shp_id': shp_id(shape_file), 'path': shape_file, 'shp_stamp': shapefile_stamp(shape_file),
+                           'geometry': valid_geometry(geometry)})
+            records.append(record)
+        basins = gpd.GeoDataFrame(records, geometry='geometry', crs='EPSG:4326').set_index('shp_id')
+        if not basins.index.is_unique:
+            duplicated = basins[basins.index.duplicated(keep=False)]
+            raise ValueError('duplicate basin ids (shp_id): ' +
+                             ', '.join(f'{basin_id}: {path}' for basin_id, path in duplicated['path'].items()))
+        basins = basins.join(basins.geometry.bounds)
+        basins['area_km2'] = [geodesic_area_perimeter(geom)[0] for geom in basins.geometry]
+        return cls(basins)
+
+    @classmethod
+    def from_parquet(cls, path: str):
+        return cls(gpd.read_parquet(path))
+
+    def to_parquet(self, path: str):
+        self.basins.to_parquet(path)
+
+    def __len__(self):
+        return len(self.basins)
+
+    def __iter__(self):
+        return iter(self.basins.index)
+
+    def ids(self) -> list:
+        return list(self.basins.index)
+
+    def subset(self, basin_ids: list):
+        """ 只包含给定流域的目录 """
+        return BasinCatalogue(self.basins.loc[list(basin_ids)])
+
+    def items(self):
+        """ (流域编号, shapely 几何) """
+        return zip(self.basins.index, self.basins.geometry)
+
+    def geometry(self, basin_id: str):
+        return self.basins.geometry.loc[basin_id]
+
+    def path(self, basin_id: str) -> str:
+        return self.basins.loc[basin_id, 'path']
+
+    def bounds(self, basin_id: str) -> tuple:
+        """ (minx, miny, maxx, maxy) """
+        return tuple(self.basins.loc[basin_id, ['minx', 'miny', 'maxx', 'maxy']])
+
+    def area(self, basin_id: str) -> float:
+        """ 流域面积 (km^2) """
+        return self.basins.loc[basin_id, 'area_km2']
+
+    def record(self, basin_id: str) -> dict:
+        """ shapefile 第一条记录的属性字段 """
+        if self._records is None:  # 属性表 (不含几何) 只构建一次
+            self._records = pd.DataFrame(self.basins.drop(columns=['path', 'shp_stamp', 'geometry', 'minx',
+                                                                   'miny', 'maxx', 'maxy', 'area_km2']))
+        return self._records.loc[basin_id].to_dict()
+
+
+def shapefile_stamp(shape_file: str) -> str:
+    """ shapefile 各文件 (.shp/.shx/.dbf/.prj) 的大小和修改时间; 原地覆盖文件时文件夹的 mtime 不变
+    (清单不会重新列出该文件夹), 所以逐个文件 os.stat
+    """
+    stamp = []
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        try:
+            stat = os.stat(os.path.splitext(shape_file)[0] + ext)
+        except FileNotFoundError:
+            continue
+        stamp.append(f'{ext}:{stat.st_size}:{stat.st_mtime_ns}')
+    return ';'.join(stamp)
+
+
+def load_catalogue(shp_dir: str, cache_file=None) -> BasinCatalogue:
+    """ 读取流域目录; cache_file (.parquet) 存在、流域文件相同且每个 shapefile 的 shapefile_stamp 未变时直接读取,
+    否则重新构建并保存
+
+    shp_dir: 流域 shapefile 文件夹
+    cache_file: GeoParquet 缓存文件路径, None 不缓存
+    """
+    if cache_file is not None and os.path.isfile(cache_file):
+        catalogue = BasinCatalogue.from_parquet(cache_file)
+        basins = catalogue.basins
+        # 增删 shapefile 会改变文件夹的 mtime, 清单中的文件列表是最新的; 文件内容的变化由 shapefile_stamp 判断;
+        # 不在目录中的 shapefile 只能是 from_folder 跳过的空 shapefile
+        shape_files = set(paths(shp_dir, suffix='.shp'))
+        if 'shp_stamp' in basins.columns and set(basins['path']) <= shape_files and \
+                all(shapefile_stamp(path) == stamp for path, stamp in zip(basins['path'], basins['shp_stamp'])) and \
+                all(len(gpd.read_file(path)) == 0 for path in shape_files - set(basins['path'])):
+            return catalogue
+    catalogue = BasinCatalogue.from_folder(shp_dir)
+    if cache_file is not None:
+        catalogue.to_parquet(cache_file)
+    return catalogue
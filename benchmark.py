@@ -0,0 +1,406 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import contextlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import Affine, from_origin
+import geopandas as gpd
+from shapely.geometry import Polygon, LineString
+
+'''
+性能基准: 离线生成合成输入, 对各脚本的热点函数在不同规模下计时, 结果保存为 JSON, 用于比较不同版本之间的性能变化。
+
+合成输入 (按规模缓存在 fixtures_dir/<size> 中, 随机种子固定):
+(1) SURF_CLI_CHN_MUL_DAY 格式的站点 TXT (降水, 一个月)
+(2) DEM (int16), IGBP (uint8), GLiM (uint16) GeoTIFF 及 GLiM 映射文件
+(3) 类 MODIS LAI 栅格 (uint8, 填充值 249-255)
+(4) raster_surf.py 输出格式的 0.1 度全国气象栅格
+(5) 随机流域 shapefile (basin_00000.shp, 带 GDBD_ID 字段) 和河网 shapefile
+
+Usage:
+python benchmark.py --sizes small medium --out ./output/benchmark.json
+python benchmark.py --sizes small --compare ./output/benchmark-old.json
+'''
+
+SIZES = {'small': dict(n_stations=200, degree=0.5, n_basins=4, radius=0.2, res=0.01, n_vertices=64, repeat=3),
+         'medium': dict(n_stations=800, degree=0.1, n_basins=8, radius=1.0, res=0.005, n_vertices=256, repeat=3),
+         'large': dict(n_stations=2400, degree=0.05, n_basins=8, radius=3.0, res=0.0025, n_vertices=1024, repeat=1)}
+
+# extent of the interpolated forcing rasters (same as raster_surf.py / raster2catchment.py)
+LAT_START, LAT_END, LON_START, LON_END = 15, 55, 70, 140
+
+GLIM_CLASSES = ['su', 'ss', 'sm', 'py', 'sc', 'ev', 'mt', 'pa', 'pi', 'pb', 'va', 'vi', 'vb', 'ig', 'wb', 'nd']
+
+
+# ---------------------------------------------------------------- fixtures
+
+
+def random_basin(rng, lon, lat, radius, n_vertices):
+    '''
+    :return: star-shaped random polygon around (lon, lat), its vertices at radius * [0.5, 1] degrees from the centre
+    '''
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n_vertices))
+    radii = radius * (0.5 + 0.5 * rng.random(n_vertices))
+    return Polygon(zip(lon + radii * np.cos(angles), lat + radii * np.sin(angles)))
+
+
+def write_raster(path, array, transform, nodata):
+    with rasterio.open(path, 'w', driver='GTiff', height=array.shape[0], width=array.shape[1], count=1,
+                       dtype=array.dtype, crs='EPSG:4326', transform=transform, nodata=nodata) as dst:
+        dst.write(array, 1)
+
+
+def smooth_field(rng, shape, scale):
+    '''
+    :return: smooth random field in [0, 1] (sum of a few random sine waves), e.g. as a synthetic DEM
+    '''
+    rows, cols = np.meshgrid(np.linspace(0, 1, shape[0]), np.linspace(0, 1, shape[1]), indexing='ij')
+    field = np.zeros(shape)
+    for _ in range(6):
+        fy, fx, phase = rng.uniform(0.5, scale, 2).tolist() + [rng.uniform(0, 2 * np.pi)]
+        field += np.sin(2 * np.pi * (fy * rows + fx * cols) + phase)
+    return (field - field.min()) / (field.max() - field.min())
+
+
+def write_station_txt(path, rng, n_stations, year=2010, month=7):
+    '''
+    SURF_CLI_CHN_MUL_DAY-PRE file: 区站号 纬度 经度 观测场拔海高度 年 月 日 20-8时 8-20时 20-20时 + 3 quality codes,
+    coordinates in 1/100 degree, precipitation in 0.1 mm, 32766 for missing values
+    '''
+    lats = rng.uniform(LAT_START + 3, LAT_END - 3, n_stations)
+    lons = rng.uniform(LON_START + 3, LON_END - 3, n_stations)
+    num_days = pd.Period(f'{year}-{month}').days_in_month
+    lines = []
+    for day in range(1, num_days + 1):
+        pre = rng.gamma(0.5, 60, n_stations).astype(int)
+        pre[rng.random(n_stations) < 0.02] = 32766
+        for i in range(n_stations):
+            lines.append(f'{50000 + i} {int(lats[i] * 100)} {int(lons[i] * 100)} {rng.integers(0, 40000)} '
+                         f'{year} {month} {day} {pre[i] // 2} {pre[i] - pre[i] // 2} {pre[i]} 0 0 0')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def make_fixtures(folder, size, seed=0):
+    '''
+    Generate (or reuse) the synthetic inputs of one size
+
+    :param folder: fixtures folder of this size
+    :param size: dict of SIZES
+    :return: dict of fixture paths and metadata
+    '''
+    meta_file = os.path.join(folder, 'fixtures.json')
+    if os.path.isfile(meta_file):
+        with open(meta_file, 'r') as f:
+            fixtures = json.load(f)
+        if fixtures['size'] == size:
+            return fixtures
+    os.makedirs(os.path.join(folder, 'shapefiles'), exist_ok=True)
+    os.makedirs(os.path.join(folder, 'surf', 'PRE'), exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # basins placed on a grid, the rasters cover all of them
+    radius = size['radius']
+    n_side = int(np.ceil(np.sqrt(size['n_basins'])))
+    left, top = 100.0, 35.0
+    span = n_side * 2.5 * radius
+    basin_files, stream_lines = [], []
+    for i in range(size['n_basins']):
+        lon = left + (i % n_side + 0.5) * 2.5 * radius
+        lat = top - (i // n_side + 0.5) * 2.5 * radius
+        polygon = random_basin(rng, lon, lat, radius, size['n_vertices'])
+        basin_file = os.path.join(folder, 'shapefiles', f'basin_{i:05d}.shp')
+        gpd.GeoDataFrame({'GDBD_ID': [10000 + i]}, geometry=[polygon], crs='EPSG:4326').to_file(basin_file)
+        basin_files.append(basin_file)
+        # a trunk stream crossing the basin outline plus a few tributaries
+        stream_lines.append(LineString([(lon, lat), (lon + 1.5 * radius, lat + 0.2 * radius)]))
+        for angle in rng.uniform(0, 2 * np.pi, 3):
+            stream_lines.append(LineString([(lon + 0.3 * radius * np.cos(angle), lat + 0.3 * radius * np.sin(angle)),
+                                            (lon, lat)]))
+    stream_file = os.path.join(folder, 'streams.shp')
+    gpd.GeoDataFrame(geometry=stream_lines, crs='EPSG:4326').to_file(stream_file)
+
+    res = size['res']
+    shape = (int(round(span / res)), int(round(span / res)))
+    rasters = {}
+    dem = (smooth_field(rng, shape, 8) * 4000).astype(np.int16)
+    rasters['dem'] = os.path.join(folder, 'dem.tif')
+    write_raster(rasters['dem'], dem, from_origin(left, top, res, res), -9999)
+
+    igbp = rng.integers(0, 17, shape, dtype=np.uint8)
+    igbp[rng.random(shape) < 0.01] = 255
+    rasters['igbp'] = os.path.join(folder, 'igbp.tif')
+    write_raster(rasters['igbp'], igbp, from_origin(left, top, res, res), 255)
+
+    glim_values = np.arange(1, len(GLIM_CLASSES) * 2 + 1, dtype=np.uint16)
+    glim = glim_values[(smooth_field(rng, shape, 20) * (len(glim_values) - 1)).astype(int)]
+    glim[rng.random(shape) < 0.01] = 65535
+    rasters['glim'] = os.path.join(folder, 'glim.tif')
+    write_raster(rasters['glim'], glim, from_origin(left, top, res, res), 65535)
+    rasters['glim_mapping'] = os.path.join(folder, 'GLiMCateNumberMapping.csv')
+    pd.DataFrame({'Value': glim_values, 'Litho': [GLIM_CLASSES[(v - 1) // 2] + ('__' if v % 2 else 'pr') for v in
+                                                  glim_values]}).to_csv(rasters['glim_mapping'], index=False)
+    rasters['glim_names'] = os.path.join(folder, 'glim_short_long_name.txt')
+    pd.DataFrame({'short': GLIM_CLASSES, 'long': [f'class {c}' for c in GLIM_CLASSES]}) \
+        .to_csv(rasters['glim_names'], index=False)
+
+    # MODIS LAI like: 0-100 valid values, 249-255 fill values, at the 500 m MODIS resolution
+    modis_res = 0.0045
+    modis_shape = (int(round(span / modis_res)), int(round(span / modis_res)))
+    lai = (smooth_field(rng, modis_shape, 10) * 70).astype(np.uint8)
+    fill = rng.random(modis_shape) < 0.05
+    lai[fill] = rng.integers(249, 256, fill.sum(), dtype=np.uint8)
+    rasters['modis'] = os.path.join(folder, 'MCD15A3H-2010.7.4-LAI-merged.tif')
+    write_raster(rasters['modis'], lai, from_origin(left, top, modis_res, modis_res), 255)
+
+    # one day of interpolated forcing on the 0.1 degree grid of raster2catchment.py, first row at LAT_START as written
+    # by raster_surf.geotif_from_array without encoding (uncompressed Float32)
+    grid_shape = (int(round((LAT_END - LAT_START) / 0.1)), int(round((LON_END - LON_START) / 0.1)))
+    rasters['forcing'] = os.path.join(folder, '2010-7-4-平均气温.tif')
+    write_raster(rasters['forcing'], (smooth_field(rng, grid_shape, 5) * 300).astype(np.float32),
+                 Affine(0.1, 0, LON_START, 0, 0.1, LAT_START), None)
+
+    station_txt = os.path.join(folder, 'surf', 'PRE', 'SURF_CLI_CHN_MUL_DAY-PRE-13011-201007.TXT')
+    write_station_txt(station_txt, rng, size['n_stations'])
+
+    days = pd.date_range('2009-01-01', '2019-12-31')
+    doy = days.dayofyear.values
+    tem = 100 + 150 * np.sin(2 * np.pi * (doy - 110) / 365) + rng.normal(0, 20, len(days))
+    pre = rng.gamma(0.4, 8, len(days)) * (1.2 + np.sin(2 * np.pi * (doy - 100) / 365))
+    forcing = pd.DataFrame({'平均气温': tem, '20-20时累计降水量': pre}, index=days)
+    forcing_file = os.path.join(folder, 'forcing.pkl')
+    forcing.to_pickle(forcing_file)
+
+    fixtures = dict(size=size, basins=basin_files, streams=stream_file, station_txt=station_txt,
+                    forcing_table=forcing_file, **rasters)
+    with open(meta_file, 'w') as f:
+        json.dump(fixtures, f, indent=2)
+    return fixtures
+
+
+# ---------------------------------------------------------------- benchmarks
+
+
+def bench_idw_interpolation(fixtures):
+    from raster_surf import idw_interpolation
+    size = fixtures['size']
+    rng = np.random.default_rng(1)
+    lats = rng.uniform(LAT_START, LAT_END, size['n_stations'])
+    lons = rng.uniform(LON_START, LON_END, size['n_stations'])
+    zs = rng.gamma(0.5, 60, size['n_stations'])
+    n_cells = len(np.arange(LAT_START, LAT_END, size['degree'])) * len(np.arange(LON_START, LON_END, size['degree']))
+    return (lambda: idw_interpolation(lats, lons, zs, lat_start=LAT_START, lat_end=LAT_END, lon_start=LON_START,
+                                      lon_end=LON_END, degree=size['degree'], k=12)), n_cells, 'cells'
+
+
+def bench_load_txt_forcing(fixtures):
+    from raster_surf import load_txt_forcing
+    n_rows = sum(1 for _ in open(fixtures['station_txt']))
+    return (lambda: load_txt_forcing(fixtures['station_txt'], '20-20时累计降水量')), n_rows, 'rows'
+
+
+def bench_tif_shp_index_mean(fixtures):
+    from raster2catchment import tif_shp_index_mean, geometry_points
+    points = [list(np.round(geometry_points(gpd.read_file(basin).geometry.iloc[0]), 1)) for basin in fixtures['basins']]
+
+    def run():
+        random.seed(0)
+        for basin_points in points:
+            tif_shp_index_mean(fixtures['forcing'], basin_points, num_sample=100000)
+
+    return run, sum(len(p) for p in points), 'points'
+
+
+def bench_p_seasonality(fixtures):
+    from climate import p_seasonality
+    forcing = pd.read_pickle(fixtures['forcing_table'])
+    return (lambda: p_seasonality(forcing)), 10, 'years'
+
+
+def basin_geometries(fixtures):
+    '''
+    basin geometries read once before timing: the benchmarks using them (igbp_stats, extract_basin_attributes_glim,
+    elev_mean, modis_zonal_stats) exclude the shapefile I/O of the production paths, which pass shapefile paths
+    (or BasinCatalogue geometries, read once per run)
+    '''
+    return [gpd.read_file(basin).geometry.iloc[0] for basin in fixtures['basins']]
+
+
+def bench_igbp_stats(fixtures):
+    from igbp import igbp_stats
+    geometries = basin_geometries(fixtures)
+    return (lambda: [igbp_stats(geometry, fixtures['igbp']) for geometry in geometries]), len(geometries), 'basins'
+
+
+def bench_glim(fixtures):
+    from glim import Glim
+    glimer = Glim(glim_raster_tif=fixtures['glim'], glim_cate_number_mapping_file=fixtures['glim_mapping'],
+                  short2long_name_txt=fixtures['glim_names'], nan_value=65535)
+    geometries = basin_geometries(fixtures)
+    return (lambda: [glimer.extract_basin_attributes_glim(geometry) for geometry in geometries]), len(geometries), \
+        'basins'
+
+
+def bench_elev_mean(fixtures):
+    from topo_elev import elev_mean
+    geometries = basin_geometries(fixtures)
+    return (lambda: [elev_mean(geometry, fixtures['dem']) for geometry in geometries]), len(geometries), 'basins'
+
+
+def bench_basin_topo_stats(fixtures):
+    from topo_shape import basin_topo_stats, load_basin, load_stream_network
+
+    def run():
+        # the shapefile readers are cached per process, start every repeat from a cold cache
+        load_basin.cache_clear()
+        load_stream_network.cache_clear()
+        basin_topo_stats(fixtures['basins'], fixtures['streams'], num_workers=1)
+
+    return run, len(fixtures['basins']), 'basins'
+
+
+def bench_modis_zonal_stats(fixtures):
+    from utils import zonal_stats_singletif
+    geometries = basin_geometries(fixtures)
+    return (lambda: [zonal_stats_singletif(fixtures['modis'], geometry) for geometry in geometries]), \
+        len(geometries), 'basins'
+
+
+def bench_group_modis_files(fixtures):
+    from modis_summary import group_tif_files_by_date_feature
+    # sub-dataset tifs of a MCD15A3H archive (4-day steps, 6 tiles, 6 features), no files are needed
+    num_dates = fixtures['size']['n_stations'] // 4
+    tifs = [f'/tmp/MCD15A3H.A{2002 + d // 92}{1 + 4 * (d % 92):03d}.h{25 + t}v06.006.2015149102803_{f}.tif84.tif'
+            for d in range(num_dates) for t in range(6) for f in range(1, 7)]
+    return (lambda: group_tif_files_by_date_feature(tifs)), len(tifs), 'files'
+
+
+BENCHMARKS = {'idw_interpolation': bench_idw_interpolation,
+              'load_txt_forcing': bench_load_txt_forcing,
+              'tif_shp_index_mean': bench_tif_shp_index_mean,
+              'p_seasonality': bench_p_seasonality,
+              'igbp_stats': bench_igbp_stats,
+              'extract_basin_attributes_glim': bench_glim,
+              'elev_mean': bench_elev_mean,
+              'basin_topo_stats': bench_basin_topo_stats,
+              'modis_zonal_stats': bench_modis_zonal_stats,
+              'group_modis_files': bench_group_modis_files}
+
+
+def time_function(func, repeat):
+    '''
+    :return: wall times (s) of repeat calls, the output (prints, tqdm bars) of func is discarded
+    '''
+    times = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'timestamp': datetime.now().isoformat(timespec='seconds'), 'commit': commit or None,
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'rasterio': rasterio.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+def run(sizes, names, fixtures_dir, repeat=None) -> dict:
+    '''
+    :param sizes: names of SIZES to run
+    :param names: names of BENCHMARKS to run
+    :param fixtures_dir: folder of the synthetic inputs (generated once per size)
+    :param repeat: number of timed calls per benchmark, default: the repeat of the size
+    :return: {'environment': {...}, 'results': [{name, size, items, unit, times_s, best_s, median_s, items_per_s}]}
+    '''
+    results = []
+    for size_name in sizes:
+        size = SIZES[size_name]
+        fixtures = make_fixtures(os.path.join(fixtures_dir, size_name), size)
+        for name in names:
+            try:
+                func, items, unit = BENCHMARKS[name](fixtures)
+                times = time_function(func, repeat or size['repeat'])
+            except Exception as e:
+                print(f'{name} [{size_name}] failed: {e!r}', file=sys.stderr)
+                results.append({'name': name, 'size': size_name, 'error': repr(e)})
+                continue
+            result = {'name': name, 'size': size_name, 'items': items, 'unit': unit, 'times_s': times,
+                      'best_s': min(times), 'median_s': float(np.median(times)),
+                      'items_per_s': items / min(times) if min(times) > 0 else None}
+            print(f'{name:32s} {size_name:8s} best {result["best_s"]:10.4f} s  '
+                  f'{result["items_per_s"] or 0:14.1f} {unit}/s')
+            results.append(result)
+    return {'environment': environment(), 'results': results}
+
+
+def compare(new: dict, old: dict, threshold=1.2) -> list:
+    '''
+    Compare the best times of two benchmark outputs
+
+    :param threshold: a benchmark is reported as a regression if new best time > threshold * old best time
+    :return: list of (name, size, ratio) of the regressions; ratio is None for a benchmark that ran in the old output
+             but now fails, or that is missing from the new output although its size was run (e.g. removed)
+    '''
+    old_results = {(r['name'], r['size']): r for r in old['results'] if 'best_s' in r}
+    new_results = {(r['name'], r['size']): r for r in new['results']}
+    new_names = set(r['name'] for r in new['results'])
+    new_sizes = set(r['size'] for r in new['results'])
+    regressions = []
+    for r in new['results']:
+        if (r['name'], r['size']) not in old_results:
+            continue
+        if 'best_s' not in r:
+            print(f'{r["name"]:32s} {r["size"]:8s} failed: {r["error"]} REGRESSION')
+            regressions.append((r['name'], r['size'], None))
+            continue
+        ratio = r['best_s'] / old_results[(r['name'], r['size'])]['best_s']
+        flag = 'REGRESSION' if ratio > threshold else ''
+        print(f'{r["name"]:32s} {r["size"]:8s} x{ratio:6.2f} {flag}')
+        if ratio > threshold:
+            regressions.append((r['name'], r['size'], ratio))
+    # benchmarks not selected with --only are not missing, removed ones are
+    for name, size in old_results:
+        if (name, size) not in new_results and size in new_sizes and (name in new_names or name not in BENCHMARKS):
+            print(f'{name:32s} {size:8s} missing REGRESSION')
+            regressions.append((name, size, None))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic inputs')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SIZES))
+    parser.add_argument('--only', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=None, help='timed calls per benchmark')
+    parser.add_argument('--fixtures', default='./output/benchmark_fixtures', help='folder of the synthetic inputs')
+    parser.add_argument('--out', default='./output/benchmark.json', help='json file of the results')
+    parser.add_argument('--compare', default=None, help='json file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    res = run(args.sizes, args.only, args.fixtures, args.repeat)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(res, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            if compare(res, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
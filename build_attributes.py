@@ -0,0 +1,364 @@
+import os
+import json
+import hashlib
+import argparse
+import traceback
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+from basin_catalogue import load_catalogue
+from profiling import configure, trace
+
+'''
+流域属性构建的统一入口。各属性脚本 (glim, igbp, rooting_depth, topo_elev, topo_shape, raster_surf, raster2catchment,
+climate) 作为有依赖关系的阶段 (stage) 运行:
+
+forcing_rasters (raster_surf) -> forcing (raster2catchment) -> climate
+glim, igbp, root_depth, topo_elev, topo_shape
+
+每个阶段的输出按流域编号缓存在 cache_dir 中, 并记录该阶段的键 (输入数据指纹、参数和上游阶段键的哈希) 以及每个流域几何的
+哈希。再次运行时, 键未变的阶段只计算新增或几何有变化的流域, 相互独立的阶段在不同进程中同时运行, 最后合并为一张流域属性表。
+
+Usage:
+python build_attributes.py --config config.json --stages glim igbp topo_elev --workers 4
+
+config.json 中的路径覆盖 DEFAULT_CONFIG 中对应的默认值。
+'''
+
+DEFAULT_CONFIG = dict(shp_dir='./shapefiles',
+                      out_dir='./output',
+                      cache_dir='./output/stage_cache',
+                      # GLiM
+                      glim_raster='./GlimRaster.tif',
+                      glim_mapping='./data/GLiMCateNumberMapping.csv',
+                      glim_names='./data/glim_short_long_name.txt',
+                      # land cover / rooting depth
+                      igbp_tif='./data/IGBP.tif',
+                      root_depth='./data/calculated_root_depth.txt',
+                      # topography
+                      dem_folder='./folder_gdem',
+                      dem_mosaic='./gdem.vrt',
+                      dem_tile_index='./gdem_tiles.csv',
+                      stream_shps='./data/as_streams.shp',
+                      num_workers=None,
+                      # meteorological forcing
+                      surf_data_root='./SURF_CLI_CHN_MUL_DAY/DATA',
+                      forcing_rasters='./forcing-rasters',
+                      forcing_dir='./forcing_time_series',
+                      date_start='1999-01-01',
+                      date_end='1999-12-31',
+                      num_neighbours=12,
+                      lat_start=15,
+                      lat_end=55,
+                      lon_start=70,
+                      lon_end=140,
+                      degree=0.1,
+                      num_sample=100000)
+
+
+def file_fingerprint(path: str, max_content_size=64 * 1024 ** 2) -> str:
+    '''
+    :param path: file or folder
+    :param max_content_size: files up to this size (bytes) are hashed by content, larger ones by size and mtime
+    :return: sha1 hex digest, 'missing' if the path does not exist
+    '''
+    if os.path.isdir(path):
+        h = hashlib.sha1()
+        for dirpath, _, filenames in sorted(os.walk(path)):
+            for f in sorted(filenames):
+                file = os.path.join(dirpath, f)
+                stat = os.stat(file)
+                h.update(f'{os.path.relpath(file, path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        return h.hexdigest()
+    if not os.path.isfile(path):
+        return 'missing'
+    stat = os.stat(path)
+    if stat.st_size > max_content_size:
+        return hashlib.sha1(f'{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def geometry_hash(geometry) -> str:
+    return hashlib.sha1(geometry.wkb).hexdigest()
+
+
+def basin_table(rows: dict) -> pd.DataFrame:
+    '''
+    :param rows: {basin id: {attribute: value}}
+    :return: pd.DataFrame indexed by basin id (shp_id), one row per basin even if it has no attribute
+    '''
+    table = pd.DataFrame.from_dict(rows, orient='index').reindex(list(rows))
+    table.index.name = 'shp_id'
+    return table
+
+
+# ---------------------------------------------------------------- stages
+
+
+def compute_glim(cfg, catalogue):
+    from glim import Glim
+    glimer = Glim(glim_raster_tif=cfg['glim_raster'], glim_cate_number_mapping_file=cfg['glim_mapping'],
+                  short2long_name_txt=cfg['glim_names'], nan_value=65535)
+    return basin_table({basin_id: glimer.extract_basin_attributes_glim_all(shape_file=geometry)
+                        for basin_id, geometry in catalogue.items()})
+
+
+def compute_igbp(cfg, catalogue):
+    from igbp import igbp_stats
+    return basin_table({basin_id: igbp_stats(shapefile=geometry, igbp_tif=cfg['igbp_tif'])
+                        for basin_id, geometry in catalogue.items()})
+
+
+def compute_root_depth(cfg, catalogue):
+    from rooting_depth import DepthMapper, root_depth_50_99_stats
+    depth_mapper = DepthMapper(cfg['root_depth'])
+    return basin_table({basin_id: root_depth_50_99_stats(geometry, cfg['igbp_tif'], depth_mapper)
+                        for basin_id, geometry in catalogue.items()})
+
+
+def compute_topo_elev(cfg, catalogue):
+    from topo_elev import topo_table
+    return topo_table(catalogue, cfg['dem_folder'], cfg['dem_mosaic'], cfg['dem_tile_index'],
+                      cfg['num_workers']).set_index('shp_id')
+
+
+def compute_topo_shape(cfg, catalogue):
+    from topo_shape import shape_factor_table
+    table = shape_factor_table(catalogue, cfg['stream_shps'], cfg['num_workers'])
+    table.index.name = 'shp_id'
+    return table
+
+
+def compute_forcing_rasters(cfg, catalogue):
+    from raster_surf import mutil
+    os.makedirs(cfg['forcing_rasters'], exist_ok=True)
+    mutil(dict(outdir=cfg['forcing_rasters'],
+               num_neighbours=cfg['num_neighbours'],
+               data_root=cfg['surf_data_root'],
+               date_start=datetime.strptime(cfg['date_start'], '%Y-%m-%d'),
+               date_end=datetime.strptime(cfg['date_end'], '%Y-%m-%d'),
+               lat_start=cfg['lat_start'],
+               lat_end=cfg['lat_end'],
+               lon_start=cfg['lon_start'],
+               lon_end=cfg['lon_end'],
+               degree=cfg['degree']))
+    return None
+
+
+def compute_forcing(cfg, catalogue):
+    from raster2catchment import catchment_forcing
+    os.makedirs(cfg['forcing_dir'], exist_ok=True)
+    catchment_forcing(catalogue, cfg['forcing_rasters'], cfg['forcing_dir'], num_sample=cfg['num_sample'])
+    return basin_table({basin_id: {'forcing_file': os.path.join(cfg['forcing_dir'], basin_id, 'forcing.xlsx')}
+                        for basin_id in catalogue})
+
+
+def compute_climate(cfg, catalogue):
+    from climate import climate_indices
+    rows = {}
+    for basin_id in catalogue:
+        rows[basin_id] = climate_indices(os.path.join(cfg['forcing_dir'], basin_id, 'forcing.xlsx'))
+        rows[basin_id]['p_seasonality'] = rows[basin_id]['p_seasonality'][0]  # mean over the years
+    return basin_table(rows)
+
+
+class Stage():
+    def __init__(self, name, compute, inputs=(), params=(), deps=(), per_basin=True, attributes=True):
+        '''
+        :param name: stage name
+        :param compute: function (cfg, catalogue) -> pd.DataFrame indexed by basin id (None if not per_basin)
+        :param inputs: config keys of the input files/folders, their fingerprints are part of the stage key
+        :param params: config keys of the parameters that change the results
+        :param deps: names of the upstream stages
+        :param per_basin: True if the stage is computed basin by basin (only missing/changed basins are computed)
+        :param attributes: True if the output table is part of the merged attribute table
+        '''
+        self.name = name
+        self.compute = compute
+        self.inputs = inputs
+        self.params = params
+        self.deps = deps
+        self.per_basin = per_basin
+        self.attributes = attributes
+
+    def key(self, cfg: dict, dep_keys: dict) -> str:
+        content = {'name': self.name,
+                   'inputs': {k: file_fingerprint(cfg[k]) for k in self.inputs},
+                   'params': {k: cfg[k] for k in self.params},
+                   'deps': {d: dep_keys[d] for d in self.deps}}
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+STAGES = {stage.name: stage for stage in [
+    Stage('glim', compute_glim, inputs=('glim_raster', 'glim_mapping', 'glim_names')),
+    Stage('igbp', compute_igbp, inputs=('igbp_tif',)),
+    Stage('root_depth', compute_root_depth, inputs=('igbp_tif', 'root_depth')),
+    Stage('topo_elev', compute_topo_elev, inputs=('dem_folder',)),
+    Stage('topo_shape', compute_topo_shape, inputs=('stream_shps',)),
+    Stage('forcing_rasters', compute_forcing_rasters, inputs=('surf_data_root',),
+          params=('date_start', 'date_end', 'num_neighbours', 'lat_start', 'lat_end', 'lon_start', 'lon_end', 'degree'),
+          per_basin=False, attributes=False),
+    Stage('forcing', compute_forcing, params=('num_sample',), deps=('forcing_rasters',), attributes=False),
+    Stage('climate', compute_climate, deps=('forcing',)),
+]}
+
+
+def _compute(name, cfg, catalogue):
+    with trace(name, items=len(catalogue)):
+        return STAGES[name].compute(cfg, catalogue)
+
+
+def stage_order(targets: list) -> list:
+    ''' the target stages and all their upstream stages, upstream first '''
+    order = []
+
+    def visit(name):
+        if name in order:
+            return
+        for dep in STAGES[name].deps:
+            visit(dep)
+        order.append(name)
+
+    for name in targets:
+        visit(name)
+    return order
+
+
+class StageCache():
+    '''
+    output table (cache_dir/<stage>.csv) and meta data (cache_dir/<stage>.json: stage key and basin geometry hashes)
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, name):
+        meta_file = os.path.join(self.cache_dir, f'{name}.json')
+        table_file = os.path.join(self.cache_dir, f'{name}.csv')
+        if not os.path.isfile(meta_file):
+            return None, None
+        with open(meta_file, 'r', encoding='utf8') as f:
+            meta = json.load(f)
+        table = pd.read_csv(table_file, index_col='shp_id', dtype={'shp_id': str}) \
+            if os.path.isfile(table_file) else None
+        return meta, table
+
+    def save(self, name, meta, table):
+        if table is not None:
+            table.to_csv(os.path.join(self.cache_dir, f'{name}.csv'), encoding='utf8')
+        with open(os.path.join(self.cache_dir, f'{name}.json'), 'w', encoding='utf8') as f:
+            json.dump(meta, f)
+
+
+def run(cfg: dict, targets: list, num_workers=None, force=False) -> pd.DataFrame:
+    '''
+    run the target stages (and their upstream stages), skipping up-to-date stages and basins
+
+    :param cfg: configuration dict, see DEFAULT_CONFIG
+    :param targets: stage names
+    :param num_workers: number of stages running at the same time, default: all independent stages
+    :param force: recompute everything
+    :return: merged attribute table of the target stages
+    '''
+    catalogue = load_catalogue(cfg['shp_dir'], cache_file=os.path.join(cfg['cache_dir'], 'basins.parquet'))
+    hashes = {basin_id: geometry_hash(geometry) for basin_id, geometry in catalogue.items()}
+    cache = StageCache(cfg['cache_dir'])
+    order = stage_order(targets)
+    keys, tables, completed, failed = {}, {}, set(), set()
+    pending = list(order)
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=num_workers or len(order)) as executor:
+        while pending or running:
+            for name in list(pending):
+                stage = STAGES[name]
+                if any(dep in failed for dep in stage.deps):
+                    print(f'[{name}] skipped, upstream stage failed')
+                    failed.add(name)
+                    pending.remove(name)
+                    continue
+                if not all(dep in completed for dep in stage.deps):
+                    continue
+                pending.remove(name)
+                keys[name] = stage.key(cfg, keys)
+                meta, table = (None, None) if force else cache.load(name)
+                if meta is None or meta['key'] != keys[name]:
+                    meta, table = {'key': keys[name], 'basins': {}}, None
+                if stage.per_basin:
+                    if table is not None:
+                        table = table[table.index.isin(catalogue.ids())]
+                    todo = [b for b in catalogue if meta['basins'].get(b) != hashes[b]]
+                    tables[name] = table
+                    if len(todo) == 0:
+                        print(f'[{name}] up to date')
+                        completed.add(name)
+                        continue
+                    print(f'[{name}] computing {len(todo)} of {len(catalogue)} basins')
+                    running[executor.submit(_compute, name, cfg, catalogue.subset(todo))] = (name, meta, todo)
+                elif meta['basins'] == {'*': 'done'}:
+                    print(f'[{name}] up to date')
+                    completed.add(name)
+                else:
+                    print(f'[{name}] computing')
+                    running[executor.submit(_compute, name, cfg, catalogue)] = (name, meta, None)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, meta, todo = running.pop(future)
+                try:
+                    res = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    print(f'[{name}] failed')
+                    failed.add(name)
+                    keys.pop(name)
+                    continue
+                completed.add(name)
+                if todo is None:
+                    meta['basins'] = {'*': 'done'}
+                    cache.save(name, meta, None)
+                    continue
+                res.index = res.index.astype(str)
+                table = tables[name]
+                table = res if table is None else pd.concat([table.drop(index=todo, errors='ignore'), res])
+                table.index.name = 'shp_id'
+                meta['basins'].update({b: hashes[b] for b in todo})
+                cache.save(name, meta, table)
+                tables[name] = table
+
+    merged = [tables[name] for name in order if STAGES[name].attributes and tables.get(name) is not None]
+    merged = pd.concat(merged, axis=1).sort_index() if merged else pd.DataFrame()
+    merged.to_excel(os.path.join(cfg['out_dir'], 'attributes.xlsx'))
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build catchment attributes')
+    parser.add_argument('--config', help='json file overriding the default configuration', default=None)
+    parser.add_argument('--stages', nargs='+', default=[name for name in STAGES if STAGES[name].attributes],
+                        choices=list(STAGES), help='stages to build, upstream stages are added automatically')
+    parser.add_argument('--workers', type=int, default=None, help='number of stages running at the same time')
+    parser.add_argument('--force', action='store_true', help='ignore the cache and recompute everything')
+    parser.add_argument('--trace', default=None, help='csv file recording time, cpu, memory and io per stage/basin')
+    parser.add_argument('--profile', default=None, choices=['cprofile', 'pyinstrument'],
+                        help='profile every stage (written to output/profiles)')
+    args = parser.parse_args()
+
+    cfg = dict(DEFAULT_CONFIG)
+    if args.config is not None:
+        with open(args.config, 'r', encoding='utf8') as f:
+            cfg.update(json.load(f))
+    os.makedirs(cfg['out_dir'], exist_ok=True)
+    configure(trace_file=args.trace, profiler=args.profile, profile_dir=os.path.join(cfg['out_dir'], 'profiles'))
+    run(cfg, args.stages, num_workers=args.workers, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,9 @@ from itertools import groupby
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-from utils import absolute_file_paths
+from utils import absolute_file_paths, file_hash, update_basin_table
+from profiling import trace
+import os
 import datetime
 
 
@@ -70,7 +72,6 @@ def p_seasonality(data):
 
         p_season = delta_p * np.sign(delta_t) * np.sin(2 * np.pi * (sp - st) / 365)
         p_seasons.append(p_season)
-        print(p_season)
     return np.mean(p_seasons), p_seasons
 
 
@@ -148,6 +149,29 @@ def frac_snow_daily(df):
     return len(df.loc[df['平均气温'] < 0].loc[df['20-20时累计降水量'] > 0]) / len(df)
 
 
+def climate_indices(forcing_file: str) -> dict:
+    '''
+    climate indices of a catchment over 2000-2019
+
+    Parameters
+    ----------
+    forcing_file forcing.xlsx of the catchment generated by raster2catchment.py
+
+    Returns
+    -------
+    dict
+    '''
+    df = pd.read_excel(forcing_file).rename(columns={'Unnamed: 0': 'date'}).set_index('date')
+    df = df.loc[datetime.datetime(2000, 1, 1):datetime.datetime(2019, 12, 31)]
+    pre = df[['20-20时累计降水量']]
+
+    return {'p_mean': p_mean(pre), 'high_prec_freq': high_prec_freq(pre),
+            'high_prec_dur': high_prec_dur(pre), 'high_prec_timing': high_prec_timing(pre),
+            'low_prec_freq': low_prec_freq(pre), 'low_prec_dur': low_prec_dur(pre),
+            'low_prec_timing': low_prec_timing(pre), 'frac_snow_daily': frac_snow_daily(df),
+            'p_seasonality': p_seasonality(df)}
+
+
 if __name__ == '__main__':
 
     forcing_dir = './forcing_time_series'
@@ -155,17 +179,15 @@ if __name__ == '__main__':
 
     files = [x for x in absolute_file_paths(forcing_dir) if 'forcing.xlsx' in x][:10]
 
-    res = {}
-    for file in tqdm(files):
-        name = file.split('\\')[-2]
-        df = pd.read_excel(file).rename(columns={'Unnamed: 0': 'date'}).set_index('date')
-        df = df.loc[datetime.datetime(2000, 1, 1):datetime.datetime(2019, 12, 31)]
-        pre = df[['20-20时累计降水量']]
-        tem = df[['平均气温']]
-
-        res[name] = {'p_mean': p_mean(pre), 'high_prec_freq': high_prec_freq(pre),
-                     'high_prec_dur': high_prec_dur(pre), 'high_prec_timing': high_prec_timing(pre),
-                     'low_prec_freq': low_prec_freq(pre), 'low_prec_dur': low_prec_dur(pre),
-                     'low_prec_timing': low_prec_timing(pre), 'frac_snow_daily': frac_snow_daily(df),
-                     'p_seasonality': p_seasonality(df)}
-    pd.DataFrame(res).T.to_excel(f'{output_dir}/climate.xlsx')
+    files = {os.path.basename(os.path.dirname(file)): file for file in files}
+
+    def compute(names):
+        res = {}
+        for name in tqdm(names):
+            with trace('climate', basin=name, items=1):
+                res[name] = climate_indices(files[name])
+        return pd.DataFrame(res).T
+
+    # 只计算结果表中没有的流域和驱动数据 (forcing.xlsx) 有变化的流域
+    update_basin_table(f'{output_dir}/climate.xlsx', {name: file_hash(file) for name, file in files.items()},
+                       compute, hash_column='forcing_hash')
@@ -3,8 +3,11 @@ import pandas as pd
 from tqdm import tqdm
 import re
 import os
-import fiona
 import rasterio
+import rasterio.mask
+from utils import basin_shapes, catalogue_hashes, update_basin_table
+from basin_catalogue import load_catalogue
+from profiling import trace, phase
 
 '''
 
@@ -30,27 +33,6 @@ The directory should be structured as follows:
 '''
 
 
-def absolute_file_paths(directory):
-    """
-
-    Parameters
-    ----------
-    directory: 文件夹路径
-
-    Returns
-    -------
-    list:
-        文件夹及其子文件夹内所有文件的路径
-    """
-
-    def nest(nest_directory):
-        for path, _, filenames in os.walk(nest_directory):
-            for f in filenames:
-                yield os.path.abspath(os.path.join(path, f))
-
-    return list(nest(directory))
-
-
 def shp_id(shpfile: str):
     '''
 
@@ -65,13 +47,12 @@ def extract_raster(raster: str, shape_file: str, output_file=None, nodata=-9999)
 
     Parameters
     ----------
-    shape_file: EPSG:4326 .shp 文件路径
+    shape_file: EPSG:4326 .shp 文件路径或流域几何 (见 utils.basin_shapes)
     output_file: 输出 .tif 文件路径
     raster: EPSG:4326 .tif 文件路径
     nodata: 指定 nodata 的值
     """
-    with fiona.open(shape_file, "r") as shapefile:
-        shapes = [feature["geometry"] for feature in shapefile]
+    shapes = basin_shapes(shape_file)
     with rasterio.open(raster) as src:
         out_image, out_transform = rasterio.mask.mask(src, shapes, nodata=nodata, crop=True)
         out_meta = src.meta
@@ -105,8 +86,17 @@ class Glim():
         self.glim_mapping_dataframe['xx'] = [s[:2] for s in self.glim_mapping_dataframe['Litho']]
         self.nan_value = nan_value
 
+        # dense lookup: raster value -> index into self.geol_classes (-1 for values not in the mapping file)
+        values = self.glim_mapping_dataframe['Value'].values.astype(np.int64)
+        self.geol_classes = np.unique(self.glim_mapping_dataframe['xx'].values)
+        self.value2class_index = np.full(values.max() + 1, -1, dtype=np.int64)
+        self.value2class_index[values] = np.searchsorted(self.geol_classes, self.glim_mapping_dataframe['xx'].values)
+
     def glim_number2geol_mapping(self, value: int):
-        return self.glim_mapping_dataframe[self.glim_mapping_dataframe['Value'] == value]['Litho'].values[0][:2]
+        class_index = self.value2class_index[value] if 0 <= value < len(self.value2class_index) else -1
+        if class_index < 0:
+            raise KeyError(f'GLiM value {value} is not in the mapping file')
+        return self.geol_classes[class_index]
 
     def glim_geol2number_mapping(self, geol: str):
         return self.glim_mapping_dataframe[self.glim_mapping_dataframe['xx'] == geol]['Value'].values
@@ -114,17 +104,28 @@ class Glim():
     def short2long_name(self, short_name: str):
         return self.short2long_dataframe[self.short2long_dataframe['short'] == short_name]['long'].values[0]
 
-    def extract_basin_attributes_glim_all(self, shape_file: str) -> dict:
+    def geol_class_counts(self, values: np.ndarray):
+        """ count the pixels of each lithology class
+
+        values: GLiM raster values (e.g. the output of extract_raster)
+        return: (geol_class, count), only classes with at least one pixel, sorted by class name
         """
-        shape_file: shapefile 文件路径
+        values = np.asarray(values).flatten()
+        values = values[(values >= 0) & (values < 1000) & (values != self.nan_value)]
+        values = values[values < len(self.value2class_index)].astype(np.int64)
+        class_index = self.value2class_index[values]
+        class_index = class_index[class_index >= 0]
+        count = np.bincount(class_index, minlength=len(self.geol_classes))
+        found = count > 0
+        return self.geol_classes[found], count[found]
+
+    def extract_basin_attributes_glim_all(self, shape_file) -> dict:
         """
-        res = extract_raster(raster=self.glim_raster_tif, shape_file=shape_file, output_file=None)
-        res = res[res < 1000].flatten()
-        res_list = res[res != self.nan_value].flatten().tolist()
-
-        res_str = [self.glim_number2geol_mapping(number) for number in res_list]
-
-        geol_class, count = np.unique(res_str, return_counts=True)
+        shape_file: shapefile 文件路径或流域几何
+        """
+        with phase('io'):
+            res = extract_raster(raster=self.glim_raster_tif, shape_file=shape_file, output_file=None)
+        geol_class, count = self.geol_class_counts(res)
 
         res = {}
         for name, c in zip(geol_class, count):
@@ -132,17 +133,13 @@ class Glim():
 
         return res
 
-    def extract_basin_attributes_glim(self, shape_file: str) -> dict:
+    def extract_basin_attributes_glim(self, shape_file) -> dict:
         """
-        shape_file: shapefile 文件路径
+        shape_file: shapefile 文件路径或流域几何
         """
-        res = extract_raster(raster=self.glim_raster_tif, shape_file=shape_file, output_file=None)
-        res = res[res < 1000].flatten()
-        res_list = res[res != self.nan_value].flatten().tolist()
-
-        res_str = [self.glim_number2geol_mapping(number) for number in res_list]
-
-        geol_class, count = np.unique(res_str, return_counts=True)
+        with phase('io'):
+            res = extract_raster(raster=self.glim_raster_tif, shape_file=shape_file, output_file=None)
+        geol_class, count = self.geol_class_counts(res)
 
         geol_class_rank = [x for _, x in sorted(zip(count, geol_class), reverse=True)]
         if len(geol_class_rank) == 0:
@@ -185,7 +182,14 @@ if __name__ == '__main__':
     glimer = Glim(glim_raster_tif=glim_raster_tif, glim_cate_number_mapping_file=glim_cate_number_mapping_file,
                   short2long_name_txt=short2long_name_txt, nan_value=nan_value)
 
-    res = {}
-    for shape_file in tqdm([file for file in absolute_file_paths('./shapefiles') if file.endswith('.shp')]):
-        res[shp_id(shape_file)] = glimer.extract_basin_attributes_glim_all(shape_file=shape_file)
-    pd.DataFrame(res).T.to_excel('./glim_result.xlsx')
+    catalogue = load_catalogue('./shapefiles')
+
+    def compute(basin_ids):
+        res = {}
+        for basin_id in tqdm(basin_ids):
+            with trace('glim', basin=basin_id, items=1):
+                res[basin_id] = glimer.extract_basin_attributes_glim_all(shape_file=catalogue.geometry(basin_id))
+        return pd.DataFrame(res).T
+
+    # 只计算结果表中没有的流域和 shapefile 有变化的流域
+    update_basin_table('./glim_result.xlsx', catalogue_hashes(catalogue), compute)
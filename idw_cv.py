@@ -0,0 +1,182 @@
+import os
+import multiprocessing
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import scipy.spatial
+from tqdm import tqdm
+from raster_surf import qualified_files, load_txt_forcing
+from station2basin import VARIABLES
+from manifest import Manifest
+from profiling import trace, phase
+
+'''
+反距离权重插值 (raster_surf.idw_interpolation) 参数 (邻居个数 k, 距离的幂 p) 的留一交叉验证:
+每个有观测的站点用其余站点中最近的 k 个有观测的站点插值, 与实际观测比较, 统计 RMSE 和 MAE。
+
+只在站点上计算, 不插值整个网格: 所有站点坐标只建一次 KD 树, 一次查询每个站点最近的若干个候选邻居 (去掉自身),
+之后对每个 (k, p) 组合, 所有日期和站点的留一估计都是对 (日期 × 站点 × 候选邻居) 数组的向量化运算;
+当日没有观测的候选邻居被跳过, 依次取后面的候选。
+
+Usage:
+python idw_cv.py  # 修改 __main__ 中的 cfg, 结果保存为 cfg['out_file']
+'''
+
+SEASONS = {12: 'DJF', 1: 'DJF', 2: 'DJF', 3: 'MAM', 4: 'MAM', 5: 'MAM',
+           6: 'JJA', 7: 'JJA', 8: 'JJA', 9: 'SON', 10: 'SON', 11: 'SON'}
+
+
+def station_matrix(variable: str, cfg: dict):
+    '''
+    读取日期范围内某个变量的所有站点观测
+
+    :param variable: 变量名称, 比如 '20-20时累计降水量'
+    :param cfg: configuration dict (见 raster_surf.py), 包含 data_root, date_start, date_end
+    :return: (日期列表, 站点坐标 (站点 × [纬度, 经度]), 观测值 (日期 × 站点, 无观测为 NaN))
+    '''
+    date_range = pd.date_range(cfg['date_start'], cfg['date_end'])
+    days = {}
+    for file in qualified_files(date_range, variable, cfg):
+        with phase('io'):
+            station_data = load_txt_forcing(file, variable)
+        for key, data in station_data.items():
+            date = datetime.strptime(key, '%Y-%m-%d')
+            if date_range[0] <= date <= date_range[-1]:
+                days[date] = data
+    dates = sorted(days)
+    coords = np.concatenate([np.stack([days[date]['lats'], days[date]['lons']], axis=1) for date in dates])
+    coords, inverse = np.unique(coords, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    values = np.full((len(dates), len(coords)), np.nan)
+    start = 0
+    for d, date in enumerate(dates):
+        zs = days[date]['zs']
+        values[d, inverse[start:start + len(zs)]] = zs
+        start += len(zs)
+    return dates, coords, values
+
+
+def loo_errors(coords: np.ndarray, values: np.ndarray, ks: list, ps: list, num_candidates=None, chunk_days=31):
+    '''
+    留一交叉验证误差
+
+    :param coords: 站点坐标 (站点 × [纬度, 经度]), 不重复
+    :param values: 观测值 (日期 × 站点), 无观测为 NaN
+    :param ks: 邻居个数列表
+    :param ps: 距离的幂列表
+    :param num_candidates: 每个站点的候选邻居个数 (不含自身), 默认 2 * max(ks); 当日有观测的候选邻居少于 k 时
+                           不计算该站点 (计入 skipped)
+    :param chunk_days: 每次向量化计算的天数, 控制内存
+    :return: dict, 每个值为 (len(ks), len(ps), 日期) 的数组: sse (误差平方和), sae (绝对误差和), n (站点个数),
+             以及 (len(ks), 日期) 的 skipped
+    '''
+    num_candidates = min(num_candidates or 2 * max(ks), len(coords) - 1)
+    tree = scipy.spatial.cKDTree(coords, leafsize=100)
+    dist, index = tree.query(coords, k=num_candidates + 1)
+    dist, index = dist[:, 1:], index[:, 1:]  # 坐标不重复, 最近的是站点自身
+    # 相对最近候选的距离, 避免 p 较大时权重溢出
+    ratio = dist[:, :1] / dist
+
+    num_days = values.shape[0]
+    res = {'sse': np.zeros((len(ks), len(ps), num_days)), 'sae': np.zeros((len(ks), len(ps), num_days)),
+           'n': np.zeros((len(ks), len(ps), num_days), dtype=np.int64),
+           'skipped': np.zeros((len(ks), num_days), dtype=np.int64)}
+    powers = {p: ratio ** p for p in ps}
+    for s in range(0, num_days, chunk_days):
+        z = values[s:s + chunk_days]
+        neighbours = z[:, index]  # 日期 × 站点 × 候选邻居
+        valid = ~np.isnan(neighbours)
+        neighbours = np.where(valid, neighbours, 0)
+        rank = np.cumsum(valid, axis=2)
+        observed = ~np.isnan(z)
+        for a, k in enumerate(ks):
+            use = valid & (rank <= k)
+            target = observed & (rank[:, :, -1] >= k)
+            res['skipped'][a, s:s + chunk_days] = np.sum(observed & ~target, axis=1)
+            for b, p in enumerate(ps):
+                weights = np.where(use, powers[p], 0)
+                with np.errstate(invalid='ignore', divide='ignore'):  # 不计算的站点没有邻居
+                    estimate = np.sum(weights * neighbours, axis=2) / np.sum(weights, axis=2)
+                error = np.where(target, estimate - np.where(observed, z, 0), 0)
+                res['sse'][a, b, s:s + chunk_days] = np.sum(error ** 2, axis=1)
+                res['sae'][a, b, s:s + chunk_days] = np.sum(np.abs(error), axis=1)
+                res['n'][a, b, s:s + chunk_days] = np.sum(target, axis=1)
+    return res
+
+
+def variable_cv(variable: str, cfg: dict, ks: list, ps: list, by='season') -> pd.DataFrame:
+    '''
+    :param variable: 变量名称
+    :param cfg: configuration dict, 包含 data_root, date_start, date_end, 可选 num_candidates
+    :param ks: 邻居个数列表
+    :param ps: 距离的幂列表
+    :param by: None 整个日期范围; 'season' 按季节 (DJF/MAM/JJA/SON); 'month' 按月份
+    :return: pd.DataFrame, 列为 variable, group, k, p, n, skipped, rmse, mae
+    '''
+    with trace('idw_cv', basin=variable) as span:
+        dates, coords, values = station_matrix(variable, cfg)
+        span.items = len(dates)
+        with phase('compute'):
+            errors = loo_errors(coords, values, ks, ps, cfg.get('num_candidates'))
+    if by == 'season':
+        groups = np.array([SEASONS[date.month] for date in dates])
+    elif by == 'month':
+        groups = np.array([date.month for date in dates])
+    else:
+        groups = np.array(['all'] * len(dates))
+    rows = []
+    for group in pd.unique(groups):
+        days = groups == group
+        for a, k in enumerate(ks):
+            for b, p in enumerate(ps):
+                n = errors['n'][a, b, days].sum()
+                rows.append({'variable': variable, 'group': group, 'k': k, 'p': p, 'n': n,
+                             'skipped': errors['skipped'][a, days].sum(),
+                             'rmse': np.sqrt(errors['sse'][a, b, days].sum() / n) if n > 0 else np.nan,
+                             'mae': errors['sae'][a, b, days].sum() / n if n > 0 else np.nan})
+    return pd.DataFrame(rows)
+
+
+def _variable_task(args):
+    return variable_cv(*args)
+
+
+def idw_cross_validation(cfg: dict, variables=VARIABLES, ks=(4, 8, 12, 16), ps=(1, 2, 3, 4, 6, 12), by='season',
+                         num_workers=None) -> pd.DataFrame:
+    '''
+    对每个变量做 IDW 参数的留一交叉验证
+
+    :param cfg: configuration dict (见 raster_surf.py)
+    :param variables: 要验证的变量
+    :param ks: 邻居个数列表
+    :param ps: 距离的幂列表
+    :param by: 分组方式, 见 variable_cv
+    :param num_workers: 进程数, 每个进程处理一个变量, 默认 min(变量个数, CPU 核数)
+    :return: pd.DataFrame, 列为 variable, group, k, p, n, skipped, rmse, mae
+    '''
+    with Manifest() as manifest:  # 扫描一次, 各进程只查询
+        manifest.refresh(cfg['data_root'])
+    num_workers = num_workers or min(len(variables), multiprocessing.cpu_count())
+    tasks = [(variable, cfg, list(ks), list(ps), by) for variable in variables]
+    with multiprocessing.Pool(num_workers) as pool:
+        tables = list(tqdm(pool.imap_unordered(_variable_task, tasks), total=len(tasks)))
+    return pd.concat(tables, ignore_index=True).sort_values(['variable', 'group', 'k', 'p'])
+
+
+def best_parameters(table: pd.DataFrame, metric='rmse') -> pd.DataFrame:
+    '''
+    :return: 每个变量和分组误差最小的 (k, p)
+    '''
+    return table.loc[table.groupby(['variable', 'group'])[metric].idxmin()].set_index(['variable', 'group'])
+
+
+if __name__ == '__main__':
+    cfg = dict(data_root='./SURF_CLI_CHN_MUL_DAY/DATA',
+               date_start=datetime(1999, 1, 1),
+               date_end=datetime(1999, 12, 31),
+               num_candidates=None,
+               out_file='./output/idw_cv.csv')
+    table = idw_cross_validation(cfg)
+    os.makedirs(os.path.dirname(cfg['out_file']), exist_ok=True)
+    table.to_csv(cfg['out_file'], index=False, encoding='utf-8-sig')
+    print(best_parameters(table))
@@ -2,6 +2,8 @@ import numpy as np
 from tqdm import tqdm
 import pandas as pd
 from utils import *
+from basin_catalogue import load_catalogue
+from profiling import trace, phase
 
 '''
 基于 MODIS MCD12Q1 产品 LC_Type1 计算流域每种土地覆盖类型所占比例
@@ -67,14 +69,15 @@ def modis_land_cover_igbp_name2number(name: str):
     return names.index(name)
 
 
-def igbp_stats(shapefile: str, igbp_tif: str, nan_value=255):
+def igbp_stats(shapefile: str, igbp_tif: str, nan_value=255, max_memory=None):
     ''' 给定 shapefilem, 根据 Modis_IGBP 分类, 计算其 dom_land_cover, dom_land_cover_frac, forest_frac 三个参数
 
     Parameters
     ----------
-    shapefile 要统计的 .shp 文件
+    shapefile 要统计的 .shp 文件或流域几何 (如 BasinCatalogue.geometry)
     igbp_tif 已生成好的 igbp_yr.tif 文件, 生成方法见 Modis_v1.2.ipynb
     nan_value 默认 255
+    max_memory None 一次读入整个流域范围; 否则按栅格分块流式统计, 每块不超过 max_memory 字节 (用于特大流域)
 
     Returns
     -------
@@ -100,22 +103,25 @@ def igbp_stats(shapefile: str, igbp_tif: str, nan_value=255):
              'Barren',
              'Water bodies']
 
-    res = extract_raster_by_shape_file(raster=igbp_tif, shape_file=shapefile, output_file=None)
-    res = res[res != -9999].flatten()
-    res_list = res[res != nan_value].flatten().tolist()
-    res_str = [modis_land_cover_igbp_number2name(number) for number in res_list]
-    land_class, count = np.unique(res_str, return_counts=True)
-    land_class_rank = [x for _, x in sorted(zip(count, land_class), reverse=True) if x != 'nan']
+    if max_memory is None:
+        with phase('io'):
+            res = extract_raster_by_shape_file(raster=igbp_tif, shape_file=shapefile, output_file=None)
+        res = res[res != -9999].flatten()
+        values, count = np.unique(res[res != nan_value], return_counts=True)
+    else:
+        with phase('io'):
+            categories = zonal_stats_blockwise(igbp_tif, shapefile, max_memory=max_memory,
+                                               categorical=True)['categories']
+        categories.pop(nan_value, None)
+        values, count = np.array(list(categories.keys()), dtype=np.int64), np.array(list(categories.values()))
 
     res = {}
     for name in names:
         res[name + '(fraction)'] = 0
-    for num, name in zip(count, land_class):
+    for value, num in zip(values, count):
+        name = modis_land_cover_igbp_number2name(int(value))
         if name != 'nan':
-            res[name + '(fraction)'] = num / np.sum(count)
-
-    print('shapefile:', shapefile)
-    print(res)
+            res[name + '(fraction)'] += num / np.sum(count)
     return res
 
 
@@ -124,7 +130,14 @@ if __name__ == '__main__':
     shp_dir = './shapefiles'
     out = './output/igbp.xlsx'
 
-    res = {}
-    for shape_file in tqdm(file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')):
-        res[shp_id(shape_file)] = igbp_stats(shapefile=shape_file, igbp_tif=igbp_tif)
-    pd.DataFrame(res).T.to_excel(out)
+    catalogue = load_catalogue(shp_dir)
+
+    def compute(basin_ids):
+        res = {}
+        for basin_id in tqdm(basin_ids):
+            with trace('igbp', basin=basin_id, items=1):
+                res[basin_id] = igbp_stats(shapefile=catalogue.geometry(basin_id), igbp_tif=igbp_tif)
+        return pd.DataFrame(res).T
+
+    # 只计算结果表中没有的流域和 shapefile 有变化的流域
+    update_basin_table(out, catalogue_hashes(catalogue), compute)
@@ -0,0 +1,269 @@
+import os
+import re
+import time
+import sqlite3
+import argparse
+import datetime
+from utils import shp_id, MODIS_NAME_PATTERN
+
+'''
+输入数据清单: 用 os.scandir 扫描一次数据目录 (SURF_CLI 站点数据、MODIS HDF、ASTER GDEM、流域 shapefile 等),
+从文件名解析一次元数据, 保存在 SQLite 数据库中; 各脚本按元数据查询文件, 不再每次遍历目录、用字符串切分文件名。
+
+刷新按修改时间: 记录每个文件夹的 mtime, 再次查询时只重新列出 mtime 变化的文件夹 (增删了文件),
+mtime 未变的文件夹直接使用数据库中的记录 (仍会检查其子文件夹)。
+
+数据库默认为 ./output/manifest.sqlite, 可用环境变量 CATCHMENT_MANIFEST 指定, 多个进程可同时读写。
+
+文件类型 (kind) 与解析的元数据:
+station  SURF_CLI_CHN_MUL_DAY-EVP-13240-199601.TXT      variable (EVP), date (该月第一天)
+modis    MCD15A3H.A2018017.h25v06.006.2018023210623.hdf  product, date, tile
+dem      ASTGTM2_N30E100_dem.tif                         n, e (瓦片西南角)
+basin    outwtrshd_0000.shp                              basin_id (shp_id)
+其他     无
+
+Usage:
+from manifest import files
+for row in files('./SURF_CLI_CHN_MUL_DAY/DATA', 'station', variable='EVP', date_start=..., date_end=...):
+    row['path'], row['date']
+
+python manifest.py ./MODIS/MCD15A3H modis   # 扫描并打印各类文件的个数
+'''
+
+MANIFEST_ENV = 'CATCHMENT_MANIFEST'
+DEFAULT_MANIFEST = './output/manifest.sqlite'
+
+FIELDS = ['variable', 'product', 'date', 'tile', 'n', 'e', 'basin_id']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT, kind TEXT, size INTEGER, mtime REAL,
+                                  variable TEXT, product TEXT, date TEXT, tile TEXT, n INTEGER, e INTEGER,
+                                  basin_id TEXT);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_kind ON files (kind, variable, product, date);
+'''
+
+STATION_PATTERN = re.compile(r'^SURF_CLI_CHN_MUL_DAY-([A-Z]+)-\d+-(\d{4})(\d{2})\.TXT$', re.IGNORECASE)
+DEM_PATTERN = re.compile(r'N(\d+)E(\d+).*\.tif$')
+
+
+def parse_station_file(name: str) -> dict:
+    ''' SURF_CLI_CHN_MUL_DAY-EVP-13240-199601.TXT -> {'kind': 'station', 'variable': 'EVP', 'date': '1996-01-01'} '''
+    match = STATION_PATTERN.match(name)
+    if match is None:
+        return {}
+    variable, year, month = match.groups()
+    return {'kind': 'station', 'variable': variable.upper(), 'date': f'{year}-{month}-01'}
+
+
+def parse_modis_hdf(name: str) -> dict:
+    ''' MCD15A3H.A2018017.h25v06.006.2018023210623.hdf -> product, date (YYYY-MM-DD), tile '''
+    match = MODIS_NAME_PATTERN.match(name)
+    if match is None or not name.endswith('.hdf'):
+        return {}
+    product, year, day_of_year, tile = match.groups()
+    date = datetime.date(int(year), 1, 1) + datetime.timedelta(int(day_of_year) - 1)
+    return {'kind': 'modis', 'product': product, 'date': date.isoformat(), 'tile': tile}
+
+
+def parse_dem_tile(name: str) -> dict:
+    ''' ASTGTM2_N30E100_dem.tif -> {'kind': 'dem', 'n': 30, 'e': 100} '''
+    match = DEM_PATTERN.search(name)
+    if match is None:
+        return {}
+    return {'kind': 'dem', 'n': int(match.group(1)), 'e': int(match.group(2))}
+
+
+def parse_basin_shapefile(name: str) -> dict:
+    ''' outwtrshd_0000.shp -> {'kind': 'basin', 'basin_id': '0000'} '''
+    if not name.endswith('.shp') or not re.search(r'\d', name):
+        return {}
+    return {'kind': 'basin', 'basin_id': shp_id(name)}
+
+
+PARSERS = {'station': parse_station_file, 'modis': parse_modis_hdf, 'dem': parse_dem_tile,
+           'basin': parse_basin_shapefile}
+
+
+def under(column: str, root: str):
+    ''' SQL 条件: column 为 root 或其下的路径 (不用 LIKE, 路径中的 _ 和 % 不是通配符) '''
+    prefix = root.rstrip(os.sep) + os.sep
+    return f'({column} = ? OR substr({column}, 1, ?) = ?)', [root, len(prefix), prefix]
+
+
+def parse_name(name: str) -> dict:
+    ''' 用所有解析器解析文件名, 都不匹配时 kind 为 'other' '''
+    for parser in PARSERS.values():
+        info = parser(name)
+        if info:
+            return info
+    return {'kind': 'other'}
+
+
+class Manifest():
+    '''
+    SQLite 数据清单, 见模块说明
+    '''
+
+    def __init__(self, db_file=None):
+        '''
+        :param db_file: SQLite 数据库路径, 默认 $CATCHMENT_MANIFEST 或 ./output/manifest.sqlite
+        '''
+        self.db_file = os.path.abspath(db_file or os.environ.get(MANIFEST_ENV, DEFAULT_MANIFEST))
+        os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        self.conn = sqlite3.connect(self.db_file, timeout=600)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _list_dir(self, path: str, mtime: float):
+        ''' 重新列出一个文件夹: 更新其中的文件和子文件夹记录, 返回子文件夹列表 '''
+        subdirs, rows = [], []
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:  # 刚被删除或无法读取的文件夹, 视为空文件夹 (与 os.walk 相同)
+            entries = []
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                info = parse_name(entry.name)
+                rows.append([entry.path, path, entry.name, info['kind'], stat.st_size, stat.st_mtime] +
+                            [info.get(field) for field in FIELDS])
+        self.conn.execute('DELETE FROM files WHERE dir = ?', (path,))
+        self.conn.executemany(f'INSERT OR REPLACE INTO files VALUES ({", ".join("?" * (6 + len(FIELDS)))})', rows)
+        known = [row['path'] for row in self.conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+        for removed in set(known) - set(subdirs):
+            self._forget(removed)
+        self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (path, os.path.dirname(path), mtime))
+        return subdirs
+
+    def _forget(self, path: str):
+        ''' 删除一个已不存在的文件夹及其子文件夹的记录 '''
+        condition, params = under('dir', path)
+        self.conn.execute(f'DELETE FROM files WHERE {condition}', params)
+        condition, params = under('path', path)
+        self.conn.execute(f'DELETE FROM dirs WHERE {condition}', params)
+
+    def refresh(self, root: str) -> int:
+        '''
+        扫描 root, 只重新列出 mtime 变化 (或新增) 的文件夹
+
+        :param root: 数据目录
+        :return: 重新列出的文件夹个数
+        '''
+        root = os.path.abspath(root)
+        condition, params = under('path', root)
+        known = {row['path']: row['mtime'] for row in
+                 self.conn.execute(f'SELECT path, mtime FROM dirs WHERE {condition}', params)}
+        listed = 0
+        stack = [root]
+        with self.conn:
+            while stack:
+                path = stack.pop()
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    self._forget(path)
+                    continue
+                if known.get(path) == mtime:
+                    stack.extend(row['path'] for row in
+                                 self.conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,)))
+                else:
+                    stack.extend(self._list_dir(path, mtime))
+                    listed += 1
+        return listed
+
+    def files(self, root: str, kind=None, refresh=True, date_start=None, date_end=None, suffix=None,
+              **fields) -> list:
+        '''
+        查询 root 下的文件
+
+        :param root: 数据目录
+        :param kind: 文件类型 ('station', 'modis', 'dem', 'basin', 'other'), None 所有文件
+        :param refresh: 查询前按 mtime 刷新
+        :param date_start: date 不早于 date_start (datetime/date/'YYYY-MM-DD')
+        :param date_end: date 不晚于 date_end
+        :param suffix: 文件名后缀, 如 '.tif'
+        :param fields: 其他元数据条件, 如 variable='EVP', product='MCD15A3H', tile=['h25v06', 'h26v05'] (列表为 IN)
+        :return: list of dict (path, name, kind, size, mtime 以及元数据), 按 path 排序
+        '''
+        if refresh:
+            self.refresh(root)
+        root = os.path.abspath(root)
+        condition, params = under('dir', root)
+        conditions = [condition]
+        if kind is not None:
+            conditions.append('kind = ?')
+            params.append(kind)
+        if date_start is not None:
+            conditions.append('date >= ?')
+            params.append(str(date_start)[:10])
+        if date_end is not None:
+            conditions.append('date <= ?')
+            params.append(str(date_end)[:10])
+        if suffix is not None:
+            conditions.append('name LIKE ?')
+            params.append('%' + suffix)
+        for field, value in fields.items():
+            if field not in FIELDS:
+                raise ValueError(f'unknown field: {field}')
+            if isinstance(value, (list, tuple, set)):
+                conditions.append(f'{field} IN ({", ".join("?" * len(value))})')
+                params.extend(value)
+            else:
+                conditions.append(f'{field} = ?')
+                params.append(value)
+        query = f'SELECT * FROM files WHERE {" AND ".join(conditions)} ORDER BY path'
+        return [dict(row) for row in self.conn.execute(query, params)]
+
+
+def files(root: str, kind=None, db_file=None, **kwargs) -> list:
+    '''
+    查询 root 下的文件, 参数见 Manifest.files
+    '''
+    with Manifest(db_file) as manifest:
+        return manifest.files(root, kind, **kwargs)
+
+
+def paths(root: str, kind=None, db_file=None, **kwargs) -> list:
+    '''
+    :return: 文件路径列表, 参数见 Manifest.files
+    '''
+    return [row['path'] for row in files(root, kind, db_file, **kwargs)]
+
+
+def parse_date(date: str) -> datetime.datetime:
+    ''' 清单中的日期 (YYYY-MM-DD) 转换为 datetime.datetime '''
+    return datetime.datetime.strptime(date, '%Y-%m-%d')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scan a data folder into the manifest')
+    parser.add_argument('root')
+    parser.add_argument('kind', nargs='?', default=None)
+    parser.add_argument('--db', default=None, help=f'SQLite file, default ${MANIFEST_ENV} or {DEFAULT_MANIFEST}')
+    args = parser.parse_args()
+    with Manifest(args.db) as manifest:
+        start = time.perf_counter()
+        listed = manifest.refresh(args.root)
+        rows = manifest.files(args.root, args.kind, refresh=False)
+        print(f'{len(rows)} files, {listed} folders listed in {time.perf_counter() - start:.2f} s')
+        counts = {}
+        for row in rows:
+            counts[row['kind']] = counts.get(row['kind'], 0) + 1
+        for kind, count in sorted(counts.items()):
+            print(kind, count)
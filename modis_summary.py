@@ -0,0 +1,448 @@
+import os, datetime, subprocess, shutil, tempfile, multiprocessing
+from utils import *
+from basin_catalogue import load_catalogue
+from manifest import files, parse_date
+from profiling import trace, phase
+
+'''
+MODIS 产品 (LAI: lai.py, NDVI: ndvi.py) 流域均值日序列的共用流程; 产品由 spec 字典描述:
+product (产品编号, 如 'MCD15A3H'), feature_name (如 'LAI'), feature_index (hdf 子数据集序号, 如 '2'),
+valid_min, valid_max (有效值范围)
+
+多年并行: summary_years 把各年的日期分批交给进程池, 每批在自己的临时文件夹中处理 (mode 'native' 不需要),
+每个日期的结果先写入 out_dir/dates/, 全部完成后合并为每个流域的年序列; 没有全局文件夹, 不切换工作目录。
+'''
+
+
+def get_qualified_hdf_files_from_folder(folder: str, modis_product: str, zones: list):
+    '''
+
+    :param folder: modis hdfs folder
+    :param modis_product: modis product id: 'MCD15A3H' for LAI; 'MOD13Q1' for NDVI
+    :param zones: modis tiles
+                  https://lpdaac.usgs.gov/data/get-started-data/collection-overview/missions/modis-overview/
+                  e.g. [h25v06, h25v07]
+    :return: qualified hdfs list
+    '''
+    if zones == 'all':
+        rows = files(folder, 'modis')
+    else:
+        rows = files(folder, 'modis', tile=list(zones))
+    for row in rows:
+        assert row['product'] == modis_product
+    return [row['path'] for row in rows]
+
+
+def get_info_from_modis_hdf(file_path) -> dict:
+    """
+    file_path: 'MCD15A3H.A2018017.h25v06.006.2018023210623.hdf' or absolute path
+
+    > get_info_from_modis_hdf('MCD15A3H.A2018017.h25v06.006.2018023210623.hdf')
+    """
+    return modis_file_info(file_path)
+
+
+def get_info_from_modis_tif(file_path) -> dict:
+    """
+    file_path: "MCD12Q1.A2018001.h25v04.006.2019200013451_08.tif" or absolute path
+
+    > get_info_from_modis_tif(r"MCD12Q1.A2018001.h25v04.006.2019200013451_08.tif")
+    """
+    return modis_file_info(file_path)
+
+
+def group_hdf_files_by_date(hdf_files: list):
+    '''
+
+    :param hdf_files: hdf files
+    :return: group hdf files by date (single pass, see utils.index_modis_files)
+    '''
+    return {date: features[None] for date, features in index_modis_files(hdf_files).items()}
+
+
+def hdf_to_tif(hdf_file: str, output_dir: str):
+    '''
+
+    :param hdf_file: hdf file
+    :param output_dir: convert hdf file to tifs
+    :return: output tif path (gdal_translate -sds writes one tif per sub-dataset: _1.tif, _2.tif ...)
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.join(output_dir, os.path.basename(hdf_file)[:-4] + '.tif')
+    subprocess.run(['gdal_translate', '-sds', '-of', 'GTiff', hdf_file, name], stdout=subprocess.PIPE)
+    return name
+
+
+def gdal_downsample_tif(tif_file: str, percent: int):
+    '''
+
+    :param tif_file: tif file path, replaced by the downsampled tif
+    :param percent: downsample percent
+    :return: None
+    '''
+    tmp_file = tif_file[:-4] + '_tmp.tif'
+    os.rename(tif_file, tmp_file)
+    subprocess.run(['gdal_translate', '-outsize', f'{percent}%', f'{percent}%', '-of', 'GTiff', tmp_file, tif_file],
+                   stdout=subprocess.PIPE)
+    os.remove(tmp_file)
+
+
+def group_tif_files_by_date_feature(files: list):
+    '''
+
+    :param files: tif files
+    :return: group tifs by date and feature (single pass, see utils.index_modis_files)
+    '''
+    index = index_modis_files(files)
+    unique_features = np.unique([feature for features in index.values() for feature in features])
+    res = {date: {feature: features.get(feature, []) for feature in unique_features}
+           for date, features in index.items()}
+    return res, unique_features
+
+
+def get_84_tifs(folder: str):
+    '''
+
+    :param folder: tifs folder
+    :return: return only tifs in wgs84
+    '''
+    files = absolute_file_paths(folder)
+    return [file for file in files if 'tif84' in file]
+
+
+def zonal_stats(tif_file: str, shape_file: str, valid_min, valid_max) -> dict:
+    '''
+
+    :param tif_file: tif file path
+    :param shape_file: shp file path or basin geometry (e.g. BasinCatalogue.geometry)
+    :param valid_min: NDVI: [-2000, 10000]; LAI: [0, 100]
+    :param valid_max: NDVI: [-2000, 10000]; LAI: [0, 100]
+    :return:
+    '''
+    res = extract_raster_by_shape_file(tif_file, shape_file).flatten()
+    res[res > valid_max] = -9999
+    res[res < valid_min] = -9999
+    res = res[res != -9999]
+    res = res[~np.isnan(res)]
+    if len(res) > 0:
+        return {'mean': np.mean(res),
+                'max': np.max(res), 'min': np.min(res)}
+    else:
+        return {'mean': 0, 'max': 0, 'min': 0}
+
+
+def clear_dir(folder: str):
+    '''
+
+    :param folder: folder path
+    :return: None
+    '''
+    shutil.rmtree(folder)
+    print(f'{folder} cleared')
+
+
+class Modis():
+    def __init__(self, hdf_folder, working_folder, tmp_folder, product, zones, downsample_percent=None):
+        '''
+
+        :param hdf_folder: hdfs folder
+        :param working_folder: data processing root dir, no os.chdir (several instances can run in parallel)
+        :param tmp_folder: folder of the converted tifs, relative to working_folder
+        :param product: modis product id
+        :param zones: modis tiles or 'all'
+        :param downsample_percent: downsample the converted tifs (e.g. 50), None keeps the native resolution
+        '''
+        self.hdf_folder = hdf_folder
+        self.working_folder = working_folder
+        self.tmp_folder = os.path.join(working_folder, tmp_folder)
+        self.product = product
+        self.zones = zones
+        self.downsample_percent = downsample_percent
+        self.merged_tif_names = []
+
+    def get_merged_tifs(self, merged_tifs_folder: str, feature_name: str, feature_index: str,
+                        hdf_files=None) -> pd.DataFrame:
+        '''
+
+        :param hdf_files: hdf files to convert, default all hdfs of hdf_folder
+        '''
+        if hdf_files is None:
+            hdf_files = [file for file in absolute_file_paths(self.hdf_folder) if file.endswith('.hdf')]
+        files = [file for file in hdf_files if self.zones == 'all' or modis_file_info(file)['zones'] in self.zones]
+        for file in files:
+            hdf_to_tif(file, self.tmp_folder)
+        if self.downsample_percent is not None:
+            for file in absolute_file_paths(self.tmp_folder):
+                if file.endswith('.tif'):
+                    gdal_downsample_tif(file, self.downsample_percent)
+        tifs = [file for file in absolute_file_paths(self.tmp_folder) if file.endswith('.tif')]
+        for file in tifs:
+            name = file + '84.tif'
+            reproject_tif(file, name)
+        tifs_84 = get_84_tifs(self.tmp_folder)
+        groups, unique_features = group_tif_files_by_date_feature(tifs_84)
+        os.makedirs(merged_tifs_folder, exist_ok=True)
+        merged_tifs = {}
+        for date in groups.keys():
+            merged_tifs[date] = {}
+            merged_tif_name = f'{self.product}-{date.year}.{date.month}.{date.day}-{feature_name}-merged.tif'
+            merged_tif_name = os.path.join(merged_tifs_folder, merged_tif_name)
+            merge_tifs(groups[date][feature_index], merged_tif_name)
+            merged_tifs[date][feature_name] = merged_tif_name
+            self.merged_tif_names.append(merged_tif_name)
+        return pd.DataFrame(merged_tifs).T
+
+    def zonal_stats_by_shapefile(self, shapefile: str, valid_min=0, valid_max=100):
+        res = {}
+        for file in self.merged_tif_names:
+            date = os.path.basename(file).split('-')[1]
+            year = int(date.split('.')[0])
+            month = int(date.split('.')[1])
+            day = int(date.split('.')[2])
+            date = datetime.datetime(year, month, day)
+            feature = os.path.basename(file).split('-')[2]
+            stats = zonal_stats(tif_file=file, shape_file=shapefile, valid_min=valid_min, valid_max=valid_max)['mean']
+            res[date] = {feature: stats}
+        return stats
+
+    def clear_tmp(self):
+        shutil.rmtree(self.tmp_folder)
+
+
+def get_hdf_product(file):
+    '''
+
+    :param file: e.g. ./MCD15A3H.A2002185.h23v03.006.2015149105852.hdf
+    :return: 'MCD15A3H'
+    '''
+    return os.path.basename(file).split('.')[0]
+
+
+def get_hdf_date(file):
+    '''
+
+    :param file: e.g. ./MCD15A3H.A2002185.h23v03.006.2015149105852.hdf
+    :return: datetime.datetime(2002, M, D)
+    '''
+    return modis_file_info(file)['date']
+
+
+def basins_todo(catalogue, hashes: dict, year_dir: str) -> list:
+    '''
+
+    :return: the basins without an output file for the year or whose shapefile changed
+    '''
+    done = load_basin_hashes(os.path.join(year_dir, 'basin_hashes.json'))
+    return [id for id in catalogue
+            if done.get(id) != hashes[id] or not os.path.isfile(os.path.join(year_dir, f'{id}.xlsx'))]
+
+
+def prepare_pixel_index(spec: dict, catalogue, date_files: dict, cache_file: str):
+    '''
+    compute the native-grid pixel indices of all basins on every needed tile once in the main process, so that the
+    workers only load them from cache_file
+
+    :param spec: MODIS product, see the module docstring
+    :param date_files: {date: hdf files}
+    '''
+    tile_files = {}
+    for hdf_files in date_files.values():
+        for file in hdf_files:
+            tile_files.setdefault(modis_file_info(file)['zones'], file)
+    pixel_index = ModisPixelIndex(catalogue, cache_file=cache_file)
+    for tile, file in tqdm(tile_files.items()):
+        with rasterio.open(modis_subdataset(file, spec['feature_index'])) as src:
+            pixel_index.pixels(tile, src.height)
+    pixel_index.save()
+
+
+def date_stats(spec: dict, date, hdf_files: list, catalogue, mode: str, pixel_index=None, scratch_dir=None) -> dict:
+    '''
+
+    :param spec: MODIS product, see the module docstring
+    :param date: datetime.datetime
+    :param hdf_files: hdf files of the date (one per tile)
+    :param catalogue: BasinCatalogue, basins to compute
+    :param mode: 'native' or 'reproject', see summary_years
+    :param pixel_index: ModisPixelIndex of the catalogue, for mode 'native'
+    :param scratch_dir: private working folder of the process, for mode 'reproject'
+    :return: {basin id: mean}
+    '''
+    if mode == 'native':
+        with phase('compute'):
+            stats = modis_zonal_stats_native(hdf_files, feature_index=spec['feature_index'], pixel_index=pixel_index,
+                                             valid_min=spec['valid_min'], valid_max=spec['valid_max'])
+        return {id: basin_stats['mean'] for id, basin_stats in stats.items()}
+
+    date_dir = os.path.join(scratch_dir, f'{date:%Y%m%d}')
+    os.makedirs(date_dir)
+    try:
+        with phase('compute'):
+            modis = Modis(hdf_folder=date_dir, working_folder=scratch_dir, tmp_folder=f'{date:%Y%m%d}',
+                          product=spec['product'], zones='all')
+            modis.get_merged_tifs(merged_tifs_folder=date_dir, feature_name=spec['feature_name'],
+                                  feature_index=spec['feature_index'], hdf_files=hdf_files)
+        with phase('mask'):
+            return {id: modis.zonal_stats_by_shapefile(shapefile=geometry, valid_min=spec['valid_min'],
+                                                       valid_max=spec['valid_max'])
+                    for id, geometry in catalogue.items()}
+    finally:
+        shutil.rmtree(date_dir, ignore_errors=True)
+
+
+_catalogue = None
+_pixel_indexes = {}
+
+
+def _init_worker(catalogue):
+    global _catalogue
+    _catalogue = catalogue
+    _pixel_indexes.clear()
+
+
+def _pixel_index(basin_ids: list, cache_file: str) -> ModisPixelIndex:
+    ''' one ModisPixelIndex per process and set of basins, loaded from the cache prepared by prepare_pixel_index '''
+    key = tuple(basin_ids)
+    if key not in _pixel_indexes:
+        _pixel_indexes[key] = ModisPixelIndex(_catalogue.subset(basin_ids), cache_file=cache_file)
+    return _pixel_indexes[key]
+
+
+def _date_batch_task(args):
+    '''
+    compute a batch of dates and write one csv per date (basin id, mean) into dates_dir
+    '''
+    spec, batch, basin_ids, mode, dates_dir, pixel_cache_file, scratch_root = args
+    catalogue = _catalogue.subset(basin_ids)
+    pixel_index = _pixel_index(basin_ids, pixel_cache_file) if mode == 'native' else None
+    scratch_dir = None
+    if mode == 'reproject':
+        scratch_dir = tempfile.mkdtemp(prefix=f"{spec['feature_name'].lower()}_", dir=scratch_root)
+    try:
+        for date, hdf_files in batch:
+            with trace(f"{spec['feature_name'].lower()}_date", basin=f'{date:%Y-%m-%d}', items=len(basin_ids)):
+                res = date_stats(spec, date, hdf_files, catalogue, mode, pixel_index, scratch_dir)
+                with phase('write'):
+                    write_table_atomic(pd.Series(res, name=spec['feature_name']).rename_axis('shp_id').to_frame(),
+                                       os.path.join(dates_dir, f'{date:%Y-%m-%d}.csv'))
+    finally:
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    return len(batch)
+
+
+def date_done(dates_dir: str, date, basin_ids: list) -> bool:
+    ''' whether the per-date output of a previous (interrupted) run already covers the basins '''
+    file = os.path.join(dates_dir, f'{date:%Y-%m-%d}.csv')
+    return os.path.isfile(file) and set(basin_ids) <= set(read_basin_table(file).index)
+
+
+def merge_year(spec: dict, year, dates: list, basin_ids: list, hashes: dict, out_dir: str, dates_dir: str):
+    '''
+    merge the per-date outputs of a year into one time series file per basin: out_dir/year/basin id.xlsx
+    '''
+    if len(dates) == 0:
+        return
+    year_dir = os.path.join(out_dir, str(year))
+    os.makedirs(year_dir, exist_ok=True)
+    table = pd.DataFrame({date: read_basin_table(os.path.join(dates_dir, f'{date:%Y-%m-%d}.csv'))[spec['feature_name']]
+                          for date in dates})
+    hash_file = os.path.join(year_dir, 'basin_hashes.json')
+    done = load_basin_hashes(hash_file)
+    for id in basin_ids:
+        with phase('write'):
+            write_table_atomic(table.loc[id].to_frame(0), os.path.join(year_dir, f'{id}.xlsx'))
+        done[id] = hashes[id]
+    save_basin_hashes(hash_file, done)
+    for date in dates:
+        os.remove(os.path.join(dates_dir, f'{date:%Y-%m-%d}.csv'))
+
+
+def summary_years(spec: dict, years, data_root, out_dir, shp_dir, mode='native', num_workers=None, batch_days=None,
+                  scratch_root=None):
+    '''
+    compute several years in a pool of processes, each date batch in its own scratch folder (mode 'reproject') or
+    without any (mode 'native'); every date is written to out_dir/dates/ as soon as it is computed, and the dates of
+    each year are merged into per-basin time series at the end (an interrupted run resumes from the written dates)
+
+    :param spec: MODIS product, see the module docstring
+    :param years: years to calculate
+    :param data_root: modis lai/ndvi data root dir, e.g. ./MOD13Q1
+    :param out_dir: output dir, e.g. ./output/ndvi
+    :param shp_dir: catchment shapefiles dir
+    :param mode: 'native': zonal stats on the native MODIS sinusoidal grid with the basin polygons projected
+                 (see utils.modis_zonal_stats_native), no hdf conversion or raster reprojection;
+                 'reproject': convert the hdfs to tifs, reproject them to WGS84 and merge the tiles first
+    :param num_workers: number of processes, default all cores, 1 runs in this process
+    :param batch_days: dates per task, default such that there are about 4 tasks per process
+    :param scratch_root: parent folder of the scratch folders, default the system temp folder
+    :return: xlsx files
+    '''
+    catalogue = load_catalogue(shp_dir)
+    hashes = catalogue_hashes(catalogue)
+    dates_dir = os.path.join(out_dir, 'dates')
+    os.makedirs(dates_dir, exist_ok=True)
+    num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+
+    # only the basins without an output file for the year or whose shapefile changed are computed
+    plan = {}
+    for year in years:
+        todo = basins_todo(catalogue, hashes, os.path.join(out_dir, str(year)))
+        print(year, f'{len(todo)} of {len(catalogue)} basins to compute')
+        if len(todo) > 0:
+            plan[year] = {'basins': todo, 'zones': catalogue_modis_tiles(catalogue.subset(todo))}
+    if len(plan) == 0:
+        return
+    catalogue = catalogue.subset(sorted(set(id for year in plan for id in plan[year]['basins'])))
+
+    # hdf files by date, from the manifest (see manifest.py), only the tiles touched by the basins of the year
+    zones = catalogue_modis_tiles(catalogue)
+    print(f'{len(zones)} MODIS tiles: {", ".join(zones)}')
+    date_files = {}
+    for row in files(data_root, 'modis', date_start=datetime.datetime(min(plan), 1, 1),
+                     date_end=datetime.datetime(max(plan), 12, 31), tile=zones):
+        date = parse_date(row['date'])
+        if date.year in plan and row['tile'] in plan[date.year]['zones']:
+            date_files.setdefault(date, []).append(row['path'])
+    for year in plan:
+        plan[year]['dates'] = sorted(date for date in date_files if date.year == year)
+
+    pixel_cache_file = os.path.join(out_dir, 'modis_pixels.pkl')
+    if mode == 'native':
+        prepare_pixel_index(spec, catalogue, date_files, pixel_cache_file)
+
+    todo_dates = {year: [date for date in plan[year]['dates'] if not date_done(dates_dir, date, plan[year]['basins'])]
+                  for year in plan}
+    num_dates = sum(len(dates) for dates in todo_dates.values())
+    batch_days = batch_days or max(1, -(-num_dates // (4 * num_workers)))
+    tasks = []
+    for year, dates in todo_dates.items():
+        for i in range(0, len(dates), batch_days):
+            batch = [(date, date_files[date]) for date in dates[i:i + batch_days]]
+            tasks.append((spec, batch, plan[year]['basins'], mode, dates_dir, pixel_cache_file, scratch_root))
+
+    if num_workers == 1:
+        _init_worker(catalogue)
+        for task in tqdm(tasks):
+            _date_batch_task(task)
+    else:
+        with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(catalogue,)) as pool:
+            list(tqdm(pool.imap_unordered(_date_batch_task, tasks), total=len(tasks)))
+
+    for year in plan:
+        merge_year(spec, year, plan[year]['dates'], plan[year]['basins'], hashes, out_dir, dates_dir)
+
+
+def summary_year(spec: dict, year, data_root, out_dir, root_dir=None, mode='native', shp_dir='./shapefiles'):
+    '''
+
+    :param spec: MODIS product, see the module docstring
+    :param year: specify the year to calculate
+    :param data_root: modis lai/ndvi data root dir, e.g. ./MOD13Q1
+    :param out_dir: output dir, e.g. ./output/ndvi
+    :param root_dir: parent folder of the scratch folders (mode 'reproject'), default the system temp folder
+    :param mode: see summary_years
+    :param shp_dir: catchment shapefiles dir
+    :return: xlsx files
+    '''
+    summary_years(spec, [year], data_root, out_dir, shp_dir, mode=mode, num_workers=1, scratch_root=root_dir)
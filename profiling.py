@@ -0,0 +1,306 @@
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+import threading
+import contextlib
+from datetime import datetime
+import pandas as pd
+
+'''
+轻量的运行统计: 记录每个阶段 (stage) 和每个流域的墙钟时间、CPU 时间、峰值内存、读写字节数和吞吐量 (items/s),
+以及其中 io (读取)、mask (栅格化/掩膜)、compute (计算)、write (写出) 各环节的耗时, 以 CSV 追踪文件保存,
+用于定位整个流程的时间花在哪里。
+
+设置通过环境变量传递, 进程池中的子进程自动继承:
+CATCHMENT_TRACE_FILE      CSV 追踪文件, 未设置时不记录 (trace/phase 几乎没有开销)
+CATCHMENT_PROFILER        cprofile 或 pyinstrument, 对每个进程最外层的阶段级 trace (未指定流域)
+                          做函数级剖析 (可选)
+CATCHMENT_PROFILE_DIR     剖析结果目录, 默认 ./output/profiles
+CATCHMENT_PROFILE_STAGES  只剖析这些阶段 (逗号分隔), 默认全部
+
+Usage:
+with trace('igbp', basin=basin_id):
+    with phase('io'):
+        data = read(...)
+    with phase('compute'):
+        ...
+
+python profiling.py ./output/trace.csv   # 按阶段和环节汇总追踪文件
+'''
+
+TRACE_FILE_ENV = 'CATCHMENT_TRACE_FILE'
+PROFILER_ENV = 'CATCHMENT_PROFILER'
+PROFILE_DIR_ENV = 'CATCHMENT_PROFILE_DIR'
+PROFILE_STAGES_ENV = 'CATCHMENT_PROFILE_STAGES'
+
+TRACE_FIELDS = ['start', 'pid', 'stage', 'basin', 'phase', 'items', 'wall_s', 'cpu_s', 'children_cpu_s',
+                'peak_rss_mb', 'read_mb', 'write_mb', 'items_per_s', 'status']
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def configure(trace_file=None, profiler=None, profile_dir=None, profile_stages=None):
+    '''
+    Enable tracing (and profiling) for this process and the processes it starts
+
+    :param trace_file: CSV trace file, rows are appended
+    :param profiler: None, 'cprofile' or 'pyinstrument'
+    :param profile_dir: folder of the profiles, default ./output/profiles
+    :param profile_stages: list of stage names to profile, default all
+    '''
+    settings = {TRACE_FILE_ENV: trace_file and os.path.abspath(trace_file), PROFILER_ENV: profiler,
+                PROFILE_DIR_ENV: profile_dir and os.path.abspath(profile_dir),
+                PROFILE_STAGES_ENV: profile_stages and ','.join(profile_stages)}
+    for key, value in settings.items():
+        if value:
+            os.environ[key] = value
+        else:
+            os.environ.pop(key, None)
+    if trace_file:
+        os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+        if not os.path.isfile(trace_file) or os.path.getsize(trace_file) == 0:
+            with open(trace_file, 'w', encoding='utf8') as f:
+                f.write(','.join(TRACE_FIELDS) + '\n')
+
+
+def enabled() -> bool:
+    return bool(os.environ.get(TRACE_FILE_ENV) or os.environ.get(PROFILER_ENV))
+
+
+def io_counters():
+    '''
+    :return: (bytes read, bytes written) by this process so far (read/write calls, including page cache hits),
+             (None, None) if not available
+    '''
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return getattr(counters, 'read_chars', counters.read_bytes), getattr(counters, 'write_chars',
+                                                                               counters.write_bytes)
+    except (ImportError, AttributeError, OSError):
+        return None, None
+
+
+def peak_rss_mb():
+    '''
+    :return: peak resident memory (MB) of this process so far, None if not available
+    '''
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB on Linux
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+    except ImportError:
+        return None
+
+
+def children_cpu_time() -> float:
+    ''' CPU time (s) of the terminated child processes, e.g. the workers of a pool or gdal command line tools '''
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Counters():
+    ''' wall time, CPU time and io counters at one moment '''
+
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.children_cpu = children_cpu_time()
+        self.read, self.write = io_counters()
+
+    def elapsed(self) -> dict:
+        ''' differences between now and these counters '''
+        now = Counters()
+        return {'wall_s': now.wall - self.wall, 'cpu_s': now.cpu - self.cpu,
+                'children_cpu_s': now.children_cpu - self.children_cpu,
+                'read_mb': None if self.read is None else (now.read - self.read) / 1024 ** 2,
+                'write_mb': None if self.write is None else (now.write - self.write) / 1024 ** 2}
+
+
+class Span():
+    ''' a traced stage/basin, accumulating the time spent in its phases '''
+
+    def __init__(self, stage, basin, items):
+        self.stage = stage
+        self.basin = basin
+        self.items = items
+        self.phases = {}
+
+    def add_phase(self, name, stats: dict):
+        if name not in self.phases:
+            self.phases[name] = dict(stats, items=1)
+            return
+        acc = self.phases[name]
+        acc['items'] += 1
+        for key, value in stats.items():
+            if value is not None and acc[key] is not None:
+                acc[key] += value
+
+
+def _span_stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def format_value(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return f'{value:.6g}'
+    return str(value).replace(',', ';')
+
+
+def write_rows(rows: list):
+    '''
+    Append rows to the trace file; one write call so that rows of concurrent processes are not interleaved
+    '''
+    trace_file = os.environ.get(TRACE_FILE_ENV)
+    for row in rows:
+        logger.debug(json.dumps(row, default=str))
+    if not trace_file:
+        return
+    lines = ''
+    if not os.path.isfile(trace_file):
+        lines = ','.join(TRACE_FIELDS) + '\n'
+    for row in rows:
+        values = [format_value(row.get(field)) for field in TRACE_FIELDS]
+        lines += ','.join(values) + '\n'
+    fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, lines.encode('utf8'))
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def _profiled(span: Span):
+    '''
+    Run the outermost stage span (no basin) of the process under cProfile or pyinstrument if CATCHMENT_PROFILER is set
+    '''
+    profiler = os.environ.get(PROFILER_ENV)
+    stages = os.environ.get(PROFILE_STAGES_ENV)
+    if not profiler or len(_span_stack()) > 1 or span.basin is not None or \
+            (stages and span.stage not in stages.split(',')):
+        yield
+        return
+    folder = os.environ.get(PROFILE_DIR_ENV, './output/profiles')
+    os.makedirs(folder, exist_ok=True)
+    name = os.path.join(folder, f'{span.stage}-{os.getpid()}-{time.time_ns()}')
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        prof = Profiler()
+        prof.start()
+        try:
+            yield
+        finally:
+            prof.stop()
+            with open(name + '.html', 'w', encoding='utf8') as f:
+                f.write(prof.output_html())
+    else:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(name + '.prof')
+
+
+@contextlib.contextmanager
+def trace(stage=None, basin=None, items=None):
+    '''
+    Trace a stage or a basin of a stage: one row for the whole span and one row per phase (see phase) in the trace
+    file. stage and basin default to the ones of the enclosing span. Does nothing if tracing is not enabled.
+
+    :param stage: stage name, e.g. 'topo_elev'
+    :param basin: basin id
+    :param items: number of items processed (basins, files, cells ...), can also be set on the yielded span
+    '''
+    if not enabled():
+        yield Span(stage, basin, items)
+        return
+    stack = _span_stack()
+    parent = stack[-1] if stack else None
+    span = Span(stage or (parent and parent.stage), basin or (parent and parent.basin), items)
+    start_time = datetime.now().isoformat(timespec='milliseconds')
+    start = Counters()
+    status = 'ok'
+    stack.append(span)
+    try:
+        with _profiled(span):
+            yield span
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        stack.pop()
+        stats = start.elapsed()
+        base = {'start': start_time, 'pid': os.getpid(), 'stage': span.stage, 'basin': span.basin}
+        rows = [dict(base, phase='', items=span.items, peak_rss_mb=peak_rss_mb(), status=status,
+                     items_per_s=span.items / stats['wall_s'] if span.items and stats['wall_s'] > 0 else None,
+                     **stats)]
+        for name, acc in span.phases.items():
+            rows.append(dict(base, phase=name, status=status, **acc))
+        write_rows(rows)
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    Accumulate the time and io of a phase ('io', 'mask', 'compute', 'write') into the innermost span; phases can be
+    entered many times per span (e.g. once per raster) and are reported as one row with items = number of calls
+    '''
+    stack = _span_stack() if enabled() else None
+    if not stack:
+        yield
+        return
+    span = stack[-1]
+    start = Counters()
+    try:
+        yield
+    finally:
+        span.add_phase(name, start.elapsed())
+
+
+def summarize(trace_file) -> pd.DataFrame:
+    '''
+    :return: total time, io and throughput per stage and phase of a trace file, the slowest first
+    '''
+    trace = pd.read_csv(trace_file, dtype={'basin': str, 'phase': str}, keep_default_na=False, na_values=[''])
+    trace['phase'] = trace['phase'].fillna('')
+    summary = trace.groupby(['stage', 'phase']).agg(spans=('wall_s', 'size'), items=('items', 'sum'),
+                                                   wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+                                                   max_wall_s=('wall_s', 'max'), read_mb=('read_mb', 'sum'),
+                                                   write_mb=('write_mb', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
+    summary['items_per_s'] = summary['items'] / summary['wall_s']
+    return summary.sort_values('wall_s', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a trace file')
+    parser.add_argument('trace_file')
+    args = parser.parse_args()
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summarize(args.trace_file))
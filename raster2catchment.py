@@ -1,4 +1,8 @@
-from PIL import Image
+import re
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import shapefile
@@ -8,6 +12,11 @@ from multiprocessing import Process
 import pandas as pd
 from tqdm import tqdm
 import os
+from basin_catalogue import load_catalogue
+import rasterio
+from utils import catalogue_hashes, load_basin_hashes, save_basin_hashes, write_table_atomic, read_band, \
+    absolute_file_paths
+from profiling import trace, phase
 
 '''
 将插值好的气象栅格数据(使用raster_surf.py)转换为流域的面均值，使用采样法计算。
@@ -65,30 +74,14 @@ def load_json(path):
     return data
 
 
-def absoluteFilePaths(directory):
-    '''
-
-    :param directory: 文件夹路径
-    :return: 文件夹以及子文件夹所有文件路径
-    '''
-    import os
-    def absoluteFilePaths(directory):
-        for dirpath, _, filenames in os.walk(directory):
-            for f in filenames:
-                yield os.path.abspath(os.path.join(dirpath, f))
-
-    return list(absoluteFilePaths(directory))
-
-
 def read_tif(tif_file):
     '''
 
     :param tif_file: .tif 文件路径
-    :return: tif 文件转换成 numpy.array
+    :return: tif 文件转换成 numpy.array, scale/offset 编码的栅格 (raster_surf.FORCING_ENCODING) 解码为实际值, 无数据为 NaN
     '''
-    from PIL import Image
-    im = Image.open(tif_file)
-    return np.array(im)
+    with rasterio.open(tif_file) as src:
+        return read_band(src)
 
 
 def shp_points(shp):
@@ -101,15 +94,156 @@ def shp_points(shp):
     return shapefile.Reader(shp).shape(0).points
 
 
-def tif_shp_index_mean(tif, points, num_sample):
+def geometry_points(geometry):
     '''
 
-    :param tif: tif 文件路径
+    :param geometry: 流域几何 (Multi)Polygon, 如 BasinCatalogue.geometry
+    :return: 所有环 (外环和内环) 的顶点坐标列表, 与 shp_points 相同
+    '''
+    parts = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+    points = []
+    for part in parts:
+        for ring in [part.exterior] + list(part.interiors):
+            points.extend(ring.coords)
+    return points
+
+
+def tif_date_variable(tif):
+    '''
+
+    :param tif: 插值栅格文件路径或名称, 如 ./folder_raster/平均气温/1954-1-1-平均气温.tif
+    :return: (datetime, 变量名称)
+    '''
+    name = re.split(r'[\\/]', tif)[-1].split('.')[0]
+    if '降水量' in name:
+        year, month, day = tuple(name.split('-'))[:3]
+        var = '20-20时累计降水量'
+    else:
+        year, month, day, var = tuple(name.split('-'))
+    return datetime(int(year), int(month), int(day)), var
+
+
+def build_forcing_cube(folder_raster, cube_file, num_threads=4):
+    '''
+    将插值栅格文件夹转换为一个未压缩的 .npy 数据立方体 (栅格个数 × 行 × 列, float32), 之后可以内存映射读取;
+    栅格名称按顺序保存在 cube_file + '.json' 中
+
+    :param folder_raster: 插值好的栅格文件夹 (raster_surf.py 的输出)
+    :param cube_file: 输出 .npy 文件路径
+    :param num_threads: 解码栅格的线程数
+    :return: cube_file
+    '''
+    tifs = sorted(tif for tif in absolute_file_paths(folder_raster) if tif.endswith('.tif'))
+    first = read_tif(tifs[0])
+    cube = np.lib.format.open_memmap(cube_file, mode='w+', dtype=np.float32, shape=(len(tifs),) + first.shape)
+    with ForcingReader(tifs, cache_bytes=0, num_threads=num_threads) as reader:
+        for i, (tif, arr) in enumerate(tqdm(reader.iter_layers(tifs), total=len(tifs))):
+            cube[i] = arr
+    cube.flush()
+    with open(cube_file + '.json', 'w', encoding='utf8') as f:
+        json.dump([os.path.basename(tif) for tif in tifs], f, ensure_ascii=False)
+    return cube_file
+
+
+class ForcingReader():
+    '''
+    插值气象栅格的读取器, 数据源可以是:
+    (1) 栅格文件夹 (raster_surf.py 的输出) 或栅格文件列表, 使用 read_tif 解码;
+    (2) build_forcing_cube 生成的 .npy 数据立方体, 内存映射读取, 不需要解码。
+
+    读过的栅格保存在按字节数限制的 LRU 缓存中; iter_layers 在后台线程中预读后面的栅格, 使读取/解码与计算重叠。
+    '''
+
+    def __init__(self, source, cache_bytes=256 * 1024 ** 2, num_threads=4):
+        '''
+        :param source: 栅格文件夹、栅格文件列表或 .npy 数据立方体
+        :param cache_bytes: LRU 缓存的最大字节数, 0 不缓存
+        :param num_threads: 预读线程数
+        '''
+        self.cube = None
+        if isinstance(source, (list, tuple)):
+            self.layers = {tif: tif for tif in source}
+        elif os.path.isdir(source):
+            self.layers = {tif: tif for tif in absolute_file_paths(source) if tif.endswith('.tif')}
+        else:
+            self.cube = np.load(source, mmap_mode='r')
+            self.layers = {name: i for i, name in enumerate(load_json(source + '.json'))}
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def names(self) -> list:
+        ''' 所有栅格的名称 (文件路径或数据立方体中的文件名) '''
+        return list(self.layers)
+
+    def _load(self, name) -> np.ndarray:
+        if self.cube is None:
+            return read_tif(self.layers[name])
+        return np.array(self.cube[self.layers[name]])  # 复制出内存映射的数据 (在预读线程中完成磁盘读取)
+
+    def _put(self, name, arr):
+        if arr.nbytes > self.cache_bytes:
+            return
+        with self.lock:
+            if name in self.cache:
+                return
+            self.cache[name] = arr
+            self.cached_bytes += arr.nbytes
+            while self.cached_bytes > self.cache_bytes:
+                _, old = self.cache.popitem(last=False)
+                self.cached_bytes -= old.nbytes
+
+    def prefetch(self, names):
+        ''' 在后台线程中读取还不在缓存中的栅格 '''
+        with self.lock:
+            for name in names:
+                if name not in self.cache and name not in self.pending:
+                    self.pending[name] = self.executor.submit(self._load, name)
+
+    def read(self, name) -> np.ndarray:
+        with self.lock:
+            if name in self.cache:
+                self.cache.move_to_end(name)
+                return self.cache[name]
+            future = self.pending.pop(name, None)
+        arr = future.result() if future is not None else self._load(name)
+        self._put(name, arr)
+        return arr
+
+    def iter_layers(self, names=None, prefetch=8):
+        '''
+        :param names: 要读取的栅格, 默认全部
+        :param prefetch: 预读的栅格个数
+        :return: (名称, numpy.array) 的迭代器
+        '''
+        names = self.names() if names is None else list(names)
+        for i, name in enumerate(names):
+            self.prefetch(names[i + 1:i + 1 + prefetch])
+            with phase('io'):
+                arr = self.read(name)
+            yield name, arr
+
+
+def index_mean(arr, points, num_sample):
+    '''
+
+    :param arr: 插值栅格 (numpy.array)
     :param points: x,y 点坐标列表
     :param num_sample: 要采样的点的个数，个数越多，采样密度越大
     :return: 计算流域面均
     '''
-    arr = read_tif(tif)
     if len(points) > num_sample:
         points = random.sample(points, num_sample)
     values = []
@@ -121,63 +255,87 @@ def tif_shp_index_mean(tif, points, num_sample):
     return np.mean(values)
 
 
+def tif_shp_index_mean(tif, points, num_sample):
+    '''
+
+    :param tif: tif 文件路径
+    :param points: x,y 点坐标列表
+    :param num_sample: 要采样的点的个数，个数越多，采样密度越大
+    :return: 计算流域面均
+    '''
+    with phase('io'):
+        arr = read_tif(tif)
+    with phase('compute'):
+        return index_mean(arr, points, num_sample)
+
+
 def one_shp(name, num_sample, tifs, shp_points_d, outdir):
     '''
 
     :param name: 流域名称
     :param num_sample: 计算面均采样个数，默认100000（全部采样）
-    :pram tifs: tif 文件路径列表（folder_raster 文件夹中包含的 tif 文件列表）
+    :pram tifs: tif 文件路径列表（folder_raster 文件夹中包含的 tif 文件列表）、栅格文件夹或数据立方体
     :param shp_points_d: dict: {name: {[x1, y1], [x2, y2}}
     :param outdir: 输出路径
     :return: 统计给定 shapefile 在所有气象插值栅格（tifs）上的面均值
     '''
-    res = {}
-    for tif in tifs:
-        if '降水量' in tif:
-            year, month, day = tuple(tif.split('\\')[-1].split('.')[0].split('-'))[:3]
-            var = '20-20时累计降水量'
-        else:
-            year, month, day, var = tuple(tif.split('\\')[-1].split('.')[0].split('-'))
-        year = int(year)
-        month = int(month)
-        day = int(day)
+    multi_shp([name], num_sample, tifs, shp_points_d, outdir)
 
-        if datetime(year, month, day) not in res:
-            res[datetime(year, month, day)] = {}
-        res[datetime(year, month, day)][var] = tif_shp_index_mean(tif, shp_points_d[name], num_sample=num_sample)
-    if not os.path.isdir(f'{outdir}/{name}'):
-        os.mkdir(f'{outdir}/{name}')
-    pd.DataFrame(res).T.sort_index().to_excel(f'{outdir}/{name}/forcing.xlsx')
-
-
-def multi_shp(names, num_sample, tifs, shp_points_d, outdir):
-    ''' 计算多个 shapefile 的面均值'''
-    for name in tqdm(names):
-        one_shp(name, num_sample=num_sample, tifs=tifs, shp_points_d=shp_points_d, outdir=outdir)
 
+def multi_shp(names, num_sample, source, shp_points_d, outdir, prefetch=8, cache_bytes=0):
+    '''
+    计算多个 shapefile 的面均值: 每个栅格只读取一次, 用于这一批的所有流域; 读取下一批栅格与当前栅格的计算同时进行。
+    结果保存在一个 float32 数组 (流域 × 栅格) 中, 最后再转换为每个流域的表
 
-def main():
-    folder_shp = './folder_shp'
-    folder_raster = './folder_raster'
-    outdir = './output'
+    :param names: 流域名称列表
+    :param num_sample: 计算面均采样个数，默认100000（全部采样）
+    :param source: 栅格文件夹、栅格文件列表或数据立方体 (见 ForcingReader)
+    :param shp_points_d: dict: {name: {[x1, y1], [x2, y2}}
+    :param outdir: 输出路径
+    :param prefetch: 预读的栅格个数
+    :param cache_bytes: 栅格缓存的最大字节数; 每个栅格只读取一次, 默认不缓存
+    '''
+    with trace('forcing', items=0) as span, ForcingReader(source, cache_bytes=cache_bytes) as reader:
+        layers = reader.names()
+        index = pd.MultiIndex.from_tuples([tif_date_variable(tif) for tif in layers])
+        values = np.full((len(names), len(layers)), np.nan, dtype=np.float32)
+        for j, (tif, arr) in enumerate(tqdm(reader.iter_layers(layers, prefetch=prefetch), total=len(layers))):
+            with phase('compute'):
+                for i, name in enumerate(names):
+                    values[i, j] = index_mean(arr, shp_points_d[name], num_sample)
+            span.items += 1
+        for i, name in enumerate(names):
+            if not os.path.isdir(f'{outdir}/{name}'):
+                os.mkdir(f'{outdir}/{name}')
+            with phase('write'):
+                table = pd.Series(values[i], index=index).unstack().sort_index()
+                write_table_atomic(table, f'{outdir}/{name}/forcing.xlsx')
+
+
+def catchment_forcing(catalogue, folder_raster, outdir, num_threads=8, num_sample=100000):
+    '''
 
-    shps = [x for x in absoluteFilePaths(folder_shp) if x.endswith('.shp')]
-    tifs = absoluteFilePaths(folder_raster)
+    :param catalogue: BasinCatalogue, 要计算的流域
+    :param folder_raster: 插值好的栅格文件夹 (raster_surf.py 的输出) 或 build_forcing_cube 生成的数据立方体
+    :param outdir: 输出路径, 每个流域生成 outdir/流域编号/forcing.xlsx
+    :param num_threads: 进程数
+    :param num_sample: 计算面均采样个数，默认100000（全部采样）
+    :return: None
+    '''
     shp_points_d = {}
-    for shp in shps:
-        name = shp.split('_')[-1].split('.')[0]
-        points = list(np.round(shp_points(shp), 1))
+    for name, geometry in catalogue.items():
+        points = list(np.round(geometry_points(geometry), 1))
         shp_points_d[name] = points
     names = list(shp_points_d.keys())
 
     proc = []
 
-    num_threads = 8
-    num_sample = 100000
     for i in range(num_threads):
         s, e = (len(names) // num_threads + 1) * i, (len(names) // num_threads + 1) * (i + 1)
         batch_names = names[s:e]
-        p = Process(target=multi_shp, args=(batch_names, num_sample, tifs, shp_points_d, outdir))
+        if len(batch_names) == 0:
+            continue
+        p = Process(target=multi_shp, args=(batch_names, num_sample, folder_raster, shp_points_d, outdir))
         proc.append(p)
 
     for p in proc:
@@ -187,5 +345,27 @@ def main():
         p.join()
 
 
+def main():
+    folder_shp = './folder_shp'
+    folder_raster = './folder_raster'
+    outdir = './output'
+
+    catalogue = load_catalogue(folder_shp)
+
+    # 只计算没有 forcing.xlsx 的流域和 shapefile 有变化的流域
+    hash_file = f'{outdir}/basin_hashes.json'
+    done = load_basin_hashes(hash_file)
+    hashes = catalogue_hashes(catalogue)
+    todo = [name for name in catalogue
+            if done.get(name) != hashes[name] or not os.path.isfile(f'{outdir}/{name}/forcing.xlsx')]
+    print(f'{len(todo)} of {len(catalogue)} basins to compute')
+    if len(todo) > 0:
+        catchment_forcing(catalogue.subset(todo), folder_raster, outdir, num_threads=8, num_sample=100000)
+    for name in todo:
+        if os.path.isfile(f'{outdir}/{name}/forcing.xlsx'):
+            done[name] = hashes[name]
+    save_basin_hashes(hash_file, done)
+
+
 if __name__ == '__main__':
     main()
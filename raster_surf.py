@@ -10,6 +10,12 @@ import pandas as pd
 import scipy
 import gdal
 import osr
+import rasterio.features
+from rasterio.transform import Affine
+from utils import basin_shapes
+from manifest import Manifest, files
+from basin_catalogue import load_catalogue
+from profiling import trace, phase
 
 '''
 
@@ -49,21 +55,6 @@ def clear_folder(folder):
             print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
-def absoluteFilePaths(directory):
-    '''
-
-    :param directory: 文件夹路径
-    :return: 所有子文件路径（包括子文件夹）
-    '''
-    import os
-    def absoluteFilePaths(directory):
-        for dirpath, _, filenames in os.walk(directory):
-            for f in filenames:
-                yield os.path.abspath(os.path.join(dirpath, f))
-
-    return list(absoluteFilePaths(directory))
-
-
 def datetime2str(date, sep='-'):
     '''
 
@@ -116,8 +107,38 @@ def remove_date_zeros(date):
     return str(year) + '-' + str(month) + '-' + str(day)
 
 
+# 紧凑编码: SURF_CLI_CHN_MUL_DAY 的原始数据以 0.1 单位 (0.1 ℃, 0.1 mm, 0.1 hPa ...) 的整数存储, 插值结果四舍五入到
+# 整数后用 int16 存储不损失原始精度 (气压最大约 11000, 降水量过滤后不超过 10000); 分块 + 水平差分预测 + 压缩
+FORCING_ENCODING = dict(scale=1.0, offset=0.0, nodata=-32768, compress='ZSTD', blocksize=256)
+
+
+def encode_int16(array: np.array, scale: float, offset: float, nodata: int) -> np.array:
+    """
+    按 value = stored * scale + offset 将浮点数组编码为 int16, NaN 编码为 nodata, 超出范围的值截断
+    """
+    info = np.iinfo(np.int16)
+    low = info.min + 1 if nodata == info.min else info.min
+    stored = np.round((array - offset) / scale)
+    nan = np.isnan(stored)
+    stored = np.clip(np.where(nan, 0, stored), low, info.max).astype(np.int16)
+    stored[nan] = nodata
+    return stored
+
+
+def creation_options(encoding: dict) -> list:
+    """
+    GeoTIFF 创建参数: 分块 (COG 布局), 压缩, 水平差分预测; 当前 GDAL 不支持 ZSTD 时改用 DEFLATE
+    """
+    compress = encoding.get('compress', 'DEFLATE').upper()
+    supported = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    if compress not in supported:
+        compress = 'DEFLATE'
+    blocksize = encoding.get('blocksize', 256)
+    return ['TILED=YES', f'BLOCKXSIZE={blocksize}', f'BLOCKYSIZE={blocksize}', f'COMPRESS={compress}', 'PREDICTOR=2']
+
+
 def geotif_from_array(array: np.array, lat_start: float, lat_end: float, lon_start: float, lon_end: float,
-                      degree: float, output_file: str):
+                      degree: float, output_file: str, nodata=None, encoding=None):
     """ 
     将一个 numpy.array 写入一个带有位置信息的 GeoTIFF 文件，默认使用 WGS84 （EPSG：4326） 坐标系
     
@@ -128,8 +149,10 @@ def geotif_from_array(array: np.array, lat_start: float, lat_end: float, lon_sta
     lon_end: 最大经度
     degree: 输出栅格单元大小（单位：度）
     output_file: 输出 GeoTIFF 文件路径
+    nodata: 无数据值 (如 idw_interpolation 使用 mask 时的 np.nan), None 不设置
+    encoding: None 写出未压缩的 Float32; 或如 FORCING_ENCODING 的 dict (scale, offset, nodata, compress, blocksize), 写出带 scale/offset 的分块压缩 int16, 读取时用 utils.read_band 解码
     """
-    mag_grid = np.float64(array)
+    mag_grid = np.asarray(array, dtype=np.float32)
     num_v = mag_grid.shape[0]
     num_h = mag_grid.shape[1]
     lats = np.linspace(lat_start, lat_end, num_v)
@@ -141,20 +164,65 @@ def geotif_from_array(array: np.array, lat_start: float, lat_end: float, lon_sta
     ysize = len(lats)
     xsize = len(lons)
     driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(output_file, xsize, ysize, 1, gdal.GDT_Float32)
+    if encoding is None:
+        ds = driver.Create(output_file, xsize, ysize, 1, gdal.GDT_Float32)
+    else:
+        ds = driver.Create(output_file, xsize, ysize, 1, gdal.GDT_Int16, options=creation_options(encoding))
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(4326)
     ds.SetProjection(srs.ExportToWkt())
     gt = [lon_start, xres, 0, lat_start, 0, yres]
     ds.SetGeoTransform(gt)
     outband = ds.GetRasterBand(1)
-    outband.SetStatistics(np.min(mag_grid), np.max(mag_grid), np.average(mag_grid), np.std(mag_grid))
-    outband.WriteArray(mag_grid)
+    missing = np.isnan(mag_grid)
+    if nodata is not None and not np.isnan(nodata):
+        missing |= mag_grid == nodata
+    valid = mag_grid[~missing]
+    if encoding is None:
+        if nodata is not None:
+            outband.SetNoDataValue(nodata)
+        outband.WriteArray(mag_grid)
+    else:
+        scale, offset = encoding.get('scale', 1.0), encoding.get('offset', 0.0)
+        outband.SetScale(scale)
+        outband.SetOffset(offset)
+        outband.SetNoDataValue(encoding['nodata'])
+        outband.SetMetadataItem('ENCODING', 'scaled_int16')  # scale 为 1 时也能识别为编码的栅格 (见 utils.band_encoding)
+        outband.WriteArray(encode_int16(np.where(missing, np.nan, mag_grid), scale, offset, encoding['nodata']))
+    if len(valid) > 0:
+        outband.SetStatistics(float(np.min(valid)), float(np.max(valid)), float(np.mean(valid, dtype=np.float64)),
+                              float(np.std(valid, dtype=np.float64)))
     ds = None
 
 
+def grid_transform(lat_start: float, lon_start: float, degree: float) -> Affine:
+    """
+    插值网格的 affine transform: 以格点 (xi[i], yi[j]) 为中心的像元, 第 i 行为纬度 xi[i] (第一行为 lat_start)
+    """
+    return Affine(degree, 0, lon_start - degree / 2, 0, degree, lat_start - degree / 2)
+
+
+def active_cell_mask(catalogue, lat_start: float, lat_end: float, lon_start: float, lon_end: float, degree: float,
+                     buffer: float = 0.0) -> np.ndarray:
+    """
+    流域覆盖的格点, 供 idw_interpolation 只插值这些格点
+
+    catalogue: BasinCatalogue
+    buffer: 流域外扩距离（单位：度）
+    return: bool 数组 (纬度 × 经度), 与 idw_interpolation 的输出对应; 与流域 (外扩后) 有接触的像元为 True,
+            因此也包含 raster2catchment 采样的流域边界顶点所在的格点
+    """
+    shape = (len(np.arange(lat_start, lat_end, degree)), len(np.arange(lon_start, lon_end, degree)))
+    shapes = []
+    for _, geometry in catalogue.items():
+        shapes.extend(basin_shapes(geometry.buffer(buffer) if buffer > 0 else geometry))
+    transform = grid_transform(lat_start, lon_start, degree)
+    return rasterio.features.geometry_mask(shapes, out_shape=shape, transform=transform, all_touched=True, invert=True)
+
+
 def idw_interpolation(x: np.array, y: np.array, z: np.array, lat_start: float, lat_end: float, lon_start: float,
-                      lon_end: float, degree: float, k: int = 12, p: int = 12, reshape_order: str = 'F'):
+                      lon_end: float, degree: float, k: int = 12, p: int = 12, reshape_order: str = 'F', mask=None,
+                      nodata=np.nan):
     """
     x: 站点经度
     y: 站点维度
@@ -164,6 +232,8 @@ def idw_interpolation(x: np.array, y: np.array, z: np.array, lat_start: float, l
     lat/lon_start/end: 最大[最小]纬度[经度]
     degree: 输出栅格单元大小（单位：度）
     reshape_order: order of reshaping
+    mask: None 插值所有格点; 否则只插值 mask 为 True 的格点 (见 active_cell_mask), 其余格点为 nodata
+    nodata: mask 以外格点的值
     """
     station_points = np.stack([x, y], axis=1)
     tree = scipy.spatial.cKDTree(station_points, leafsize=100)
@@ -171,6 +241,14 @@ def idw_interpolation(x: np.array, y: np.array, z: np.array, lat_start: float, l
     nx = len(xi)
     yi = np.arange(lon_start, lon_end, degree)
     ny = len(yi)
+    if mask is not None:
+        rows, cols = np.nonzero(mask)
+        dist, index = tree.query(np.stack([xi[rows], yi[cols]], axis=1), k=k)
+        weights = 1 / dist ** p
+        norm_weights = weights / np.sum(weights, axis=1)[:, np.newaxis]
+        res = np.full((nx, ny), nodata, dtype=np.float64)
+        res[rows, cols] = np.sum(z[index] * norm_weights, axis=1)
+        return res
     xi, yi = np.meshgrid(xi, yi)
     all_points = np.stack([xi.flatten(), yi.flatten()], axis=1)
     dist, index = tree.query(all_points, k=k)
@@ -181,13 +259,21 @@ def idw_interpolation(x: np.array, y: np.array, z: np.array, lat_start: float, l
     return res
 
 
+def idw_power(cfg: dict, variable: str) -> float:
+    """
+    IDW 距离的幂: cfg['power'] 为一个数或 {变量名称: 幂} (可用 idw_cv.py 按变量选择), 默认 12
+    """
+    power = cfg.get('power', 12)
+    return power[variable] if isinstance(power, dict) else power
+
+
 def qualified_files(date_range: pd.date_range, variable: str, cfg):
     '''
 
     :param date_range: 日期范围
     :param variable: 变量名称
-    :param cfg: configuration dict
-    :return: 符合条件的文件列表
+    :param cfg: configuration dict, data_root 由 manifest.py 扫描 (按文件夹 mtime 刷新), 不再每次遍历
+    :return: 符合条件的文件列表, 按月份排序
     '''
     var_all = {'大型蒸发量': 'evp', '日最高地表气温': 'gst', '日最低地表气温': 'gst',
                '平均地表气温': 'gst', '20-20时累计降水量': 'pre', '平均本站气压': 'prs', '日最高本站气压': 'prs',
@@ -195,23 +281,12 @@ def qualified_files(date_range: pd.date_range, variable: str, cfg):
                '平均气温': 'tem', '日最高气温': 'tem', '日最低气温': 'tem', '平均风速': 'win', '最大风速': 'win'}
     variable = var_all[variable].upper()
 
-    date_range = set([datetime2str(x, sep='-') for x in date_range])
-    files = absolute_file_paths(cfg['data_root'])
-    var_files = []
-    found = False
-    for file in files:
-        if variable in file:
-            txt_date_range = set(get_date_range_from_txt(file))
-            if not date_range.isdisjoint(txt_date_range):
-                found = True
-                var_files.append(file)
-    if not found:
+    # 站点文件按月存储, 清单中的日期为该月第一天
+    month_start = datetime(date_range[0].year, date_range[0].month, 1)
+    rows = files(cfg['data_root'], 'station', variable=variable, date_start=month_start, date_end=date_range[-1])
+    if len(rows) == 0:
         raise ValueError("Did not find file needed.")
-
-    def custum_key(file):
-        return int(file[-10:-4])
-
-    return sorted(var_files, key=custum_key)
+    return [row['path'] for row in sorted(rows, key=lambda row: (row['date'], row['path']))]
 
 
 def evp_convert(data):
@@ -387,31 +462,46 @@ def variable_tif(date_start, date_end, variable, cfg):
     '''
     date_range = pd.date_range(date_start, date_end)
     var_files = qualified_files(date_range, variable, cfg)
-    for file in tqdm(var_files):
-        station_data = load_txt_forcing(file, variable)
-        for key in station_data.keys():
-            x, y, z = station_data[key].values()
-            x, y, z = x[~np.isnan(z)], y[~np.isnan(z)], z[~np.isnan(z)]  # 只使用有观测站点的数据
-            if len(x) < cfg['num_neighbours']:
-                raise UserWarning(
-                    f'Too few observations, need as least {cfg["num_neighbours"]} stations with observation for interpolation')
-            tmp_res = idw_interpolation(x, y, z, lat_start=cfg['lat_start'], lat_end=cfg['lat_end'],
-                                        lon_start=cfg['lon_start'], lon_end=cfg['lon_end'], degree=cfg['degree'],
-                                        k=cfg['num_neighbours'])
-            if not os.path.isdir(f'{cfg["outdir"]}/{variable}'):
-                os.mkdir(f'{cfg["outdir"]}/{variable}')
-            geotif_from_array(array=tmp_res, lat_start=cfg['lat_start'], lat_end=cfg['lat_end'],
-                              lon_start=cfg['lon_start'], lon_end=cfg['lon_end'], degree=cfg['degree'],
-                              output_file=f'{cfg["outdir"]}/{variable}/{key + "-" + variable}.tif')
+    with trace('forcing_rasters', basin=variable, items=0) as span:
+        for file in tqdm(var_files):
+            with phase('io'):
+                station_data = load_txt_forcing(file, variable)
+            for key in station_data.keys():
+                x, y, z = station_data[key].values()
+                x, y, z = x[~np.isnan(z)], y[~np.isnan(z)], z[~np.isnan(z)]  # 只使用有观测站点的数据
+                if len(x) < cfg['num_neighbours']:
+                    raise UserWarning(
+                        f'Too few observations, need as least {cfg["num_neighbours"]} stations with observation for interpolation')
+                with phase('compute'):
+                    tmp_res = idw_interpolation(x, y, z, lat_start=cfg['lat_start'], lat_end=cfg['lat_end'],
+                                                lon_start=cfg['lon_start'], lon_end=cfg['lon_end'],
+                                                degree=cfg['degree'], k=cfg['num_neighbours'],
+                                                p=idw_power(cfg, variable), mask=cfg.get('active_mask'))
+                if not os.path.isdir(f'{cfg["outdir"]}/{variable}'):
+                    os.mkdir(f'{cfg["outdir"]}/{variable}')
+                with phase('write'):
+                    geotif_from_array(array=tmp_res, lat_start=cfg['lat_start'], lat_end=cfg['lat_end'],
+                                      lon_start=cfg['lon_start'], lon_end=cfg['lon_end'], degree=cfg['degree'],
+                                      output_file=f'{cfg["outdir"]}/{variable}/{key + "-" + variable}.tif',
+                                      nodata=None if cfg.get('active_mask') is None else np.nan,
+                                      encoding=cfg.get('encoding'))
+                span.items += 1
 
 
 def mutil(cfg):
     '''
     多线程处理
     
-    :param cfg: configuration dict
+    :param cfg: configuration dict, 设置 shp_dir 时只插值流域覆盖的格点 (外扩 mask_buffer 度, 见 active_cell_mask)
     :return: None
     '''
+    if cfg.get('shp_dir') is not None:
+        cfg = dict(cfg, active_mask=active_cell_mask(load_catalogue(cfg['shp_dir']), cfg['lat_start'], cfg['lat_end'],
+                                                     cfg['lon_start'], cfg['lon_end'], cfg['degree'],
+                                                     buffer=cfg.get('mask_buffer', 0.0)))
+        print(f'interpolating {cfg["active_mask"].sum()} of {cfg["active_mask"].size} cells')
+    with Manifest() as manifest:  # 扫描一次, 各进程只查询
+        manifest.refresh(cfg['data_root'])
     proc = []
 
     for variable in ['大型蒸发量', '日最高地表气温', '日最低地表气温', '平均地表气温',
@@ -438,5 +528,8 @@ if __name__ == '__main__':
                lat_end=55,
                lon_start=70,
                lon_end=140,
-               degree=0.1)
+               degree=0.1,
+               shp_dir='./shapefiles',  # None: interpolate the whole grid
+               mask_buffer=0.1,
+               encoding=FORCING_ENCODING)  # None: uncompressed Float32 GeoTIFF
     mutil(cfg)
@@ -3,6 +3,8 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from utils import *
+from basin_catalogue import load_catalogue
+from profiling import trace, phase
 
 '''
 基于 MODIS IGBP 分类计算流域有效根深分布 (Zeng 2001)
@@ -79,13 +81,13 @@ class DepthMapper():
         return self.land_root_depth[self.land_root_depth['land'] == name]['99'].values[0]
 
 
-def root_depth_50_99_stats(shape_file: str, igbp_tif: str, depth_mapper: DepthMapper):
+def root_depth_50_99_stats(shape_file, igbp_tif: str, depth_mapper: DepthMapper):
     ''' the arithmetic mean of catchment effective rooting depth for root_fraction_percentiles=50/99
         对给定的 shapefile, 根据 IGBP 分类, 计算每一个 grid 的有效根深 (root_fraction_percentiles=50/99), 统计算数均值
 
     Parameters
     ----------
-    shape_file 要统计的 shapefile
+    shape_file 要统计的 shapefile 或流域几何 (如 BasinCatalogue.geometry)
     igbp_tif converted IGBP classification in raster form
     depth_mapper DepthMapper 对象, 存储了 IGBP 到 effective depth 的映射
 
@@ -94,12 +96,13 @@ def root_depth_50_99_stats(shape_file: str, igbp_tif: str, depth_mapper: DepthMa
     dict
     {'root_depth_50': np.mean(depth50), 'root_depth_99': np.mean(depth99)}
     '''
-    res = extract_raster_by_shape_file(raster=igbp_tif, shape_file=shape_file, output_file=None)
+    with phase('io'):
+        res = extract_raster_by_shape_file(raster=igbp_tif, shape_file=shape_file, output_file=None)
     res = res[res != -9999]
     res_list = res[res != 255].flatten().tolist()
-    print('mapping igbp classification to effective rooting depth for each pixel')
-    depth50 = [depth_mapper.igbp2depth50(index) for index in tqdm(res_list, position=0, leave=True, file=sys.stdout)]
-    depth99 = [depth_mapper.igbp2depth99(index) for index in tqdm(res_list, position=0, leave=True, file=sys.stdout)]
+    with phase('compute'):
+        depth50 = [depth_mapper.igbp2depth50(index) for index in tqdm(res_list, position=0, leave=True, file=sys.stdout)]
+        depth99 = [depth_mapper.igbp2depth99(index) for index in tqdm(res_list, position=0, leave=True, file=sys.stdout)]
     return {'root_depth_50': np.mean(depth50), 'root_depth_99': np.mean(depth99)}
 
 
@@ -110,7 +113,14 @@ if __name__ == '__main__':
     out = './output/root_depth.xlsx'
     depth_mapper = DepthMapper(root_depth)
 
-    res = {}
-    for shape_file in [file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')]:
-        res[shp_id(shape_file)] = root_depth_50_99_stats(shape_file, igbp_tif, depth_mapper)
-    pd.DataFrame(res).T.to_excel(out, header=False, index=False)
+    catalogue = load_catalogue(shp_dir)
+
+    def compute(basin_ids):
+        res = {}
+        for basin_id in tqdm(basin_ids):
+            with trace('root_depth', basin=basin_id, items=1):
+                res[basin_id] = root_depth_50_99_stats(catalogue.geometry(basin_id), igbp_tif, depth_mapper)
+        return pd.DataFrame(res).T
+
+    # 只计算结果表中没有的流域和 shapefile 有变化的流域
+    update_basin_table(out, catalogue_hashes(catalogue), compute)
@@ -0,0 +1,266 @@
+import os
+import hashlib
+import random
+import multiprocessing
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.spatial
+from tqdm import tqdm
+from raster_surf import qualified_files, load_txt_forcing, grid_transform, idw_power
+from manifest import Manifest
+from raster2catchment import geometry_points
+from utils import basin_mask, write_table_atomic
+from basin_catalogue import load_catalogue
+from profiling import trace, phase
+
+'''
+由站点观测直接计算流域面均值, 不生成也不读取插值栅格。
+
+反距离权重插值 (raster_surf.idw_interpolation) 对站点值是线性的, 流域面均值 (raster2catchment) 又是格点值的加权平均,
+因此对给定的一组有观测的站点, 每个流域的面均值是站点值的固定加权和:
+
+流域面均值 = C (流域 × 格点, 流域采样权重) · I (格点 × 站点, IDW 权重) · z (站点值)
+
+W = C · I 按当日有观测的站点 (站点坐标) 计算一次并缓存, 之后每天的流域面均值只是一次稀疏矩阵-向量乘法。
+输出与 raster2catchment.py 相同: outdir/流域编号/forcing.xlsx
+
+Requirement:
+(1) SURF_CLI_CHN_MUL_DAY 数据集 (见 raster_surf.py)
+(2) Catchment shapefiles
+├── folder_shp
+|   ├── outwtrshd_0000.shp
+|   ├── ...
+'''
+
+VARIABLES = ['大型蒸发量', '日最高地表气温', '日最低地表气温', '平均地表气温',
+             '20-20时累计降水量', '平均本站气压', '日最高本站气压',
+             '日最低本站气压', '平均相对湿度', '日照时数',
+             '平均气温', '日最高气温', '日最低气温', '平均风速', '最大风速']
+
+
+class ForcingGrid():
+    '''
+    插值网格, 与 raster_surf.idw_interpolation 相同: 第 i 行第 j 列的格点为 (xi[i], yi[j]), xi 为纬度, yi 为经度;
+    格点按行展开编号 (i * ny + j)
+    '''
+
+    def __init__(self, lat_start: float, lat_end: float, lon_start: float, lon_end: float, degree: float):
+        self.lat_start = lat_start
+        self.lon_start = lon_start
+        self.degree = degree
+        self.xi = np.arange(lat_start, lat_end, degree)
+        self.yi = np.arange(lon_start, lon_end, degree)
+        self.shape = (len(self.xi), len(self.yi))
+        self.transform = grid_transform(lat_start, lon_start, degree)
+
+    @classmethod
+    def from_cfg(cls, cfg: dict):
+        return cls(cfg['lat_start'], cfg['lat_end'], cfg['lon_start'], cfg['lon_end'], cfg['degree'])
+
+    @property
+    def num_cells(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    def cell_index(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        '''
+        :return: 最近格点的编号, 网格外的点为 -1
+        '''
+        i = np.rint((np.asarray(lats) - self.lat_start) / self.degree).astype(np.int64)
+        j = np.rint((np.asarray(lons) - self.lon_start) / self.degree).astype(np.int64)
+        inside = (i >= 0) & (i < self.shape[0]) & (j >= 0) & (j < self.shape[1])
+        return np.where(inside, i * self.shape[1] + j, -1)
+
+    def cell_points(self, cells: np.ndarray) -> np.ndarray:
+        '''
+        :return: 格点的 (纬度, 经度), 与 idw_interpolation 中 KD 树的坐标顺序相同
+        '''
+        i, j = np.divmod(np.asarray(cells), self.shape[1])
+        return np.stack([self.xi[i], self.yi[j]], axis=1)
+
+
+def basin_cell_weights(catalogue, grid: ForcingGrid, method='points', num_sample=100000) -> scipy.sparse.csr_matrix:
+    '''
+    每个流域在格点上的平均权重 (每行和为 1)
+
+    :param catalogue: BasinCatalogue
+    :param grid: ForcingGrid
+    :param method: 'points' 与 raster2catchment.tif_shp_index_mean 相同: 流域边界顶点所在格点的平均 (顶点多于
+                   num_sample 时随机采样); 'area': 格点 (像元中心) 落在流域内的所有格点的平均, 流域内没有格点时
+                   取离流域质心最近的格点
+    :param num_sample: 'points' 的最大采样个数
+    :return: scipy.sparse.csr_matrix, (流域 × 格点)
+    '''
+    rows, cols, values = [], [], []
+    for b, (basin_id, geometry) in enumerate(catalogue.items()):
+        if method == 'points':
+            points = list(np.round(geometry_points(geometry), 1))
+            if len(points) > num_sample:
+                points = random.sample(points, num_sample)
+            points = np.array(points)
+            cells = grid.cell_index(points[:, 1], points[:, 0])
+            cells, counts = np.unique(cells[cells >= 0], return_counts=True)
+        elif method == 'area':
+            cells = np.flatnonzero(basin_mask(geometry, grid.shape, grid.transform))
+            if len(cells) == 0:
+                cells = grid.cell_index([geometry.centroid.y], [geometry.centroid.x])
+            counts = np.ones(len(cells))
+        else:
+            raise ValueError(f'unknown method: {method}')
+        if len(cells) == 0:
+            raise ValueError(f'basin {basin_id} is outside of the interpolation grid')
+        rows.append(np.full(len(cells), b))
+        cols.append(cells)
+        values.append(counts / np.sum(counts))
+    return scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(len(catalogue), grid.num_cells))
+
+
+def idw_weights(lats: np.ndarray, lons: np.ndarray, points: np.ndarray, k=12, p=12) -> scipy.sparse.csr_matrix:
+    '''
+    反距离权重插值的权重矩阵, 与 raster_surf.idw_interpolation 相同; 格点与站点重合时直接取该站点的值
+
+    :param lats: 站点纬度
+    :param lons: 站点经度
+    :param points: 格点 (纬度, 经度), 见 ForcingGrid.cell_points
+    :param k: 邻居个数
+    :param p: 距离的幂
+    :return: scipy.sparse.csr_matrix, (格点 × 站点)
+    '''
+    tree = scipy.spatial.cKDTree(np.stack([lats, lons], axis=1), leafsize=100)
+    dist, index = tree.query(points, k=k)
+    dist, index = dist.reshape(len(points), -1), index.reshape(len(points), -1)
+    with np.errstate(divide='ignore'):
+        weights = 1 / dist ** p
+    exact = dist == 0
+    on_station = exact.any(axis=1)
+    weights[on_station] = exact[on_station]
+    weights /= np.sum(weights, axis=1)[:, np.newaxis]
+    rows = np.repeat(np.arange(len(points)), index.shape[1])
+    return scipy.sparse.csr_matrix((weights.ravel(), (rows, index.ravel())), shape=(len(points), len(lats)))
+
+
+class StationBasinWeights():
+    '''
+    (流域 × 站点) 权重矩阵 W = C · I, 按当日有观测的站点 (坐标及其顺序) 缓存, 最多缓存 max_patterns 组
+    '''
+
+    def __init__(self, cell_weights: scipy.sparse.csr_matrix, grid: ForcingGrid, k=12, p=12, max_patterns=64):
+        '''
+        :param cell_weights: (流域 × 格点), 见 basin_cell_weights
+        '''
+        # 只在流域用到的格点上计算 IDW 权重
+        self.cells = np.flatnonzero(cell_weights.getnnz(axis=0))
+        self.cell_weights = cell_weights[:, self.cells].tocsr()
+        self.points = grid.cell_points(self.cells)
+        self.k = k
+        self.p = p
+        self.max_patterns = max_patterns
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def pattern_key(lats: np.ndarray, lons: np.ndarray) -> str:
+        return hashlib.sha1(np.stack([lats, lons]).astype(np.float64).tobytes()).hexdigest()
+
+    def weights(self, lats: np.ndarray, lons: np.ndarray) -> scipy.sparse.csr_matrix:
+        key = self.pattern_key(lats, lons)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        w = (self.cell_weights @ idw_weights(lats, lons, self.points, self.k, self.p)).tocsr()
+        self.cache[key] = w
+        if len(self.cache) > self.max_patterns:
+            self.cache.popitem(last=False)
+        return w
+
+    def basin_means(self, lats: np.ndarray, lons: np.ndarray, zs: np.ndarray) -> np.ndarray:
+        '''
+        :return: 每个流域的面均值, 顺序与 cell_weights 的行相同
+        '''
+        return self.weights(lats, lons) @ zs
+
+
+def variable_basin_forcing(variable: str, basin_ids: list, weights: StationBasinWeights, cfg: dict) -> pd.DataFrame:
+    '''
+    :param variable: 变量名称, 比如 '20-20时累计降水量'
+    :param basin_ids: 流域编号, 与 weights 的行对应
+    :param weights: StationBasinWeights
+    :param cfg: configuration dict (见 raster_surf.py), 包含 data_root, date_start, date_end, num_neighbours
+    :return: pd.DataFrame, 日期 × 流域
+    '''
+    date_range = pd.date_range(cfg['date_start'], cfg['date_end'])
+    res = {}
+    with trace('forcing_stations', basin=variable, items=0) as span:
+        for file in tqdm(qualified_files(date_range, variable, cfg)):
+            with phase('io'):
+                station_data = load_txt_forcing(file, variable)
+            for key in station_data.keys():
+                date = datetime.strptime(key, '%Y-%m-%d')
+                if not date_range[0] <= date <= date_range[-1]:
+                    continue
+                x, y, z = station_data[key].values()
+                x, y, z = x[~np.isnan(z)], y[~np.isnan(z)], z[~np.isnan(z)]  # 只使用有观测站点的数据
+                if len(x) < cfg['num_neighbours']:
+                    raise UserWarning(
+                        f'Too few observations, need as least {cfg["num_neighbours"]} stations with observation for interpolation')
+                with phase('compute'):
+                    res[date] = weights.basin_means(x, y, z)
+                span.items += 1
+    return pd.DataFrame(res, index=basin_ids).T.sort_index()
+
+
+def _variable_task(args):
+    variable, basin_ids, cell_weights, grid, cfg = args
+    weights = StationBasinWeights(cell_weights, grid, k=cfg['num_neighbours'], p=idw_power(cfg, variable))
+    return variable, variable_basin_forcing(variable, basin_ids, weights, cfg)
+
+
+def station_forcing(catalogue, cfg: dict, variables=VARIABLES, method='points', num_workers=None):
+    '''
+    由站点观测直接生成每个流域的 forcing.xlsx, 与 raster_surf.py + raster2catchment.py 的结果相同 (不经过栅格)
+
+    :param catalogue: BasinCatalogue, 要计算的流域
+    :param cfg: configuration dict (见 raster_surf.py), 另含 outdir (输出路径) 和 num_sample
+    :param variables: 要计算的变量
+    :param method: 流域采样方法, 见 basin_cell_weights
+    :param num_workers: 进程数, 每个进程处理一个变量, 默认 min(变量个数, CPU 核数)
+    :return: None
+    '''
+    grid = ForcingGrid.from_cfg(cfg)
+    basin_ids = list(catalogue)
+    cell_weights = basin_cell_weights(catalogue, grid, method, cfg.get('num_sample', 100000))
+
+    with Manifest() as manifest:  # 扫描一次, 各进程只查询
+        manifest.refresh(cfg['data_root'])
+    num_workers = num_workers or min(len(variables), multiprocessing.cpu_count())
+    tasks = [(variable, basin_ids, cell_weights, grid, cfg) for variable in variables]
+    with multiprocessing.Pool(num_workers) as pool:
+        tables = dict(pool.imap_unordered(_variable_task, tasks))
+
+    for basin_id in tqdm(basin_ids):
+        forcing = pd.DataFrame({variable: tables[variable][basin_id] for variable in variables if variable in tables})
+        if not os.path.isdir(f'{cfg["outdir"]}/{basin_id}'):
+            os.makedirs(f'{cfg["outdir"]}/{basin_id}')
+        write_table_atomic(forcing.sort_index(), f'{cfg["outdir"]}/{basin_id}/forcing.xlsx')
+
+
+if __name__ == '__main__':
+    cfg = dict(outdir='./output',
+               num_neighbours=12,
+               data_root='./SURF_CLI_CHN_MUL_DAY/DATA',
+               date_start=datetime(1999, 1, 1),
+               date_end=datetime(1999, 12, 31),
+               lat_start=15,
+               lat_end=55,
+               lon_start=70,
+               lon_end=140,
+               degree=0.1,
+               num_sample=100000)
+    catalogue = load_catalogue('./folder_shp')
+    station_forcing(catalogue, cfg)
@@ -1,9 +1,13 @@
-import re, shapefile, math
-import richdem as rd
+import re, math, time, hashlib
+import multiprocessing
+import rasterio.windows
 from osgeo import gdal, osr
 import pandas as pd
 from tqdm import tqdm
 from utils import *
+from basin_catalogue import BasinCatalogue, load_catalogue
+from manifest import files
+from profiling import trace, phase
 
 '''
 基于 ASTER GDEM: https://asterweb.jpl.nasa.gov/gdem.asp 统计流域地形特征
@@ -33,14 +37,13 @@ def load_N_E_from_dem_name(dem_file: str):
     return {'N': int(N), 'E': int(E)}
 
 
-def shapefile_N_E(shpfile: str):
-    ''' get min/max lat/lon, this is for determining the range of needed dem files '''
-    sf = shapefile.Reader(shpfile)
-    bbox = sf.bbox
+def shapefile_N_E(shpfile):
+    ''' get min/max lat/lon of a shapefile or geometry, this is for determining the range of needed dem files '''
+    bbox = basin_bounds(shpfile)
     return {'N_min': bbox[1], 'N_max': bbox[3], 'E_min': bbox[0], 'E_max': bbox[2]}
 
 
-def fetch_shapefile_needed_DEM_range(shpfile: str):
+def fetch_shapefile_needed_DEM_range(shpfile):
     ''' get the range of needed dem files for the given shapefile '''
     N_E = shapefile_N_E(shpfile)
     Ns = range(math.floor(N_E['N_min']), math.ceil(N_E['N_max']) + 1)
@@ -48,122 +51,303 @@ def fetch_shapefile_needed_DEM_range(shpfile: str):
     return {'Ns': Ns, 'Es': Es}
 
 
-def elev_mean(shpfile: str, dem_folder: str):
+def build_dem_tile_index(dem_folder: str, index_file=None) -> pd.DataFrame:
+    ''' record the bounds of every tile of the ASTER GDEM folder (1 x 1 degree, named by its south-west corner), the
+    tiles and their N/E come from the manifest (see manifest.py) instead of walking the folder
+
+    :param dem_folder: folder of ASTER GDEM tifs
+    :param index_file: .csv file to save the index, None not saved
+    :return: pd.DataFrame with columns file, N, E, left, bottom, right, top
+    '''
+    index = []
+    for row in files(dem_folder, 'dem', suffix='.tif'):
+        index.append({'file': row['path'], 'N': row['n'], 'E': row['e'],
+                      'left': row['e'], 'bottom': row['n'], 'right': row['e'] + 1, 'top': row['n'] + 1})
+    index = pd.DataFrame(index, columns=['file', 'N', 'E', 'left', 'bottom', 'right', 'top'])
+    if index_file is not None:
+        index.to_csv(index_file, index=False)
+    return index
+
+
+def load_dem_tile_index(dem_folder: str, index_file: str) -> pd.DataFrame:
+    ''' tile index of the folder, the manifest is refreshed by folder mtime so new tiles are picked up; the index is
+    also saved to index_file '''
+    return build_dem_tile_index(dem_folder, index_file)
+
+
+def tile_index_hash(tile_index: pd.DataFrame) -> str:
+    ''' hash of the tile files of the index, identifies the tiles a VRT mosaic was built from '''
+    return hashlib.sha1('\n'.join(sorted(tile_index['file'])).encode('utf8')).hexdigest()
+
+
+def build_dem_mosaic(tile_index: pd.DataFrame, mosaic_file: str):
+    ''' build a global VRT mosaic of all GDEM tiles, basin windows are then read directly from it; the hash of the
+    tile index is saved next to it (mosaic_file + '.tiles') '''
+    vrt = gdal.BuildVRT(mosaic_file, list(tile_index['file']))
+    vrt = None
+    with open(mosaic_file + '.tiles', 'w') as f:
+        f.write(tile_index_hash(tile_index))
+    return mosaic_file
+
+
+def update_dem_mosaic(tile_index: pd.DataFrame, mosaic_file: str):
+    ''' rebuild the VRT mosaic if it is missing or was built from other tiles (e.g. tiles added to the folder) '''
+    built_from = None
+    if os.path.isfile(mosaic_file) and os.path.isfile(mosaic_file + '.tiles'):
+        with open(mosaic_file + '.tiles', 'r') as f:
+            built_from = f.read().strip()
+    if built_from != tile_index_hash(tile_index):
+        build_dem_mosaic(tile_index, mosaic_file)
+    return mosaic_file
+
+
+def needed_dem_tiles(shpfile, tile_index: pd.DataFrame) -> pd.DataFrame:
+    ''' tiles of the index covering the given shapefile '''
+    needed = fetch_shapefile_needed_DEM_range(shpfile)
+    return tile_index[tile_index['N'].isin(needed['Ns']) & tile_index['E'].isin(needed['Es'])]
+
+
+def read_dem_window(shpfile, dem_mosaic: str, pad=1):
+    ''' read the DEM window covering the shapefile (plus pad cells on each side for the slope kernel)
+
+    :return: dem (float32 array, nodata as nan), affine transform of the window
+    '''
+    N_E = shapefile_N_E(shpfile)
+    with rasterio.open(dem_mosaic) as src:
+        window = rasterio.windows.from_bounds(N_E['E_min'], N_E['N_min'], N_E['E_max'], N_E['N_max'],
+                                              transform=src.transform)
+        window = window.round_offsets(op='floor').round_lengths(op='ceil')
+        window = rasterio.windows.Window(window.col_off - pad, window.row_off - pad,
+                                         window.width + 2 * pad, window.height + 2 * pad)
+        nodata = -9999 if src.nodata is None else src.nodata
+        dem = src.read(1, window=window, boundless=True, fill_value=nodata).astype(np.float32)
+        transform = src.window_transform(window)
+    dem[dem == nodata] = np.nan
+    return dem, transform
+
+
+def elev_mean(shpfile, dem_mosaic: str, tile_index=None):
     ''' calculate mean elevation of the catchment '''
-    if os.path.isfile(tmp_merged):
-        os.remove(tmp_merged)
-    if os.path.isfile(tmp_reprojected):
-        os.remove(tmp_reprojected)
-    # get needed N E range
-    needed_Ns = fetch_shapefile_needed_DEM_range(shpfile)['Ns']
-    needed_Es = fetch_shapefile_needed_DEM_range(shpfile)['Es']
-
-    # get needed tifs
-    files = absolute_file_paths(dem_folder)
-    files = [file for file in files if file.endswith('.tif')]
-    needed_tifs = []
-    for file in files:
-        N = load_N_E_from_dem_name(file)['N']
-        E = load_N_E_from_dem_name(file)['E']
-        if (N in needed_Ns) and (E in needed_Es):
-            needed_tifs.append(file)
-
-    # merge tifs
-    if len(needed_tifs) == 0:
+    if tile_index is not None and len(needed_dem_tiles(shpfile, tile_index)) == 0:
         raise FileNotFoundError(f'did not find needed tifs for determining topograpy attributes | shpfile: {shpfile}')
-    merge_tifs(needed_tifs, tmp_merged)
-    reproject_tif(tmp_merged, tmp_reprojected)
-    # zonal stats
-    try:
-        res = zonal_stats_singletif(tmp_reprojected, shpfile)
-    except ValueError as e:
-        print(e)
-        print(needed_Es, needed_Ns, needed_tifs)
+    dem, transform = read_dem_window(shpfile, dem_mosaic, pad=0)
+    res = dem[basin_mask(shpfile, dem.shape, transform)]
+    res = res[~np.isnan(res)]
+    if len(res) == 0:
         return {'mean': np.nan}
-    return res
+    return {'mean': np.mean(res)}
+
+
+def cell_size_metres(transform, height: int, geographic=True):
+    ''' cell size (m) along x and y of every row of a raster
 
+    :param transform: affine transform of the raster
+    :param height: number of rows
+    :param geographic: True if the transform is in degrees (e.g. EPSG:4326), False if it is already in metres
+    :return: dx, dy; arrays of length height
+    '''
+    if not geographic:
+        return np.full(height, abs(transform.a)), np.full(height, abs(transform.e))
+    # WGS84 ellipsoid: prime vertical (N) and meridional (M) radii of curvature at the latitude of each row
+    a, e2 = 6378137.0, 0.00669437999014
+    lat = np.radians(transform.f + (np.arange(height) + 0.5) * transform.e)
+    w = 1 - e2 * np.sin(lat) ** 2
+    N = a / np.sqrt(w)
+    M = a * (1 - e2) / w ** 1.5
+    dx = np.radians(abs(transform.a)) * N * np.cos(lat)
+    dy = np.radians(abs(transform.e)) * M
+    return dx, dy
 
-def calculate_slope(DEM):
-    ''' calculate the slope of a given dem '''
-    dem_path = DEM
-    shasta_dem = rd.LoadGDAL(dem_path, no_data=-128)
-    slope = rd.TerrainAttribute(shasta_dem, attrib='slope_riserun')
-    return np.array(slope.data)
 
+def slope_kernel(dem: np.ndarray, transform, geographic=True, method='horn', block_rows=1024):
+    ''' slope (rise / run, m/m) of a dem with the metric cell size of every row taken from the geotransform
 
-def slope_mean(shpfile: str, dem_folder: str):
+    The dem is processed in blocks of block_rows rows with a one-row halo, so the temporary arrays stay small for
+    large rasters. Cells on the raster edge or next to a nan cell are nan.
+
+    :param dem: elevation (m), nodata as nan
+    :param transform: affine transform of the dem
+    :param geographic: True if the transform is in degrees, False if in metres
+    :param method: 'horn' (Horn 1981, 3 x 3 weighted) or 'zevenbergen' (Zevenbergen & Thorne 1987, 4 neighbours)
+    :param block_rows: number of rows processed at a time
+    '''
+    height, width = dem.shape
+    slope = np.full(dem.shape, np.nan, dtype=np.float32)
+    if height < 3 or width < 3:
+        return slope
+    dx, dy = cell_size_metres(transform, height, geographic)
+    for r0 in range(1, height - 1, block_rows):
+        r1 = min(r0 + block_rows, height - 1)
+        z = dem[r0 - 1:r1 + 1].astype(np.float64)
+        # a b c
+        # d e f
+        # g h i
+        b, d, f, h = z[:-2, 1:-1], z[1:-1, :-2], z[1:-1, 2:], z[2:, 1:-1]
+        if method == 'horn':
+            a, c, g, i = z[:-2, :-2], z[:-2, 2:], z[2:, :-2], z[2:, 2:]
+            dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * dx[r0:r1, np.newaxis])
+            dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * dy[r0:r1, np.newaxis])
+        elif method == 'zevenbergen':
+            dzdx = (f - d) / (2 * dx[r0:r1, np.newaxis])
+            dzdy = (h - b) / (2 * dy[r0:r1, np.newaxis])
+        else:
+            raise ValueError(f'unknown slope method: {method}')
+        slope[r0:r1, 1:-1] = np.hypot(dzdx, dzdy)
+    return slope
+
+
+def calculate_slope(dem: np.ndarray, transform, nodata=-9999):
+    ''' calculate the slope of a given dem with richdem (rise / run in the units of the transform) '''
+    import richdem as rd
+    rd_dem = rd.rdarray(np.where(np.isnan(dem), nodata, dem), no_data=nodata)
+    rd_dem.geotransform = transform.to_gdal()
+    slope = rd.TerrainAttribute(rd_dem, attrib='slope_riserun')
+    slope = np.array(slope, dtype=np.float32)
+    slope[slope == nodata] = np.nan
+    return slope
+
+
+def slope_mean(shpfile, dem_mosaic: str, tile_index=None):
     ''' calculate the slope of a given catchment '''
-    if os.path.isfile(tmp_merged):
-        os.remove(tmp_merged)
-    if os.path.isfile(tmp_reprojected):
-        os.remove(tmp_reprojected)
-    # get needed N E range
-    needed_Ns = fetch_shapefile_needed_DEM_range(shpfile)['Ns']
-    needed_Es = fetch_shapefile_needed_DEM_range(shpfile)['Es']
-
-    # get needed tifs
-    files = absolute_file_paths(dem_folder)
-    files = [file for file in files if file.endswith('.tif')]
-
-    needed_tifs = []
-    for file in files:
-        N = load_N_E_from_dem_name(file)['N']
-        E = load_N_E_from_dem_name(file)['E']
-        if (N in needed_Ns) and (E in needed_Es):
-            needed_tifs.append(file)
-
-    # merge tifs
-    merge_tifs(needed_tifs, tmp_merged)
-    reproject_tif(tmp_merged, tmp_reprojected)
-
-    # get slope
-    slope = calculate_slope(tmp_reprojected)
-
-    # rise (m, dem) / run (degree, coordinates)
-    slope = slope / 111  # 1 degree = 111km
-
-    # get raster range
-    ds = gdal.Open(tmp_reprojected)
-    width = ds.RasterXSize
-    height = ds.RasterYSize
-    gt = ds.GetGeoTransform()
-    minx = gt[0]
-    miny = gt[3] + width * gt[4] + height * gt[5]
-    maxx = gt[0] + width * gt[1] + height * gt[2]
-    maxy = gt[3]
-    ds = None
-
-    # write slope tif
-    geotif_from_array(slope, lat_start=miny, lat_end=maxy, lon_start=minx, lon_end=maxx, degree=0.1,
-                      output_file=tmp_slope)
+    if tile_index is not None and len(needed_dem_tiles(shpfile, tile_index)) == 0:
+        raise FileNotFoundError(f'did not find needed tifs for determining topograpy attributes | shpfile: {shpfile}')
+    dem, transform = read_dem_window(shpfile, dem_mosaic)
+
+    # get slope, m/km
+    slope = slope_kernel(dem, transform) * 1000
 
     # zonal stats
-    try:
-        res = zonal_stats_singletif(tmp_slope, shpfile)['mean']
-    except ValueError as e:
-        print(e)
-        print(needed_Es, needed_Ns, needed_tifs)
+    res = slope[basin_mask(shpfile, slope.shape, transform)]
+    res = res[~np.isnan(res)]
+    if len(res) == 0:
         return np.nan
+    return np.mean(res)
+
+
+def compare_slope_with_richdem(dem: np.ndarray, transform) -> dict:
+    ''' benchmark slope_kernel against the former richdem path (slope_riserun in degrees / 111) for speed and accuracy
+
+    :param dem: elevation (m) in EPSG:4326, nodata as nan
+    :param transform: affine transform of the dem
+    :return: run times (s) of both methods and the differences of the richdem slope (m/km) from slope_kernel
+    '''
+    start = time.perf_counter()
+    slope = slope_kernel(dem, transform) * 1000
+    kernel_time = time.perf_counter() - start
+    start = time.perf_counter()
+    slope_rd = calculate_slope(dem, transform) / 111
+    richdem_time = time.perf_counter() - start
+
+    valid = ~np.isnan(slope) & ~np.isnan(slope_rd)
+    diff = slope_rd[valid] - slope[valid]
+    return {'kernel_time(s)': kernel_time, 'richdem_time(s)': richdem_time,
+            'bias(m/km)': np.mean(diff), 'mae(m/km)': np.mean(np.abs(diff)), 'rmse(m/km)': np.sqrt(np.mean(diff ** 2)),
+            'relative_bias': np.sum(diff) / np.sum(slope[valid])}
+
+
+def summary_stats(values: np.ndarray, name: str, unit: str, percentiles=(5, 50, 95)) -> dict:
+    ''' mean/min/max/percentiles of the valid (not nan) values, e.g. {'elev(m)': .., 'elev_min(m)': .., 'elev_p5(m)': ..} '''
+    values = values[~np.isnan(values)]
+    keys = [f'{name}({unit})', f'{name}_min({unit})', f'{name}_max({unit})'] + \
+           [f'{name}_p{p}({unit})' for p in percentiles]
+    if len(values) == 0:
+        return {key: np.nan for key in keys}
+    stats = [np.mean(values), np.min(values), np.max(values)] + list(np.percentile(values, percentiles))
+    return dict(zip(keys, stats))
+
+
+def topo_stats(shpfile, dem_mosaic: str, tile_index=None, percentiles=(5, 50, 95)) -> dict:
+    ''' elevation and slope statistics of the catchment from a single read of its DEM window
+
+    :param shpfile: catchment shapefile or geometry (e.g. BasinCatalogue.geometry)
+    :param dem_mosaic: GDEM mosaic (see build_dem_mosaic)
+    :param tile_index: GDEM tile index, used to check that the catchment is covered; None not checked
+    :param percentiles: percentiles of elevation and slope to report
+    :return: {'elev(m)': mean, 'elev_min(m)', 'elev_max(m)', 'elev_p5(m)', ..., 'slope(m/km)': mean, ...}
+    '''
+    if tile_index is not None and len(needed_dem_tiles(shpfile, tile_index)) == 0:
+        raise FileNotFoundError(f'did not find needed tifs for determining topograpy attributes | shpfile: {shpfile}')
+    with phase('io'):
+        dem, transform = read_dem_window(shpfile, dem_mosaic)
+    with phase('mask'):
+        inside = basin_mask(shpfile, dem.shape, transform)
+
+    with phase('compute'):
+        slope = slope_kernel(dem, transform) * 1000  # m/km
+
+        res = summary_stats(dem[inside], 'elev', 'm', percentiles)
+        res.update(summary_stats(slope[inside], 'slope', 'm/km', percentiles))
     return res
 
 
-def main(outpath):
-    res = []
-    print(len([file for file in absolute_file_paths(shp_folfer) if file.endswith('.shp')]))
-    shps = [file for file in absolute_file_paths(shp_folfer) if file.endswith('.shp')]
-    for shpfile in tqdm(shps):
-        tmp_res = {'shp_id': shp_id(shpfile), 'elev(m)': elev_mean(shpfile, dem_folder)['mean'],
-                   'slope(m/km)': slope_mean(shpfile, dem_folder)}
-        tmp_res.update(load_N_E_from_dem_name(shpfile))
-        res.append(tmp_res)
-    pd.DataFrame(res).to_excel(outpath)
+def estimate_window_bytes(shpfile, cell_size: float, bytes_per_cell=32) -> int:
+    ''' rough peak memory of topo_stats for a catchment: DEM window, slope and mask arrays plus temporary copies '''
+    N_E = shapefile_N_E(shpfile)
+    num_cells = ((N_E['N_max'] - N_E['N_min']) / cell_size + 3) * ((N_E['E_max'] - N_E['E_min']) / cell_size + 3)
+    return int(num_cells * bytes_per_cell)
+
+
+def memory_capped_workers(window_bytes: list, num_workers: int, memory_fraction=0.8) -> int:
+    ''' the number of workers such that the largest catchments running together fit in the available memory
+
+    :param window_bytes: estimated peak memory of every catchment
+    :param num_workers: upper limit of workers, e.g. the number of cores
+    :param memory_fraction: fraction of the available memory that may be used
+    '''
+    memory = available_memory()
+    if memory is None:
+        return num_workers
+    budget = memory * memory_fraction
+    largest = np.cumsum(sorted(window_bytes, reverse=True)[:num_workers])
+    return max(1, int(np.sum(largest <= budget)))
+
+
+def _topo_stats_task(args):
+    basin_id, geometry, dem_mosaic, tile_index = args
+    res = {'shp_id': basin_id}
+    with trace('topo_elev', basin=basin_id, items=1):
+        res.update(topo_stats(geometry, dem_mosaic, tile_index))
+    return res
+
+
+def topo_table(catalogue: BasinCatalogue, dem_folder, dem_mosaic, tile_index_file, num_workers=None) -> pd.DataFrame:
+    ''' topography attributes of all catchments of the catalogue, processed in a pool of num_workers processes
+    (default: all cores)
+
+    Catchments are submitted from the largest to the smallest so that the longest tasks start first, and the number
+    of workers is reduced when the largest catchments running together would not fit in the available memory.
+    '''
+    tile_index = load_dem_tile_index(dem_folder, tile_index_file)
+    update_dem_mosaic(tile_index, dem_mosaic)
+    with rasterio.open(dem_mosaic) as src:
+        cell_size = abs(src.res[0])
+
+    window_bytes = {basin_id: estimate_window_bytes(geometry, cell_size) for basin_id, geometry in catalogue.items()}
+    basin_ids = sorted(window_bytes, key=lambda basin_id: window_bytes[basin_id], reverse=True)
+
+    num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+    num_workers = memory_capped_workers(list(window_bytes.values()), num_workers)
+    tasks = [(basin_id, catalogue.geometry(basin_id), dem_mosaic, tile_index) for basin_id in basin_ids]
+    with multiprocessing.Pool(num_workers) as pool:
+        res = list(tqdm(pool.imap_unordered(_topo_stats_task, tasks), total=len(tasks)))
+    return pd.DataFrame(res).sort_values('shp_id').reset_index(drop=True)
+
+
+def main(outpath, dem_folder, catalogue: BasinCatalogue, dem_mosaic, tile_index_file, num_workers=None):
+    ''' only the catchments missing from outpath or whose shapefile changed are computed and merged into outpath '''
+    def compute(basin_ids):
+        return topo_table(catalogue.subset(basin_ids), dem_folder, dem_mosaic, tile_index_file,
+                          num_workers).set_index('shp_id')
+
+    update_basin_table(outpath, catalogue_hashes(catalogue), compute)
 
 
 if __name__ == '__main__':
     dem_folder = './folder_gdem'
     shp_folfer = './shapefiles'
-    outpath = './output/topo'
-    tmp_merged = 'merge_cache.tif'
-    tmp_reprojected = 'reproject_cache.tif'
-    tmp_slope = 'slope_cache.tif'
-    main(outpath)
+    outpath = './output/topo.xlsx'
+    dem_mosaic = './gdem.vrt'
+    tile_index_file = './gdem_tiles.csv'
+    num_workers = None  # None: all cores
+    catalogue = load_catalogue(shp_folfer, cache_file='./output/basins.parquet')
+    main(outpath, dem_folder, catalogue, dem_mosaic, tile_index_file, num_workers)
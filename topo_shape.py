@@ -1,11 +1,13 @@
 import shapefile
+import multiprocessing
 from tqdm import tqdm
-from shapely.geometry import Polygon, LineString
-from shapely.geometry import Point
-from functools import partial
-import shapely.ops as ops
+from shapely.geometry import LineString, MultiLineString, shape
+from shapely.strtree import STRtree
+from functools import lru_cache
 import pyproj
 from utils import *
+from basin_catalogue import load_catalogue
+from profiling import trace, phase
 from shapely.ops import transform
 
 '''
@@ -19,45 +21,113 @@ where the river stream is not clear), basin outlet and hence river length cannot
 '''
 
 
-def latlon2km(p1, p2):
+@lru_cache(maxsize=None)
+def get_transformer(src_crs='EPSG:4326', dst_crs='EPSG:32649'):
     '''
-    Convert distance in the degree to km
+    pyproj Transformer between two CRS, created once per process and reused
     '''
-    import pyproj
-    pyproj.Proj("+init=epsg:4326")
-    from shapely.geometry import LineString
-    from functools import partial
-    import pyproj
-    from shapely.ops import transform
+    return pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
 
-    line = LineString([p1, p2])
-    wgs84 = pyproj.Proj(init='epsg:4326')
-    utm = pyproj.Proj(init='epsg:32649')
 
-    project = partial(
-        pyproj.transform,
-        wgs84,
-        utm)
+def project_geometry(geom, dst_crs='EPSG:32649', src_crs='EPSG:4326'):
+    '''
+    Project a shapely geometry, the coordinates of each part are transformed in one vectorized call
+    '''
+    return transform(get_transformer(src_crs, dst_crs).transform, geom)
+
 
-    utm_polyline = transform(project, line)
+def latlon2km(p1, p2):
+    '''
+    Convert distance in the degree to km
+    '''
+    line = LineString([p1, p2])
+    utm_polyline = project_geometry(line)
     length_km = utm_polyline.length / 1000
     return length_km
 
 
+class StreamNetwork():
+    '''
+    River stream lines read once from the stream shapefile, with an STRtree over their bounding boxes
+    '''
+
+    def __init__(self, stream_shps):
+        self.path = stream_shps
+        self.lines = [LineString(stream.points) for stream in shapefile.Reader(stream_shps).shapes()
+                      if len(stream.points) > 1]
+        self.tree = STRtree(self.lines)
+        self._line_index = {id(line): i for i, line in enumerate(self.lines)}
+
+    def query(self, geom):
+        '''
+        Stream lines whose bounding box intersects the bounding box of geom, in the order of the stream shapefile
+        '''
+        hits = self.tree.query(geom)
+        if len(hits) > 0 and not isinstance(hits[0], (int, np.integer)):  # shapely < 2.0 returns the geometries
+            hits = [self._line_index[id(line)] for line in hits]
+        return [self.lines[i] for i in sorted(hits)]
+
+
+@lru_cache(maxsize=4)
+def load_stream_network(stream_shps):
+    '''
+    Read the river network once per process, later calls with the same path reuse it
+    '''
+    return StreamNetwork(stream_shps)
+
+
+@lru_cache(maxsize=None)
+def load_basin(basin_shp):
+    '''
+    Record and geometry of the first shape of a basin shapefile, read once per process
+
+    The geometry is built from the parts of the shape, so multi-ring basins become a MultiPolygon (or a Polygon with
+    holes) instead of one self-intersecting ring, and remaining invalid geometries are repaired.
+    '''
+    shape_record = shapefile.Reader(basin_shp).shapeRecord(0)
+    return shape_record.record.as_dict(), valid_geometry(shape(shape_record.shape.__geo_interface__))
+
+
+def basin_polygon(basin):
+    '''
+    Catchment geometry given a shapefile path or an already loaded (Multi)Polygon, e.g. BasinCatalogue.geometry
+    '''
+    if isinstance(basin, str):
+        return load_basin(basin)[1]
+    return basin
+
+
+def exterior_boundary(polygon):
+    '''
+    Exterior ring(s) of a (Multi)Polygon
+    '''
+    if polygon.geom_type == 'MultiPolygon':
+        return MultiLineString([part.exterior for part in polygon.geoms])
+    return polygon.exterior
+
+
+def boundary_points(polygon) -> np.ndarray:
+    '''
+    Vertices (lon, lat) of the exterior ring(s) of a (Multi)Polygon
+    '''
+    rings = exterior_boundary(polygon)
+    rings = rings.geoms if rings.geom_type == 'MultiLineString' else [rings]
+    return np.concatenate([np.asarray(ring.coords, dtype=np.float64)[:, :2] for ring in rings])
+
+
 def find_outlet(catchment_shp, stream_shps):
     '''
-    Find catchment outlet point given river stream shps and catchment shapefile
+    Find catchment outlet point given river stream shps (path or StreamNetwork) and catchment (shapefile or geometry)
     '''
-    basin = shapefile.Reader(catchment_shp).shapeRecord(0).shape
-    stream_shapes = shapefile.Reader(stream_shps).shapes()
+    streams = stream_shps if isinstance(stream_shps, StreamNetwork) else load_stream_network(stream_shps)
 
-    basin_polygon = Polygon(basin.points)
-    if not basin_polygon.is_valid:
+    polygon = basin_polygon(catchment_shp)
+    if not polygon.is_valid:
         print('invalid polygon')
         return
-    for stream in stream_shapes:
-        line = LineString(stream.points)
-        intersection = basin_polygon.exterior.intersection(line)
+    exterior = exterior_boundary(polygon)
+    for line in streams.query(polygon):
+        intersection = exterior.intersection(line)
         if intersection.is_empty:
             continue
         else:
@@ -81,36 +151,22 @@ def get_record(basins, i):
 
 def catchment_perimeter(catchment_shp):
     '''
-    Calculate the Perimeter of the catchment given shapefile
+    Calculate the Perimeter of the catchment given shapefile or geometry (geodesic, km)
     '''
-    polyline = Polygon(shapefile.Reader(catchment_shp).shapeRecord(0).shape.points)
-    wgs84 = pyproj.Proj(init='epsg:4326')
-    utm = pyproj.Proj(init='epsg:32649')
-
-    project = partial(
-        pyproj.transform,
-        wgs84,
-        utm)
-
-    utm_polyline = transform(project, polyline)
-    length_km = utm_polyline.length / 1000
-    return length_km
+    return geodesic_area_perimeter(basin_polygon(catchment_shp))[1]
 
 
 def longest_distance(catchment_shp, stream_shps):
     '''
-    For a given point, find the remotest point on the polygon boundary and return the distance
+    For a given point, find the remotest point on the polygon boundary and return the geodesic distance (km)
     '''
-    basin = shapefile.Reader(catchment_shp).shapeRecord(0).shape
-    streams = shapefile.Reader(stream_shps).shapes()
-    outlet = find_outlet(catchment_shp, stream_shps)
+    polygon = basin_polygon(catchment_shp)
+    outlet = find_outlet(polygon, stream_shps)
     if outlet:
-        max_dis = 0
-        for p in basin.points:
-            if Point(p).distance(Point(outlet)) > max_dis:
-                max_dis = Point(p).distance(Point(outlet))
-                max_point = p
-        return latlon2km(max_point, outlet)
+        points = boundary_points(polygon)
+        _, _, distance = GEOD.inv(np.full(len(points), outlet[0]), np.full(len(points), outlet[1]),
+                                  points[:, 0], points[:, 1])
+        return np.max(distance) / 1000
 
 
 def form_factor(A, L):
@@ -155,57 +211,129 @@ def elongation_ratio(A, L):
 
 def basin_area(basin_shp):
     '''
-    Calculate catchment area given shapefile
+    Calculate catchment area given shapefile or geometry (geodesic, km^2)
+    '''
+    return geodesic_area_perimeter(basin_polygon(basin_shp))[0]
+
+
+def record_gdbd_id(record: dict, basin_id):
+    '''
+    GDBD_ID of a basin record as int, None (with a warning) if the field is missing, empty or not a number
+    '''
+    value = record.get('GDBD_ID')
+    try:
+        return int(value)
+    except (TypeError, ValueError):  # None, '' or NaN
+        print(f'basin {basin_id}: invalid GDBD_ID {value!r}')
+        return None
+
+
+def catalogue_basins(catalogue):
+    '''
+    (GDBD_ID, geometry) of every basin in a BasinCatalogue; the catalogue id is used if there is no valid GDBD_ID
+    '''
+    for basin_id, geometry in catalogue.items():
+        record = catalogue.record(basin_id)
+        gdbd_id = record_gdbd_id(record, basin_id) if 'GDBD_ID' in record else None
+        yield (basin_id if gdbd_id is None else gdbd_id), geometry
+
+
+def shapefile_basins(basin_shps):
+    '''
+    (GDBD_ID, geometry) of every basin given a list of basin shapefiles; the shp_id is used if there is no valid
+    GDBD_ID
     '''
-    basin = shapefile.Reader(basin_shp).shapeRecord(0).shape
-    geom = Polygon(basin.points)
-    geom_area = ops.transform(
-        partial(
-            pyproj.transform,
-            pyproj.Proj(init='EPSG:4326'),
-            pyproj.Proj(
-                proj='aea',
-                lat_1=geom.bounds[1],
-                lat_2=geom.bounds[3]
-            )
-        ),
-        geom)
-    return geom_area.area / 1000 ** 2  # km^2
+    for basin_shp in basin_shps:
+        record, polygon = load_basin(basin_shp)
+        gdbd_id = record_gdbd_id(record, shp_id(basin_shp))
+        yield (shp_id(basin_shp) if gdbd_id is None else gdbd_id), polygon
 
 
-def basin_topo_stats(basin_shps, stream_shps):
+def shape_factors(polygon, streams):
+    '''
+    Catchment shape factors of one basin given its geometry and the river network
+    '''
+    L = longest_distance(polygon, streams)
+    A, P = geodesic_area_perimeter(polygon)
+    if L:
+        return {'Length': L, 'Area': A, 'Form factor': form_factor(A, L),
+                'Shape factor': shape_factor(A, L),
+                'Compactness coefficient': compactness_coefficient(P, A),
+                'Circulatory ratio': circulatory_ratio(P, A),
+                'Elongation ratio': elongation_ratio(A, L)}
+    # If the given polygon is invalid, the length attribute (L) cannot be determined, and other variables depend on that.
+    else:
+        return {'Length': None, 'Area': A, 'Form factor': None,
+                'Shape factor': None,
+                'Compactness coefficient': None,
+                'Circulatory ratio': None,
+                'Elongation ratio': None}
+
+
+def _shape_factors_task(args):
+    gdbd_id, polygon, stream_shps = args
+    with trace('topo_shape', basin=gdbd_id, items=1):
+        with phase('io'):
+            streams = load_stream_network(stream_shps)
+        with phase('compute'):
+            return gdbd_id, shape_factors(polygon, streams)
+
+
+def basin_topo_stats(basin_shps, stream_shps, num_workers=1):
     '''
-    Catchment shape factors statistics given a list of basin shapefiles and river stream shapefiles
+    Catchment shape factors statistics given the basins (BasinCatalogue or a list of basin shapefiles) and river
+    stream shapefiles; with num_workers > 1 the basins are processed in a process pool, each worker reads the river
+    network once
     '''
+    if isinstance(basin_shps, (list, tuple)):
+        basins = shapefile_basins(basin_shps)
+    else:
+        basins = catalogue_basins(basin_shps)
     res = {}
-    for basin_shp in tqdm(basin_shps):
-        basin = shapefile.Reader(basin_shp)
-        gdbd_id = int(get_record(basin, 0)['GDBD_ID'])
-        print(gdbd_id)
-        L = longest_distance(basin_shp, stream_shps)
-        A = basin_area(basin_shp)
-        P = catchment_perimeter(basin_shp)
-        if L:
-            res[gdbd_id] = {'Length': L, 'Area': A, 'Form factor': form_factor(A, L),
-                            'Shape factor': shape_factor(A, L),
-                            'Compactness coefficient': compactness_coefficient(P, A),
-                            'Circulatory ratio': circulatory_ratio(P, A),
-                            'Elongation ratio': elongation_ratio(A, L)}
-        # If the given polygon is invalid, the length attribute (L) cannot be determined, and other variables depend on that.
-        else:
-            res[gdbd_id] = {'Length': None, 'Area': A, 'Form factor': None,
-                            'Shape factor': None,
-                            'Compactness coefficient': None,
-                            'Circulatory ratio': None,
-                            'Elongation ratio': None}
+    if num_workers > 1:
+        stream_path = stream_shps.path if isinstance(stream_shps, StreamNetwork) else stream_shps
+        tasks = [(gdbd_id, polygon, stream_path) for gdbd_id, polygon in basins]
+        with multiprocessing.Pool(num_workers) as pool:
+            for gdbd_id, factors in tqdm(pool.imap_unordered(_shape_factors_task, tasks), total=len(tasks)):
+                res[gdbd_id] = factors
+        return res
+
+    if not isinstance(stream_shps, StreamNetwork):
+        stream_shps = load_stream_network(stream_shps)
+    for gdbd_id, polygon in tqdm(basins, total=len(basin_shps)):
+        res[gdbd_id] = shape_factors(polygon, stream_shps)
     return res
 
 
+def shape_factor_table(catalogue, stream_shps, num_workers=1):
+    '''
+    Catchment shape factors of the basins of a BasinCatalogue as a pd.DataFrame indexed by the catalogue id (shp_id),
+    the GDBD_ID of each basin is kept as a column; num_workers=None uses all cores
+    '''
+    num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+    tasks = [(basin_id, geometry, stream_shps) for basin_id, geometry in catalogue.items()]
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            res = dict(tqdm(pool.imap_unordered(_shape_factors_task, tasks), total=len(tasks)))
+    else:
+        res = dict(_shape_factors_task(task) for task in tqdm(tasks))
+    for basin_id in catalogue:
+        # GDBD_ID is None for a basin with an invalid GDBD_ID, the catalogue id if the shapefiles have no such field
+        record = catalogue.record(basin_id)
+        gdbd_id = record_gdbd_id(record, basin_id) if 'GDBD_ID' in record else basin_id
+        res[basin_id] = {'GDBD_ID': gdbd_id, **res[basin_id]}
+    return pd.DataFrame(res).T
+
+
 if __name__ == '__main__':
     shp_folfer = './shapefiles'
     stream_shps = './data/as_streams.shp'
     out_dir = './output'
 
-    basin_shps = [file for file in absolute_file_paths(shp_folfer) if '.shp' in file]
-    topo_stats = basin_topo_stats(basin_shps=basin_shps, stream_shps=stream_shps)
-    pd.DataFrame(topo_stats).T.to_excel(f'{out_dir}/shape_factors.xlsx')
+    num_workers = multiprocessing.cpu_count()
+
+    catalogue = load_catalogue(shp_folfer, cache_file=f'{out_dir}/basins.parquet')
+
+    # only the basins missing from the table or whose shapefile changed are computed
+    update_basin_table(f'{out_dir}/shape_factors.xlsx', catalogue_hashes(catalogue),
+                       lambda basin_ids: shape_factor_table(catalogue.subset(basin_ids), stream_shps, num_workers))
@@ -1,5 +1,7 @@
 import os
 import re
+import json
+import hashlib
 import datetime
 import numpy as np
 import pandas as pd
@@ -12,8 +14,14 @@ import fiona
 import netCDF4
 from netCDF4 import Dataset
 import geopandas as gpd
+import pyproj
+from shapely.geometry.polygon import orient
 import rasterio
 import rasterio.mask
+import rasterio.errors
+import rasterio.features
+import rasterio.windows
+import rasterio.transform
 from rasterio.merge import merge
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 
@@ -58,6 +66,154 @@ def shp_id(shpfile: str):
     return re.findall(r'[\d]+', shpfile)[-1]
 
 
+def basin_shapes(basin) -> list:
+    """ 流域几何 (GeoJSON), 用于 rasterio 的掩膜/统计
+
+    basin: .shp 文件路径, shapely 几何 (如 BasinCatalogue.geometry(basin_id)) 或 GeoJSON 几何列表
+    """
+    if isinstance(basin, str):
+        with fiona.open(basin, "r") as shapefile:
+            return [feature["geometry"] for feature in shapefile]
+    if hasattr(basin, '__geo_interface__'):
+        return [basin.__geo_interface__]
+    return list(basin)
+
+
+def basin_bounds(basin) -> tuple:
+    """ 流域外包矩形 (minx, miny, maxx, maxy)
+
+    basin: .shp 文件路径或 shapely 几何
+    """
+    if isinstance(basin, str):
+        with fiona.open(basin, "r") as shapefile:
+            return tuple(shapefile.bounds)
+    return tuple(basin.bounds)
+
+
+def valid_geometry(geom):
+    """ 修复自相交等无效的流域几何 (buffer(0)), 有效的几何原样返回
+    """
+    if geom.is_valid:
+        return geom
+    return geom.buffer(0)
+
+
+GEOD = pyproj.Geod(ellps='WGS84')
+
+
+def geodesic_area_perimeter(geom):
+    """ WGS84 椭球面上 (Multi)Polygon (EPSG:4326) 的面积 (km^2) 和周长 (km)
+    """
+    parts = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+    area, perimeter = 0, 0
+    for part in parts:
+        # 外环逆时针、内环顺时针, 使洞的面积被扣除
+        part_area, part_perimeter = GEOD.geometry_area_perimeter(orient(part, sign=1.0))
+        area += part_area
+        perimeter += part_perimeter
+    return area / 1000 ** 2, perimeter / 1000
+
+
+def file_hash(path: str) -> str:
+    """ 文件内容的 sha1
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def shapefile_hash(shape_file: str) -> str:
+    """ shapefile (.shp/.shx/.dbf/.prj) 内容的 sha1, 用于判断流域几何或属性是否有变化
+    """
+    h = hashlib.sha1()
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        path = os.path.splitext(shape_file)[0] + ext
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def catalogue_hashes(catalogue) -> dict:
+    """ {流域编号: shapefile_hash}, catalogue 为 BasinCatalogue
+    """
+    return {basin_id: shapefile_hash(catalogue.path(basin_id)) for basin_id in catalogue}
+
+
+def read_basin_table(path: str):
+    """ 读取以流域编号 (shp_id, 字符串) 为索引的 .xlsx/.csv 表, 文件不存在时返回 None
+    """
+    if not os.path.isfile(path):
+        return None
+    if path.endswith('.csv'):
+        table = pd.read_csv(path, index_col=0, converters={0: str})
+    else:
+        table = pd.read_excel(path, index_col=0, converters={0: str})
+    table.index.name = 'shp_id'
+    return table
+
+
+def write_table_atomic(table: pd.DataFrame, path: str, **kwargs):
+    """ 先写入同一目录下的临时文件再替换, 中断时不会留下写了一半的表
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    tmp = os.path.join(folder, f'.tmp-{os.getpid()}-{name}')
+    if path.endswith('.csv'):
+        table.to_csv(tmp, **kwargs)
+    else:
+        table.to_excel(tmp, **kwargs)
+    os.replace(tmp, path)
+
+
+def update_basin_table(out_file: str, hashes: dict, compute, hash_column='shp_hash') -> pd.DataFrame:
+    """ 增量更新流域属性表: 只计算表中没有的或哈希有变化的流域, 合并后原子写回 out_file
+
+    Parameters
+    ----------
+    out_file: 输出表 (.xlsx/.csv), 以流域编号为索引
+    hashes: {流域编号: 哈希}, 如 catalogue_hashes(catalogue)
+    compute: 函数 (流域编号列表) -> pd.DataFrame (以流域编号为索引)
+    hash_column: 表中保存哈希的列名
+    """
+    table = read_basin_table(out_file)
+    if table is None or hash_column not in table.columns:
+        todo = list(hashes)
+    else:
+        known = table[hash_column].to_dict()
+        todo = [basin_id for basin_id in hashes if known.get(basin_id) != hashes[basin_id]]
+    print(f'{out_file}: {len(todo)} of {len(hashes)} basins to compute')
+    if len(todo) == 0:
+        return table
+    new = compute(todo)
+    new.index = new.index.astype(str)
+    new[hash_column] = [hashes[basin_id] for basin_id in new.index]
+    if table is not None:
+        new = pd.concat([table.drop(index=todo, errors='ignore'), new])
+    new = new.sort_index()
+    new.index.name = 'shp_id'
+    write_table_atomic(new, out_file)
+    return new
+
+
+def load_basin_hashes(path: str) -> dict:
+    """ 按流域保存的输出文件 (如 forcing.xlsx) 对应的流域哈希 {流域编号: 哈希}
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_basin_hashes(path: str, hashes: dict):
+    tmp = path + f'.tmp-{os.getpid()}'
+    with open(tmp, 'w', encoding='utf8') as f:
+        json.dump(hashes, f)
+    os.replace(tmp, path)
+
+
 def absolute_file_paths(directory):
     """
 
@@ -68,17 +224,244 @@ def absolute_file_paths(directory):
     Returns
     -------
     list:
-        文件夹及其子文件夹内的所有文件的路径
+        文件夹及其子文件夹内的所有文件的路径; 需要反复查询的大数据目录请用 manifest.py
     """
 
     def nest(nest_directory):
-        for path, _, filenames in os.walk(nest_directory):
-            for f in filenames:
-                yield os.path.abspath(os.path.join(path, f))
+        try:
+            entries = os.scandir(nest_directory)
+        except OSError:  # 与 os.walk 相同, 不存在或无法读取的文件夹没有文件
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield from nest(entry.path)
+                elif entry.is_file():
+                    yield os.path.abspath(entry.path)
 
     return list(nest(directory))
 
 
+MODIS_NAME_PATTERN = re.compile(r'^(\w+)\.A(\d{4})(\d{3})\.(h\d{2}v\d{2})\.')
+MODIS_FEATURE_PATTERN = re.compile(r'_(\d+)\.tif')
+
+
+def modis_file_info(file_path: str) -> dict:
+    """ 解析 MODIS 文件名 (一次正则匹配)
+
+    file_path: 'MCD15A3H.A2018017.h25v06.006.2018023210623.hdf', gdal_translate -sds 输出的子数据集
+               'MCD15A3H.A2018017.h25v06.006.2018023210623_2.tif' (及其重投影结果 ..._2.tif84.tif) 或绝对路径
+
+    Returns
+    -------
+    dict
+        date (datetime.datetime), product, zones (tile, 如 h25v06), feature (子数据集序号, hdf 为 None)
+    """
+    name = os.path.basename(file_path)
+    match = MODIS_NAME_PATTERN.match(name)
+    if match is None:
+        raise ValueError(f'not a MODIS file name: {name}')
+    product, year, day_of_year, zones = match.groups()
+    feature = MODIS_FEATURE_PATTERN.search(name)
+    return {'date': datetime.datetime(int(year), 1, 1) + datetime.timedelta(int(day_of_year) - 1),
+            'product': product, 'zones': zones, 'feature': feature.group(1) if feature else None}
+
+
+def index_modis_files(files: list) -> dict:
+    """ 一次遍历将 MODIS 文件按日期和子数据集分组
+
+    Returns
+    -------
+    dict
+        {date: {feature: [该日期、该子数据集所有瓦片的文件]}}, 按日期排序; hdf 文件的 feature 为 None
+    """
+    index = {}
+    for file in files:
+        info = modis_file_info(file)
+        index.setdefault(info['date'], {}).setdefault(info['feature'], []).append(file)
+    return {date: index[date] for date in sorted(index)}
+
+
+# MODIS 正弦投影网格: 球半径 (m) 和瓦片边长 (m, 赤道上的 10 度), 共 36 × 18 个瓦片
+MODIS_SPHERE_RADIUS = 6371007.181
+MODIS_TILE_SIZE = 1111950.5197665
+
+
+def modis_tiles_for_bounds(minx: float, miny: float, maxx: float, maxy: float) -> set:
+    """ 与经纬度外包矩形相交的 MODIS 正弦投影瓦片
+
+    瓦片的行 (v) 为 10 度纬度带; 正弦投影 x = R * 经度 * cos(纬度), 因此在每个纬度带内, 外包矩形的 x 范围由
+    该带内离赤道最近/最远的纬度决定
+
+    Returns
+    -------
+    set
+        如 {'h25v05', 'h26v05'}
+    """
+    tiles = set()
+    miny, maxy = max(miny, -90.0), min(maxy, 90.0)
+    v_top, v_bottom = int((90 - maxy) // 10), int((90 - miny) // 10)
+    for v in range(max(v_top, 0), min(v_bottom, 17) + 1):
+        lat_low, lat_high = max(miny, 80.0 - 10 * v), min(maxy, 90.0 - 10 * v)
+        cos_low, cos_high = np.cos(np.radians(lat_low)), np.cos(np.radians(lat_high))
+        cos_min = min(cos_low, cos_high)
+        cos_max = 1.0 if lat_low <= 0 <= lat_high else max(cos_low, cos_high)
+        x_min = MODIS_SPHERE_RADIUS * np.radians(minx) * (cos_max if minx < 0 else cos_min)
+        x_max = MODIS_SPHERE_RADIUS * np.radians(maxx) * (cos_min if maxx < 0 else cos_max)
+        h_left = int((x_min + 18 * MODIS_TILE_SIZE) // MODIS_TILE_SIZE)
+        h_right = int((x_max + 18 * MODIS_TILE_SIZE) // MODIS_TILE_SIZE)
+        for h in range(max(h_left, 0), min(h_right, 35) + 1):
+            tiles.add(f'h{h:02d}v{v:02d}')
+    return tiles
+
+
+def catalogue_modis_tiles(catalogue) -> list:
+    """ 覆盖所有流域外包矩形的 MODIS 瓦片 (各流域外包矩形所需瓦片的并集, 而不是整体外包矩形)
+
+    catalogue: basin_catalogue.BasinCatalogue
+    """
+    tiles = set()
+    for basin_id in catalogue:
+        tiles |= modis_tiles_for_bounds(*catalogue.bounds(basin_id))
+    return sorted(tiles)
+
+
+MODIS_SINUSOIDAL = f'+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +R={MODIS_SPHERE_RADIUS} +units=m +no_defs'
+
+
+def modis_tile_transform(tile: str, size: int):
+    """ MODIS 瓦片原生网格 (正弦投影) 的 affine transform
+
+    tile: 如 'h25v05'
+    size: 瓦片每边的像元数, 500 m 产品为 2400 (MCD15A3H), 250 m 产品为 4800 (MOD13Q1)
+    """
+    h, v = int(tile[1:3]), int(tile[4:6])
+    res = MODIS_TILE_SIZE / size
+    return rasterio.transform.from_origin((h - 18) * MODIS_TILE_SIZE, (9 - v) * MODIS_TILE_SIZE, res, res)
+
+
+class ModisPixelIndex():
+    """ 每个流域在 MODIS 瓦片原生网格上的像元编号: 流域多边形投影到正弦投影一次, 在瓦片网格上栅格化
+    (像元中心落在流域内, 与 rasterio.mask.mask 一致), 不需要重投影任何栅格
+
+    瓦片网格固定不变, 结果按 (瓦片, 网格大小) 保存在 cache_file 中, 流域 shapefile 变化时重新计算
+    """
+
+    def __init__(self, catalogue, cache_file=None):
+        """
+        catalogue: basin_catalogue.BasinCatalogue
+        cache_file: 缓存文件 (.pkl), None 不缓存
+        """
+        self.cache_file = cache_file
+        self.hashes = catalogue_hashes(catalogue)
+        self.geometries = gpd.GeoSeries(list(catalogue.basins.geometry), index=catalogue.basins.index,
+                                        crs='EPSG:4326').to_crs(MODIS_SINUSOIDAL)
+        self.pixels_cache = {}
+        self.changed = False
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            for key, pixels in cached['pixels'].items():
+                self.pixels_cache[key] = {basin_id: index for basin_id, index in pixels.items()
+                                          if cached['hashes'].get(basin_id) == self.hashes.get(basin_id)}
+            self.cached_hashes = cached['hashes']
+        else:
+            self.cached_hashes = {}
+
+    def basin_ids(self) -> list:
+        return list(self.geometries.index)
+
+    def pixels(self, tile: str, size: int) -> dict:
+        """ {流域编号: 流域在瓦片内的像元的展开编号 (row * size + col)}, 不包括与瓦片不相交的流域 """
+        cached = self.pixels_cache.setdefault((tile, size), {})
+        transform = modis_tile_transform(tile, size)
+        res = MODIS_TILE_SIZE / size
+        left, top = transform.c, transform.f
+        for basin_id, geometry in self.geometries.items():
+            if basin_id in cached:
+                continue
+            minx, miny, maxx, maxy = geometry.bounds
+            col_start, col_end = max(int((minx - left) // res), 0), min(int(np.ceil((maxx - left) / res)), size)
+            row_start, row_end = max(int((top - maxy) // res), 0), min(int(np.ceil((top - miny) / res)), size)
+            if col_start >= col_end or row_start >= row_end:
+                cached[basin_id] = np.zeros(0, dtype=np.int32)
+            else:
+                window_transform = transform * rasterio.transform.Affine.translation(col_start, row_start)
+                inside = basin_mask(geometry, (row_end - row_start, col_end - col_start), window_transform)
+                rows, cols = np.nonzero(inside)
+                cached[basin_id] = ((rows + row_start) * size + cols + col_start).astype(np.int32)
+            self.changed = True
+        return {basin_id: cached[basin_id] for basin_id in self.geometries.index if len(cached[basin_id]) > 0}
+
+    def save(self):
+        """ 保存新计算的像元编号 (保留缓存中其他流域的结果) """
+        if self.cache_file is None or not self.changed:
+            return
+        hashes = dict(self.cached_hashes, **self.hashes)
+        tmp = self.cache_file + f'.tmp-{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'hashes': hashes, 'pixels': self.pixels_cache}, f)
+        os.replace(tmp, self.cache_file)
+        self.changed = False
+
+
+def modis_subdataset(hdf_file: str, feature_index: str) -> str:
+    """ hdf 文件的第 feature_index 个子数据集 (从 1 开始, 与 gdal_translate -sds 输出的 _1.tif, _2.tif ... 对应) """
+    with rasterio.open(hdf_file) as src:
+        return src.subdatasets[int(feature_index) - 1]
+
+
+def modis_zonal_stats_native(hdf_files: list, feature_index: str, pixel_index: ModisPixelIndex, valid_min,
+                             valid_max) -> dict:
+    """ 在 MODIS 原生网格上统计一个日期所有瓦片的流域均值, 不转换/重投影/拼接栅格
+
+    Parameters
+    ----------
+    hdf_files: 同一日期各瓦片的 hdf 文件
+    feature_index: 子数据集序号, 见 modis_subdataset
+    pixel_index: ModisPixelIndex
+    valid_min, valid_max: 有效值范围, NDVI: [-2000, 10000]; LAI: [0, 100]
+
+    Returns
+    -------
+    dict
+        {流域编号: {'mean', 'max', 'min'}}, 没有有效像元的流域为 0 (与 zonal_stats 一致)
+    """
+    values = {}
+    for hdf_file in hdf_files:
+        tile = modis_file_info(hdf_file)['zones']
+        with rasterio.open(modis_subdataset(hdf_file, feature_index)) as src:
+            pixels = pixel_index.pixels(tile, src.height)
+            if len(pixels) == 0:
+                continue
+            data = src.read(1).ravel()
+        for basin_id, index in pixels.items():
+            values.setdefault(basin_id, []).append(data[index])
+    res = {}
+    for basin_id in pixel_index.basin_ids():
+        basin_values = np.concatenate(values.get(basin_id, [np.zeros(0)]))
+        basin_values = basin_values[(basin_values >= valid_min) & (basin_values <= valid_max)]
+        if len(basin_values) > 0:
+            res[basin_id] = {'mean': np.mean(basin_values), 'max': np.max(basin_values), 'min': np.min(basin_values)}
+        else:
+            res[basin_id] = {'mean': 0, 'max': 0, 'min': 0}
+    return res
+
+
+def available_memory():
+    """ 当前可用物理内存 (字节), 无法获取时返回 None
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def reproject_tif(src_tif: str, out_tif: str, out_crc='EPSG:4326'):
     """
 
@@ -140,10 +523,9 @@ def extract_raster_by_shape_file(raster: str, shape_file: str, output_file=None)
     nodata: 指定 nodata 的值, 不在抽取范围内的值被标记为 nodata
     output_file: 输出 .tif 文件路径, None 不输出
     raster: .tif 文件的路径，要求坐标系为 WGS84 （EPSG:4326）
-    shape_file: .shp 文件的路径，要求坐标系为 WGS84 （EPSG:4326）
+    shape_file: .shp 文件的路径或流域几何 (见 basin_shapes)，要求坐标系为 WGS84 （EPSG:4326）
     """
-    with fiona.open(shape_file, "r") as shapefile:
-        shapes = [feature["geometry"] for feature in shapefile]
+    shapes = basin_shapes(shape_file)
     with rasterio.open(raster) as src:
         out_image, out_transform = rasterio.mask.mask(src, shapes, nodata=-9999, crop=True)
         out_meta = src.meta
@@ -159,11 +541,184 @@ def extract_raster_by_shape_file(raster: str, shape_file: str, output_file=None)
         return out_image
 
 
-def zonal_stats_singletif(tif_file: str, shape_file: str):
+def band_encoding(src, band=1):
+    """ raster_surf.geotif_from_array 编码的栅格 (见 raster_surf.FORCING_ENCODING) 的 (scale, offset, nodata),
+    实际值 = 存储值 * scale + offset; 其他栅格 (包括自带 scale 的 MODIS 等原始数据, 由各脚本自行换算) 返回 None
+
+    src: rasterio dataset
+    """
+    if src.tags(band).get('ENCODING') != 'scaled_int16':
+        return None
+    return src.scales[band - 1], src.offsets[band - 1], src.nodata
+
+
+def decode_values(values: np.ndarray, encoding) -> np.ndarray:
+    """ 按 band_encoding 的 (scale, offset, nodata) 解码为 float32, nodata 解码为 NaN; encoding 为 None 时原样返回 """
+    if encoding is None:
+        return values
+    scale, offset, nodata = encoding
+    decoded = values.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    if nodata is not None:
+        decoded[values == nodata] = np.nan
+    return decoded
+
+
+def read_band(src, band=1, window=None) -> np.ndarray:
+    """ 读取一个波段并透明地解码 scale/offset 编码的栅格 (见 band_encoding)
+
+    src: rasterio dataset
+    window: rasterio.windows.Window, None 读取整个波段
+    """
+    return decode_values(src.read(band, window=window), band_encoding(src, band))
+
+
+class ZonalAccumulator():
+    """ 分块累加区域统计量 (count/sum/min/max, 可选直方图), 避免一次性读入整个流域的栅格
+    """
+
+    def __init__(self, categorical=False, bins=None):
+        """
+        categorical: 是否统计每个整数类别的像元个数 (如 IGBP, GLiM)
+        bins: 连续变量直方图的分箱边界, None 不统计
+        """
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.categorical = categorical
+        self.category_count = np.zeros(0, dtype=np.int64)
+        self.bins = None if bins is None else np.asarray(bins)
+        self.histogram = None if bins is None else np.zeros(len(self.bins) - 1, dtype=np.int64)
+
+    def update(self, values: np.ndarray):
+        """ values: 一个数据块中落在流域内的有效像元值 (1 维) """
+        if len(values) == 0:
+            return
+        values64 = values.astype(np.float64)
+        self.count += len(values)
+        self.sum += values64.sum()
+        self.sum_sq += np.square(values64).sum()
+        self.min = min(self.min, values64.min())
+        self.max = max(self.max, values64.max())
+        if self.categorical:
+            block_count = np.bincount(values[values >= 0].astype(np.int64))
+            if len(block_count) > len(self.category_count):
+                block_count[:len(self.category_count)] += self.category_count
+                self.category_count = block_count
+            else:
+                self.category_count[:len(block_count)] += block_count
+        if self.bins is not None:
+            self.histogram += np.histogram(values64, bins=self.bins)[0]
+
+    def result(self) -> dict:
+        if self.count == 0:
+            res = {'count': 0, 'sum': 0.0, 'mean': np.nan, 'std': np.nan, 'min': np.nan, 'max': np.nan}
+        else:
+            mean = self.sum / self.count
+            res = {'count': self.count, 'sum': self.sum, 'mean': mean,
+                   'std': np.sqrt(max(self.sum_sq / self.count - mean ** 2, 0)), 'min': self.min, 'max': self.max}
+        if self.categorical:
+            res['categories'] = {value: c for value, c in enumerate(self.category_count) if c > 0}
+        if self.bins is not None:
+            res['histogram'] = self.histogram
+        return res
+
+
+def iter_block_windows(src, window: rasterio.windows.Window, max_memory: int):
+    """ 将 window 切分为与栅格原生分块 (tile/strip) 对齐的子窗口, 每个子窗口读入后约占 max_memory 字节
+
+    Parameters
+    ----------
+    src: rasterio dataset
+    window: 要遍历的窗口 (如流域外包矩形)
+    max_memory: 单个数据块的内存上限 (字节), 包括数据本身和掩膜等临时数组
+    """
+    block_height, block_width = src.block_shapes[0]
+    # 数据 + float64 副本 + 掩膜, 约为单个像元字节数的 10 倍
+    bytes_per_pixel = np.dtype(src.dtypes[0]).itemsize + 9
+    max_pixels = max(max_memory // bytes_per_pixel, block_height * block_width)
+    col_off, row_off = int(window.col_off), int(window.row_off)
+    width, height = int(window.width), int(window.height)
+
+    # 对齐到原生分块的边界, 避免一个分块被重复解码; 子窗口的宽高为分块大小的整数倍 (至少一个分块)
+    row_start = row_off - row_off % block_height
+    col_start = col_off - col_off % block_width
+    span_blocks = -(-(col_off + width - col_start) // block_width)
+    chunk_width = min(max(1, (max_pixels // block_height) // block_width), span_blocks) * block_width
+    chunk_height = max(1, (max_pixels // chunk_width) // block_height) * block_height
+    for row in range(row_start, row_off + height, chunk_height):
+        for col in range(col_start, col_off + width, chunk_width):
+            col_min, col_max = max(col, col_off), min(col + chunk_width, col_off + width)
+            row_min, row_max = max(row, row_off), min(row + chunk_height, row_off + height)
+            if col_min >= col_max or row_min >= row_max:
+                continue
+            yield rasterio.windows.Window(col_min, row_min, col_max - col_min, row_max - row_min)
+
+
+def zonal_stats_blockwise(raster: str, shape_file: str, max_memory=256 * 1024 ** 2, nodata=-9999,
+                          categorical=False, bins=None) -> dict:
+    """ 分块读取栅格做区域统计, 内存占用不超过 max_memory, 结果与 extract_raster_by_shape_file 一致
+
+    Parameters
+    ----------
+    raster: .tif/.vrt 文件的路径，要求坐标系与 shape_file 一致
+    shape_file: .shp 文件的路径或流域几何 (见 basin_shapes)
+    max_memory: 每个数据块的内存上限 (字节)
+    nodata: 视为无效值的像元值 (NaN 同样视为无效)
+    categorical: 是否统计每个整数类别的像元个数, 结果在 'categories' 中
+    bins: 连续变量直方图的分箱边界, 结果在 'histogram' 中
+
+    Returns
+    -------
+    dict
+        {'count', 'sum', 'mean', 'std', 'min', 'max'[, 'categories'][, 'histogram']}
+    """
+    shapes = basin_shapes(shape_file)
+    acc = ZonalAccumulator(categorical=categorical, bins=bins)
+    with rasterio.open(raster) as src:
+        try:
+            basin_window = rasterio.features.geometry_window(src, shapes)
+        except rasterio.errors.WindowError:
+            # 流域与栅格不相交
+            return acc.result()
+        for window in iter_block_windows(src, basin_window, max_memory):
+            inside = rasterio.features.geometry_mask(shapes, out_shape=(int(window.height), int(window.width)),
+                                                     transform=src.window_transform(window), invert=True)
+            if not inside.any():
+                continue
+            values = read_band(src, window=window)[inside]
+            valid = values != nodata
+            if np.issubdtype(values.dtype, np.floating):
+                valid &= ~np.isnan(values)
+            acc.update(values[valid])
+    return acc.result()
+
+
+def basin_mask(shape_file: str, out_shape: tuple, transform) -> np.ndarray:
+    """ 流域掩膜, 落在流域内的像元为 True (与 rasterio.mask.mask 的判定规则一致)
+
+    Parameters
+    ----------
+    shape_file: .shp 文件的路径或流域几何 (见 basin_shapes)
+    out_shape: 栅格的 (height, width)
+    transform: 栅格的 affine transform
+    """
+    shapes = basin_shapes(shape_file)
+    return rasterio.features.geometry_mask(shapes, out_shape=out_shape, transform=transform, invert=True)
+
+
+def zonal_stats_singletif(tif_file: str, shape_file: str, max_memory=None):
     """ 输入一个 .shp 文件和一个 .tif 文件, 根据 .shp 文件对 .tif 文件抽取栅格并区域统计
+
+    max_memory: None 一次读入整个流域范围; 否则按原生分块流式读取, 每块不超过 max_memory 字节
     """
+    if max_memory is not None:
+        return zonal_stats_blockwise(tif_file, shape_file, max_memory=max_memory)['mean']
+    with rasterio.open(tif_file) as src:
+        encoding = band_encoding(src)
     res = extract_raster_by_shape_file(tif_file, shape_file).flatten()
-    res = res[res != -9999]
+    res = decode_values(res[res != -9999], encoding)
     res = res[~np.isnan(res)]
     if len(res) > 0:
         return np.mean(res)